@@ -12,6 +12,7 @@ rm -f true_order_and_stages_BT.json \
       true_order_and_stages_Mallows_Tau_T10.json \
       true_order_and_stages_Pairwise.json \
       true_order_and_stages_PL.json
+rm -f true_order_and_stages_*.sqlite
 
 rm -rf logs_gen/*
 
@@ -37,13 +38,15 @@ done
 # ==============================================================================
 echo "Job $JOB_ID finished, packaging results..."
 
-tar -czf data.tar.gz data
-mv /home/hhao9/mpebm/data.tar.gz /staging/hhao9/mpebm_data.tar.gz
+# one zip per shard of combinations (utils_archive.py): each run_mlhc.sh job fetches only its own
+python3 utils_archive.py build data data_shards
+rm -rf /staging/hhao9/mpebm_data_shards
+mv data_shards /staging/hhao9/mpebm_data_shards
 rm -rf data
 
 mv json_files/* . && rmdir json_files
 
-ls -lh /staging/hhao9/mpebm_data.tar.gz
+du -sh /staging/hhao9/mpebm_data_shards
 
 # optional downstream run
 bash run.sh
@@ -11,5 +11,6 @@ for dir1 in BT Random Mallows_Tau_T1 Mallows_Tau_T10 PL Pairwise; do
         find "algo_results/$dir1/$dir" -mindepth 2 -type f -delete
     done 
 done 
+rm -rf algo_results/results_store
 
 condor_submit /home/hhao9/mpebm/run_mlhc.sub
\ No newline at end of file
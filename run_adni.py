@@ -3,7 +3,12 @@ import os
 sys.path.append(os.getcwd())
 
 import os 
-from pysaebm import run_ebm
+import argparse
+from utils_convergence import get_criteria
+from utils_chains import run_chain, summarize_chains, pooled_orders, publish_best
+from utils_pool import get_n_workers, map_kwargs, process_pool
+from pyjpm.viz import save_heatmap
+import numpy as np
 import utils_adni
 import yaml
 import json 
@@ -43,6 +48,11 @@ def load_config():
         return yaml.safe_load(f)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the EBMs to ADNI, one chain per seed and algorithm.")
+    parser.add_argument('--seeds', type=int, nargs='+', default=None, help="default: ADNI_SEEDS in config.yaml")
+    parser.add_argument('--workers', type=int, default=None, help="default: ADNI_WORKERS in config.yaml")
+    args = parser.parse_args()
+
     # Get directories correct
     base_dir = os.path.dirname(os.path.abspath(__file__))
     print(f"Current working directory: {base_dir}")
@@ -63,26 +73,61 @@ if __name__ == "__main__":
     # BURN_IN = 10
     THINNING=config['THINNING']
     MCMC_SEED = config['MCMC_SEED']
+    # ADAPTIVE_MCMC: stop each chain once converged, n_iter below is the cap
+    CONVERGENCE = get_criteria(config)
+    # independent chains per algorithm; the best is published as before
+    SEEDS = args.seeds or config.get('ADNI_SEEDS', [42])
 
     raw = os.path.join(base_dir, raw)
 
-    adni_filtered = utils_adni.get_adni_filtered(raw, meta_data, select_biomarkers, diagnosis_list)
-    debm_output, data_matrix, df_long, participant_dx_dict, ordered_biomarkers = utils_adni.process_data(adni_filtered, ventricles_log=False, tau_log=False)
-    df_long.to_csv('adni.csv', index=False)
-
-    for algorithm in ['mle', 'conjugate_priors']:
-        results = run_ebm(
-            data_file=os.path.join(base_dir, 'adni.csv'),
-            algorithm=algorithm,
-            output_dir=OUTPUT_DIR,
-            n_iter=20000,
-            n_shuffle=2,
-            burn_in=500,
-            thinning=1,
-            skip_heatmap=False,
-            skip_traceplot=False,
-            seed=42, ## 42 turns out to be the best
-            save_results=True,
-            save_details=True,
-            save_theta_phi=True,
-        )
+    # cached by the content of ADNIMERGE.csv and the options above; no CSV round trip to run_ebm
+    cache_dir = os.path.join(base_dir, config['ADNI_CACHE_DIR']) if config.get('ADNI_CACHE_DIR') else None
+    debm_output, data_matrix, df_long, participant_dx_dict, ordered_biomarkers = utils_adni.load_adni(
+        raw, meta_data, select_biomarkers, diagnosis_list, ventricles_log=False, tau_log=False, cache_dir=cache_dir)
+
+    algorithms = ['mle', 'conjugate_priors']
+    chain_fits = [dict(
+        data=df_long,
+        fname='adni',
+        algorithm=algorithm,
+        output_dir=OUTPUT_DIR,
+        n_iter=20000,
+        n_shuffle=2,
+        burn_in=500,
+        thinning=1,
+        skip_heatmap=False,
+        skip_traceplot=False,
+        seed=seed, ## 42 turns out to be the best
+        save_results=True,
+        save_details=True,
+        save_theta_phi=True,
+        convergence=CONVERGENCE,
+    ) for algorithm in algorithms for seed in SEEDS]
+
+    # every (seed, algorithm) chain is independent: a seed sweep takes the wall time of one chain
+    n_workers = min(len(chain_fits), get_n_workers(config.get('ADNI_WORKERS') if args.workers is None else args.workers))
+    print(f"Running {len(chain_fits)} chain(s) on {n_workers} worker process(es)")
+    with process_pool(n_workers) as executor:
+        chains = map_kwargs(run_chain, chain_fits, executor)
+
+    for algorithm in algorithms:
+        algorithm_chains = [x for x in chains if x['algorithm'] == algorithm]
+        summary = summarize_chains(algorithm_chains)
+        publish_best(OUTPUT_DIR, algorithm, summary['best_seed'])
+        with open(os.path.join(OUTPUT_DIR, algorithm, 'chains_summary.json'), 'w') as f:
+            json.dump(summary, f, indent=4)
+        if len(algorithm_chains) > 1:
+            save_heatmap(
+                pooled_orders(algorithm_chains),
+                burn_in=0,
+                thinning=1,
+                folder_name=os.path.join(OUTPUT_DIR, algorithm, 'heatmaps'),
+                file_name=f"adni_heatmap_{algorithm}_pooled",
+                title=f"{algorithm} Ordering Result, {len(algorithm_chains)} chains pooled",
+                biomarker_names=np.array(list(summary['order_with_highest_ll'])),
+                best_order=np.array(list(summary['order_with_highest_ll'].values())),
+            )
+        agreement = summary['agreement']
+        print(f"{algorithm}: best seed {summary['best_seed']} (max log likelihood {summary['max_log_likelihood']:.4f}), "
+              f"Kendall distance between chains {agreement['kendall_mean']:.4f} (max {agreement['kendall_max']:.4f}), "
+              f"{100 * agreement['same_as_best']:.0f}% of chains on the best order, split R-hat {agreement['split_rhat']}")
@@ -0,0 +1,356 @@
+"""Benchmarks for the pipeline's hot paths.
+
+    python3 run_bench.py tau                                   # utils_mp vs the pyjpm originals
+    python3 run_bench.py suite --update                        # record bench_baseline.json
+    python3 run_bench.py suite                                 # compare against it
+
+`suite` times every stage of generation, metadata and fitting on the real `params.json`,
+for J in SUITE_JS and SUITE_N_PARTIALS partial rankings (no network, no data/ folder):
+
+- generate_mixed, generate_partial: pyjpm `generate` of one combination and of its
+  partial-ranking datasets (J * TIMES_MORE participants each), writing the CSVs to a temporary
+  folder, as run_gen.py does;
+- generate_mixed_in_memory, generate_partial_in_memory: the same with `utils_data.generate_datasets`,
+  the in-memory clone run_mlhc.py --in-memory uses;
+- compute_conflict2, get_overlap_rate: the pyjpm-style metadata of its ordering_array;
+- preference_index: the `utils_prefs.PreferenceIndex` of it, and the same metadata from it;
+- sampler_<method>: `PlackettLuce`/`MCMC` construction plus `compute_alignment_and_determinism`;
+- get_energies_<method>: energies of N_RANDOM_PERMS random permutations;
+- get_average_tau: N_RANDOM_PERMS x MP_SAMPLE_COUNT permutations;
+- run_mpebm: a BT fit of the mixed dataset, SUITE_N_ITER iterations.
+
+The sampler and fit sizes are cut down (SUITE_SAMPLE_COUNT, SUITE_MP_MCMC, SUITE_N_ITER) so
+that the suite runs in minutes; `--full` uses config.yaml's sizes instead. Each stage gets one
+warm-up call (numba compilation), its best wall time over `--repeat` calls, and the peak
+memory of one more call: on Linux the rise of the peak RSS above the RSS before the call
+(freed heap is first returned with malloc_trim and the peak reset through
+/proc/self/clear_refs, so this is free and sees every allocation, numba's too), elsewhere the
+peak under tracemalloc (Python and NumPy allocations only, and much slower).
+
+With a baseline, a stage fails when it is slower than the baseline by more than
+`--threshold` (and SUITE_MIN_WALL seconds), or uses more than `--mem-threshold` more memory
+(and SUITE_MIN_MB); the exit status is then 1. Baselines are only comparable on the same
+machine and settings: record one with `--update` where the comparisons will run. Stages
+that look slower are measured a second time, and only the ones that stay slower fail; on a
+busy or shared machine, raise `--threshold` or `--repeat`.
+"""
+import os
+import gc
+import sys
+import json
+import ctypes
+import time
+import yaml
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy as np
+import pyjpm.mp_utils as mp_utils
+import utils_mp
+from typing import Callable, Dict, List, Tuple
+from pyjpm import generate
+from pyjpm.mp_utils import compute_conflict2
+from utils_mp import PlackettLuce, MCMC
+from utils_data import generate_datasets, get_dirichlet_alpha
+from utils_ebm import run_mpebm
+from run_meta import get_overlap_rate
+from utils_prefs import PreferenceIndex
+
+# bumped when stages change what they measure, so that older baselines are not compared
+SUITE_VERSION = 2
+SUITE_JS = [50, 100, 200]
+SUITE_N_PARTIALS = [2, 3, 4]
+SUITE_METHODS = ['BT', 'PL', 'Pairwise', 'Mallows_Tau']
+SUITE_SAMPLE_COUNT = 100
+SUITE_MP_MCMC = 100
+SUITE_N_ITER = 200
+SUITE_R = 0.25
+SUITE_SEED = 42
+SUITE_MIN_WALL = 0.01
+SUITE_MIN_MB = 1.0
+
+def timeit(fn, *args, repeat:int=3):
+    """Best wall time of `repeat` calls, after one warm-up call (numba compilation)."""
+    result = fn(*args)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def read_status_kb(field:str) -> int:
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+def memory_method() -> str:
+    """'rss' if the peak RSS of this process can be reset (Linux), else 'tracemalloc'."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        read_status_kb('VmHWM')
+        return 'rss'
+    except (OSError, KeyError):
+        return 'tracemalloc'
+
+def peak_mb(fn, *args, method:str='tracemalloc') -> float:
+    """Peak memory of one call above what was in use before it, in MB."""
+    if method == 'rss':
+        # otherwise the call reuses freed pages that are still resident and its peak is not seen
+        gc.collect()
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = read_status_kb('VmRSS')
+        fn(*args)
+        return max(0, read_status_kb('VmHWM') - before) / 1e3
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1e6
+
+def bench_tau(rng:np.random.Generator):
+    """`get_average_tau(random_perms, sigma_gt)` at the sizes run_meta.py uses."""
+    print(f"{'n_items':>8} {'nA':>6} {'nB':>6} {'pyjpm (s)':>10} {'utils_mp (s)':>13} {'speedup':>8} {'max |diff|':>11}")
+    for n_items in [10, 14, 18]:
+        for nA, nB in [(1000, 1000), (10_000, 1000)]:
+            items = np.arange(n_items, dtype=np.int64)
+            perms_a = np.array([rng.permutation(items) for _ in range(nA)])
+            perms_b = np.array([rng.permutation(items) for _ in range(nB)])
+            t_old, (old, _) = timeit(mp_utils.get_average_tau, perms_a, perms_b, repeat=1)
+            t_new, (new, _) = timeit(utils_mp.get_average_tau, perms_a, perms_b)
+            print(f"{n_items:>8} {nA:>6} {nB:>6} {t_old:>10.3f} {t_new:>13.4f} {t_old / t_new:>7.0f}x {np.max(np.abs(old - new)):>11.2e}")
+
+def make_sampler(method:str, ordering_array:np.ndarray, sizes:Dict, seed:int):
+    """The sampler run_meta.py builds for `method`, with the suite's sizes."""
+    rng = np.random.default_rng(seed)
+    if method == 'PL':
+        return PlackettLuce(
+            ordering_array=ordering_array, rng=rng, sample_count=sizes['sample_count'], pl_best=False,
+            mcmc_iterations=sizes['mp_mcmc'], n_shuffle=sizes['n_shuffle'], n_random_perms=sizes['n_random_perms'],
+        )
+    return MCMC(
+        ordering_array=ordering_array, rng=rng, method=method, mcmc_iterations=sizes['mp_mcmc'],
+        n_shuffle=sizes['n_shuffle'], n_random_perms=sizes['n_random_perms'],
+        sample_count=sizes['sample_count'], mallows_temperature=1.0,
+    )
+
+def preference_metadata(ordering_array:np.ndarray) -> Tuple[float, float]:
+    index = PreferenceIndex.from_ordering_array(ordering_array)
+    return index.conflict(), index.overlap_rate()
+
+def suite_stages(config:Dict, params:Dict, J:int, n_partials:int, sizes:Dict, output_dir:str) -> List[Tuple[str, Callable]]:
+    """(stage, zero-argument call) for one (J, n_partials) point; each call does the same work every time.
+
+    The generate stages write their CSVs to output_dir, overwriting them on every call.
+    """
+    mixed_kwargs = dict(
+        mixed_pathology=True, experiment_name=config['EXPERIMENT_NAMES'][0], params=params,
+        js=[J], rs=[SUITE_R], num_of_datasets_per_combination=1, seed=SUITE_SEED, mp_method='BT',
+        mcmc_iterations=config['MP_MCMC'], fixed_biomarker_order=False, pl_best=False,
+        low_num=n_partials, high_num=n_partials,
+        low_length=config['LOW_LENGTH'], high_length=config['HIGH_LENGTH'],
+    )
+
+    def generate_mixed():
+        # as run_gen.py calls it; without its progress messages in the table
+        with redirect_stdout(None):
+            return generate(
+                **mixed_kwargs, dirichlet_alpha=get_dirichlet_alpha(pristine=False), output_dir=output_dir,
+                keep_all_cols=False, sample_count=config['MP_SAMPLE_COUNT_GEN'],
+            )
+
+    def generate_mixed_in_memory():
+        return generate_datasets(**mixed_kwargs, dirichlet_alpha=get_dirichlet_alpha(pristine=False))
+
+    records, datasets = generate_mixed_in_memory()
+    (filename, data), = datasets.items()
+    ordering_array = records[filename]['ordering_array']
+    int2str = dict(enumerate(sorted(params.keys())))
+    str2int = {v: k for k, v in int2str.items()}
+    partial_kwargs = []
+    for idx, partial_ordering in enumerate(ordering_array):
+        partial_params = {int2str[bm]: params[int2str[bm]] for bm in partial_ordering if bm in int2str}
+        partial_kwargs.append(dict(
+            mixed_pathology=False, experiment_name=config['EXPERIMENT_NAMES'][0], params=partial_params,
+            js=[J * config['TIMES_MORE']], rs=[SUITE_R], num_of_datasets_per_combination=1,
+            seed=SUITE_SEED + idx, prefix=f"PR{idx}_m0",
+        ))
+
+    def generate_partial():
+        with redirect_stdout(None):
+            for kwargs in partial_kwargs:
+                generate(
+                    **kwargs, dirichlet_alpha=get_dirichlet_alpha(pristine=False), output_dir=output_dir,
+                    keep_all_cols=False, fixed_biomarker_order=True,
+                )
+
+    def generate_partial_in_memory():
+        for kwargs in partial_kwargs:
+            generate_datasets(**kwargs, dirichlet_alpha=get_dirichlet_alpha(pristine=False))
+
+    rng = np.random.default_rng(SUITE_SEED)
+    unique_elements = np.unique(ordering_array[ordering_array >= 0])
+    random_perms = np.array([rng.permutation(unique_elements) for _ in range(sizes['n_random_perms'])])
+    sigma_gt = np.array([rng.permutation(unique_elements) for _ in range(sizes['tau_sample_count'])])
+
+    def build_sampler(method):
+        return lambda: make_sampler(method, ordering_array, sizes, SUITE_SEED).compute_alignment_and_determinism()
+
+    def energies(method):
+        sampler = make_sampler(method, ordering_array, sizes, SUITE_SEED)
+        return lambda: sampler.get_energies(random_perms)
+
+    def fit():
+        return run_mpebm(
+            data=data, fname=filename, partial_rankings=ordering_array, bm2int=str2int, mp_method='BT',
+            n_iter=sizes['n_iter'], n_shuffle=sizes['n_shuffle'], burn_in=sizes['n_iter'] // 4, thinning=1,
+            seed=SUITE_SEED, save_results=False,
+        )
+
+    return [
+        ('generate_mixed', generate_mixed),
+        ('generate_partial', generate_partial),
+        ('generate_mixed_in_memory', generate_mixed_in_memory),
+        ('generate_partial_in_memory', generate_partial_in_memory),
+        ('compute_conflict2', lambda: compute_conflict2(ordering_array)),
+        ('get_overlap_rate', lambda: get_overlap_rate(ordering_array)),
+        ('preference_index', lambda: preference_metadata(ordering_array)),
+        *[(f"sampler_{method}", build_sampler(method)) for method in SUITE_METHODS],
+        *[(f"get_energies_{method}", energies(method)) for method in SUITE_METHODS],
+        ('get_average_tau', lambda: utils_mp.get_average_tau(random_perms, sigma_gt)),
+        ('run_mpebm', fit),
+    ]
+
+def run_suite(config:Dict, params:Dict, sizes:Dict, repeat:int, only:List[str], method:str) -> Dict[str, Dict]:
+    measurements = {}
+    print(f"{'stage':<40} {'wall (s)':>10} {'peak (MB)':>10}")
+    for J in SUITE_JS:
+        for n_partials in SUITE_N_PARTIALS:
+            with tempfile.TemporaryDirectory() as output_dir:
+                for stage, fn in suite_stages(config, params, J, n_partials, sizes, output_dir):
+                    key = f"J{J}/pr{n_partials}/{stage}"
+                    if only and not any(x in key for x in only):
+                        continue
+                    wall, _ = timeit(fn, repeat=repeat)
+                    measurements[key] = {'wall_s': wall, 'peak_mb': peak_mb(fn, method=method)}
+                    print(f"{key:<40} {wall:>10.4f} {measurements[key]['peak_mb']:>10.2f}", flush=True)
+    return measurements
+
+def compare(measurements:Dict[str, Dict], baseline:Dict[str, Dict], threshold:float, mem_threshold:float) -> List[Tuple[str, str]]:
+    """(stage, printable line) for every regression against the baseline."""
+    regressions = []
+    for key, now in measurements.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        if now['wall_s'] > before['wall_s'] * (1 + threshold) and now['wall_s'] - before['wall_s'] > SUITE_MIN_WALL:
+            regressions.append((key, f"{key}: wall {before['wall_s']:.4f} s -> {now['wall_s']:.4f} s"))
+        if now['peak_mb'] > before['peak_mb'] * (1 + mem_threshold) and now['peak_mb'] - before['peak_mb'] > SUITE_MIN_MB:
+            regressions.append((key, f"{key}: peak {before['peak_mb']:.2f} MB -> {now['peak_mb']:.2f} MB"))
+    return regressions
+
+def bench_suite(rng:np.random.Generator, args:argparse.Namespace) -> int:
+    """The generation, metadata and fitting stages, against a JSON baseline. Returns the exit status."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(base_dir, 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    with open(os.path.join(base_dir, 'params.json'), 'r') as f:
+        params = json.load(f)
+    sizes = dict(
+        n_shuffle=config['N_SHUFFLE'],
+        n_random_perms=config['N_RANDOM_PERMS'],
+        tau_sample_count=config['MP_SAMPLE_COUNT'],
+        sample_count=config['MP_SAMPLE_COUNT'] if args.full else SUITE_SAMPLE_COUNT,
+        mp_mcmc=config['MP_MCMC'] if args.full else SUITE_MP_MCMC,
+        n_iter=config['N_MCMC'] if args.full else SUITE_N_ITER,
+    )
+    # run_mpebm logs every fit
+    logging.getLogger().setLevel(logging.ERROR)
+    method = memory_method()
+    measurements = run_suite(config, params, sizes, args.repeat, args.only, method)
+
+    report = {
+        'environment': {
+            'machine': platform.machine(), 'processor': platform.processor(), 'node': platform.node(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+        },
+        'settings': {'sizes': sizes, 'repeat': args.repeat, 'memory': method, 'version': SUITE_VERSION},
+        'stages': measurements,
+    }
+    if args.update or not os.path.isfile(args.baseline):
+        if os.path.isfile(args.baseline) and args.only:
+            # keep the stages that were not rerun
+            with open(args.baseline, 'r') as f:
+                report['stages'] = {**json.load(f)['stages'], **measurements}
+        tmp_path = f"{args.baseline}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        os.replace(tmp_path, args.baseline)
+        print(f"Baseline of {len(report['stages'])} stages written to {args.baseline}")
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    settings = baseline['settings']
+    if (settings['sizes'], settings['memory'], settings.get('version')) != (sizes, method, SUITE_VERSION):
+        print(f"{args.baseline} was recorded with other settings ({baseline['settings']}); rerun with --update.")
+        return 2
+    if baseline['environment'] != report['environment']:
+        print(f"Warning: {args.baseline} was recorded on {baseline['environment']}, this is {report['environment']}.")
+    regressions = compare(measurements, baseline['stages'], args.threshold, args.mem_threshold)
+    if regressions:
+        # a busy machine makes single slow stages common: only regressions that persist count
+        flagged = sorted({key for key, _ in regressions})
+        print(f"Measuring {len(flagged)} stage(s) again")
+        again = run_suite(config, params, sizes, args.repeat, flagged, method)
+        for key in flagged:
+            measurements[key] = {x: min(measurements[key][x], again[key][x]) for x in measurements[key]}
+        regressions = compare(measurements, baseline['stages'], args.threshold, args.mem_threshold)
+    for _, line in regressions:
+        print(f"REGRESSION {line}")
+    print(f"{len(regressions)} regression(s) in {len(measurements)} stages "
+          f"(threshold +{100 * args.threshold:.0f}% wall, +{100 * args.mem_threshold:.0f}% memory)")
+    return 1 if regressions else 0
+
+BENCHMARKS = {
+    'tau': bench_tau,
+    'suite': bench_suite,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the pipeline's hot paths.")
+    parser.add_argument('names', nargs='*', metavar='benchmark', help=f"any of {', '.join(BENCHMARKS)}; default: all")
+    parser.add_argument('--baseline', default='bench_baseline.json', help="suite: baseline JSON file")
+    parser.add_argument('--update', action='store_true', help="suite: (re)write the baseline instead of comparing")
+    parser.add_argument('--threshold', type=float, default=0.25, help="suite: allowed relative slowdown per stage")
+    parser.add_argument('--mem-threshold', type=float, default=0.25, help="suite: allowed relative peak memory increase")
+    parser.add_argument('--repeat', type=int, default=3, help="suite: timed calls per stage")
+    parser.add_argument('--full', action='store_true', help="suite: config.yaml's sampler and fit sizes")
+    parser.add_argument('--only', nargs='+', default=[], help="suite: stages whose key contains any of these")
+    args = parser.parse_args()
+    unknown = [x for x in args.names if x not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s) {', '.join(unknown)}; choose from {', '.join(BENCHMARKS)}")
+
+    status = 0
+    rng = np.random.default_rng(42)
+    for name in args.names or list(BENCHMARKS):
+        print(f"=== {name}")
+        if name == 'suite':
+            status = max(status, bench_suite(rng, args))
+        else:
+            BENCHMARKS[name](rng)
+    sys.exit(status)
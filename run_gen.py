@@ -6,6 +6,12 @@ import yaml
 import re 
 from pyjpm import generate
 import numpy as np 
+from typing import Dict, List, Optional, Tuple, Iterator
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from utils_store import TrueOrderStore, STORE_EXT
+from utils_data import get_dirichlet_alpha, draw_experiment_seeds, draw_partial_seeds
+from utils_datafile import convert_data_dir
+from utils_trace import Tracer, trace_path
 
 def extract_components(filename):
     pattern = r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$'
@@ -14,21 +20,123 @@ def extract_components(filename):
         return match.groups()  # returns tuple (J, R, E, M)
     return None
 
-def convert_np_types(obj):
-    """Convert numpy types in a nested dictionary to Python standard types."""
-    if isinstance(obj, dict):
-        return {k: convert_np_types(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_np_types(item) for item in obj]
-    elif isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return convert_np_types(obj.tolist())
-    else:
-        return obj
-    
+def generate_mixed_pathology(
+        store:TrueOrderStore, 
+        gen_kwargs:Dict, 
+        experiment_names:List[str], 
+        rng:np.random.Generator,
+        tracer:Optional[Tracer]=None,
+    ):
+    """Generate the mixed-pathology datasets experiment by experiment.
+
+    Each experiment's records are committed to the store as soon as `generate()` returns,
+    and experiments already in the store are skipped (their seed is still drawn, so the
+    remaining experiments get the same seeds as in an uninterrupted run).
+
+    gen_kwargs['dirichlet_alpha'] is shared by all calls, as generate()'s default would be.
+    With a tracer, each generate() call is a 'generate_mixed' stage.
+    """
+    tracer = tracer or Tracer(None)
+    for exp_name, random_state in draw_experiment_seeds(rng, experiment_names).items():
+        if store.is_done('mixed', exp_name):
+            print(f"Skipping {exp_name}: already in {store.path}")
+            # the skipped generate() call would have left the stage prior in this state
+            gen_kwargs['dirichlet_alpha']['multinomial'] = []
+            continue
+        with tracer.stage('generate_mixed', experiment=exp_name):
+            true_order_and_stages_dicts = generate(
+                mixed_pathology=True,
+                experiment_name=exp_name,
+                seed=random_state,
+                **gen_kwargs
+            )
+        store.mark_done('mixed', exp_name, records=true_order_and_stages_dicts)
+
+def _partial_ranking_tasks(
+        store:TrueOrderStore, 
+        params:Dict, 
+        int2str:Dict[int, str], 
+        config:Dict, 
+        data_dir:str, 
+        rng:np.random.Generator
+    ) -> Iterator[Tuple[str, List[Dict]]]:
+    """Yield (fname, generate() kwargs for each of its partial orderings) for unfinished combinations.
+
+    Seeds are drawn here, in store order, so they do not depend on how the tasks are executed.
+    """
+    seeds = draw_partial_seeds(rng, store.n_partial_rankings())
+    for fname, random_states in seeds.items():
+        if store.is_done('partial', fname):
+            continue
+        J, R, E, M = extract_components(fname)
+        ordering_array = store[fname]['ordering_array']
+        kwargs_list = []
+        for idx, partial_ordering in enumerate(ordering_array):
+            # obtain the new partial params
+            partial_params = {int2str[bm]: params[int2str[bm]] for bm in partial_ordering if bm in int2str}
+            kwargs_list.append(dict(
+                mixed_pathology=False,
+                experiment_name = E,
+                params=partial_params,
+                js = [int(J) * config['TIMES_MORE']], # J * 2
+                rs = [float(R)], # 
+                num_of_datasets_per_combination=1,
+                output_dir=data_dir,
+                seed=random_states[idx],
+                # explicit, so that a task's data does not depend on what ran before it in its process
+                dirichlet_alpha=get_dirichlet_alpha(pristine=False),
+                keep_all_cols = False,
+                fixed_biomarker_order=True,
+                # the ith partial ranking for fname
+                prefix=f"PR{idx}_m{M}"
+            ))
+        yield fname, kwargs_list
+
+def generate_partial_rankings(
+        store:TrueOrderStore, 
+        params:Dict, 
+        int2str:Dict[int, str], 
+        config:Dict, 
+        data_dir:str, 
+        rng:np.random.Generator,
+        n_workers:int=1,
+    ):
+    """Generate one dataset per partial ordering of every combination in the store.
+
+    With n_workers > 1 the generate() calls run on a process pool with at most
+    2 * n_workers tasks in flight. Every task carries its own seed and writes its own
+    CSV, so the files are identical for any n_workers.
+    """
+    tasks = _partial_ranking_tasks(store, params, int2str, config, data_dir, rng)
+    if n_workers <= 1:
+        for fname, kwargs_list in tasks:
+            for kwargs in kwargs_list:
+                generate(**kwargs)
+            store.mark_done('partial', fname)
+        return
+
+    remaining = {} # fname -> number of its datasets still running
+    pending = {} # future -> fname
+
+    def collect(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            future.result() # re-raise worker errors
+            fname = pending.pop(future)
+            remaining[fname] -= 1
+            if remaining[fname] == 0:
+                store.mark_done('partial', fname)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for fname, kwargs_list in tasks:
+            remaining[fname] = len(kwargs_list)
+            for kwargs in kwargs_list:
+                if len(pending) >= 2 * n_workers:
+                    collect(FIRST_COMPLETED)
+                pending[executor.submit(generate, **kwargs)] = fname
+        if pending:
+            collect(ALL_COMPLETED)
+
 if __name__ == "__main__":
     # Get directories correct
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -58,144 +166,63 @@ if __name__ == "__main__":
     # print(json.dumps(config, indent=4))
 
     rng = np.random.default_rng(config['GEN_SEED'])
+    tracer = Tracer(trace_path(base_dir, config, 'run_gen', mp_method), script='run_gen', key=mp_method)
 
     ########################################################################
     # Generate data using the MP EBM framework
     ########################################################################
-    all_dicts = []
+    # The store doubles as the progress record: rerunning after a kill resumes where it stopped.
+    # Delete json_files/ (gen.sh does) to start from scratch.
+    os.makedirs(JSON_DIR, exist_ok=True)
+    gen_kwargs = dict(
+        params_file=params_file,
+        js = config['JS'], 
+        rs = config['RS'],
+        num_of_datasets_per_combination=config['N_VARIANTS'],
+        keep_all_cols = False,
+        mp_method=mp_method,
+        sample_count = config['MP_SAMPLE_COUNT_GEN'],
+        mcmc_iterations = config['MP_MCMC'],
+        low_num=config['LOW_NUM'], # lowest possible number of n_partial_rankings
+        high_num=config['HIGH_NUM'],
+        low_length=config['LOW_LENGTH'], # shortest possible partial ranking length
+        high_length=config['HIGH_LENGTH'], # longest possible partial ranking length
+        # generate()'s default stage prior, made explicit: see utils_data.get_dirichlet_alpha
+        dirichlet_alpha=get_dirichlet_alpha(pristine=True),
+    )
     if 'Mallows' not in mp_method:
-        DATA_DIR = os.path.join(OUTPUT_DIR, mp_method)
-        for exp_name in config['EXPERIMENT_NAMES']:
-            random_state = rng.integers(0, 2**32 - 1)
-            true_order_and_stages_dicts = generate(
-                    mixed_pathology=True,
-                    experiment_name = exp_name,
-                    params_file=params_file,
-                    js = config['JS'], 
-                    rs = config['RS'],
-                    num_of_datasets_per_combination=config['N_VARIANTS'],
-                    output_dir=DATA_DIR,
-                    seed=random_state,
-                    keep_all_cols = False,
-                    fixed_biomarker_order = False, # to randomize things
-                    mp_method=mp_method,
-                    sample_count = config['MP_SAMPLE_COUNT_GEN'],
-                    mcmc_iterations = config['MP_MCMC'],
-                    low_num=config['LOW_NUM'], # lowest possible number of n_partial_rankings
-                    high_num=config['HIGH_NUM'],
-                    low_length=config['LOW_LENGTH'], # shortest possible partial ranking length
-                    high_length=config['HIGH_LENGTH'], # longest possible partial ranking length
-                    pl_best = False
-                )
-            all_dicts.append(true_order_and_stages_dicts)
-
-        combined = {k: v for d in all_dicts for k, v in d.items()}
-        combined = convert_np_types(combined)
-
-        # Dump the JSON
-        json_path = os.path.join(JSON_DIR, f"true_order_and_stages_{mp_method}.json")
-        with open(json_path, "w") as f:
-            json.dump(combined, f, indent=2)
-
-        print("Aggregated ordering data completed!")
-        """
-        Generate partial rankings
-        """
-        for fname, fname_data in combined.items():
-            J, R, E, M = extract_components(fname)
-            ordering_array = fname_data['ordering_array']
-            for idx, partial_ordering in enumerate(ordering_array):
-                random_state = rng.integers(0, 2**32 - 1)
-                # obtain the new partial params
-                partial_params = {int2str[bm]: params[int2str[bm]] for bm in partial_ordering if bm in int2str}
-
-                # partial_params = {}
-                # for bm_int in partial_ordering:
-                #     if bm_int in int2str:
-                #         bm = int2str[bm_int]
-                #         partial_params[bm] = params[bm]
-                
-                generate(
-                    mixed_pathology=False,
-                    experiment_name = E,
-                    params=partial_params,
-                    js = [int(J) * config['TIMES_MORE']], # J * 2
-                    rs = [float(R)], # 
-                    num_of_datasets_per_combination=1,
-                    output_dir=DATA_DIR,
-                    seed=random_state,
-                    keep_all_cols = False,
-                    fixed_biomarker_order=True,
-                    # the ith partial ranking for fname
-                    prefix=f"PR{idx}_m{M}"
-                )
+        runs = [(mp_method, dict(
+            fixed_biomarker_order = False, # to randomize things
+            pl_best = False
+        ))]
     else:
-        for mallows_temperature in [1.0, 10.0]:
-            all_dicts = []
-            suffix_text = f'T{mallows_temperature}'
-            DATA_DIR = os.path.join(OUTPUT_DIR, f"{mp_method}_T{mallows_temperature}")
-            for exp_name in config['EXPERIMENT_NAMES']:
-                random_state = rng.integers(0, 2**32 - 1)
-                true_order_and_stages_dicts = generate(
-                        mixed_pathology=True,
-                        experiment_name = exp_name,
-                        params_file=params_file,
-                        js = config['JS'], 
-                        rs = config['RS'],
-                        num_of_datasets_per_combination=config['N_VARIANTS'],
-                        output_dir=DATA_DIR,
-                        seed=random_state,
-                        keep_all_cols = False,
-                        fixed_biomarker_order = True, # THIS SHOULD ALWASY BE TRUE, OTHERWISE ALL PARTICIPANTS WON'T HAVE THE SAME SEQUENCE SHARED 
-                        mp_method=mp_method,
-                        sample_count = config['MP_SAMPLE_COUNT_GEN'],
-                        mcmc_iterations = config['MP_MCMC'],
-                        low_num=config['LOW_NUM'], # lowest possible number of n_partial_rankings
-                        high_num=config['HIGH_NUM'],
-                        low_length=config['LOW_LENGTH'], # shortest possible partial ranking length
-                        high_length=config['HIGH_LENGTH'], # longest possible partial ranking length
-                        mallows_temperature = mallows_temperature
-                    )
-                all_dicts.append(true_order_and_stages_dicts)
-
-            combined = {k: v for d in all_dicts for k, v in d.items()}
-            combined = convert_np_types(combined)
-
-            # Dump the JSON
-            json_path = os.path.join(JSON_DIR, f"true_order_and_stages_{mp_method}_{suffix_text}.json")
-            with open(json_path, "w") as f:
-                json.dump(combined, f, indent=2)
-
+        runs = [(f"{mp_method}_T{mallows_temperature}", dict(
+            fixed_biomarker_order = True, # THIS SHOULD ALWASY BE TRUE, OTHERWISE ALL PARTICIPANTS WON'T HAVE THE SAME SEQUENCE SHARED 
+            mallows_temperature = mallows_temperature
+        )) for mallows_temperature in [1.0, 10.0]]
+
+    for data_framework, framework_kwargs in runs:
+        DATA_DIR = os.path.join(OUTPUT_DIR, data_framework)
+        store_path = os.path.join(JSON_DIR, f"true_order_and_stages_{data_framework}{STORE_EXT}")
+        with TrueOrderStore(store_path, mode='w') as store:
+            generate_mixed_pathology(
+                store, 
+                gen_kwargs=dict(gen_kwargs, output_dir=DATA_DIR, **framework_kwargs),
+                experiment_names=config['EXPERIMENT_NAMES'], 
+                rng=rng,
+                tracer=Tracer(tracer.path, **tracer.context, data_framework=data_framework),
+            )
+            with tracer.stage('json_export', data_framework=data_framework):
+                store.export_json(os.path.join(JSON_DIR, f"true_order_and_stages_{data_framework}.json"))
             print("Aggregated ordering data completed!")
             """
             Generate partial rankings
             """
-            
-            for fname, fname_data in combined.items():
-                J, R, E, M = extract_components(fname)
-                ordering_array = fname_data['ordering_array']
-                for idx, partial_ordering in enumerate(ordering_array):
-                    random_state = rng.integers(0, 2**32 - 1)
-                    # obtain the new partial params
-                    partial_params = {int2str[bm]: params[int2str[bm]] for bm in partial_ordering if bm in int2str}
-                    # partial_params = {}
-                    # for bm_int in partial_ordering:
-                    #     if bm_int in int2str:
-                    #         bm = int2str[bm_int]
-                    #         partial_params[bm] = params[bm]
-                    
-                    generate(
-                        mixed_pathology=False,
-                        experiment_name = E,
-                        params=partial_params,
-                        js = [int(J) * config['TIMES_MORE']], # J * 2
-                        rs = [float(R)], # 
-                        num_of_datasets_per_combination=1,
-                        output_dir=DATA_DIR,
-                        seed=random_state,
-                        keep_all_cols = False,
-                        fixed_biomarker_order=True,
-                        # the ith partial ranking for fname
-                        prefix=f"PR{idx}_m{M}"
-                    )
-    
\ No newline at end of file
+            with tracer.stage('generate_partial', data_framework=data_framework):
+                generate_partial_rankings(
+                    store, params, int2str, config, DATA_DIR, rng, n_workers=config.get('GEN_WORKERS', 1))
+        # generate() only writes CSVs
+        with tracer.stage('convert', data_framework=data_framework):
+            n_converted = convert_data_dir(DATA_DIR, config.get('DATA_FORMAT', 'csv'), n_workers=config.get('GEN_WORKERS', 1))
+        if n_converted:
+            print(f"Converted {n_converted} datasets in {DATA_DIR} to {config['DATA_FORMAT']}")
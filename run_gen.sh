@@ -17,6 +17,7 @@ echo "Created logs directory at $(pwd)/logs_gen"
 
 mkdir -p data
 mkdir -p json_files
+mkdir -p traces
 
 
 # ==============================================================================
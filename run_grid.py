@@ -0,0 +1,169 @@
+"""Run the run_mlhc.py or run_meta.py grid on one machine, without a job per combination.
+
+    python3 run_grid.py mlhc                                    # every line of all_combinations.txt
+    python3 run_grid.py meta test_combinations.txt --workers 4
+    python3 run_grid.py mlhc all_combinations.txt --shard 0/4   # lines 0, 4, 8, ... (one of four nodes)
+    python3 run_grid.py mlhc --retries 2 --in-memory
+
+Combinations run on a pool of long-lived worker processes, so pyjpm, numba and friends are
+imported and compiled once per worker instead of once per combination. Each combination's
+output goes to <log_dir>/<task>_<filename>.out. Finished combinations are appended to
+<log_dir>/<task>_done.txt and skipped when the grid is restarted; combinations that still
+fail after --retries extra attempts are listed in <log_dir>/<task>_failed.txt.
+
+A worker that dies (OOM kill, segfault) takes the pool down with it. The pool is rebuilt and
+the combinations that were running are rerun one at a time; only the one that kills its
+worker again is charged an attempt.
+"""
+import sys
+import os
+sys.path.append(os.getcwd())
+import time
+import logging
+import argparse
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import List
+from utils_pool import get_n_workers, terminate_pool
+
+def read_combinations(path:str, shard:str='0/1') -> List[str]:
+    """Lines of a combination list, keeping every n-th one starting at i for shard 'i/n'."""
+    index, count = (int(x) for x in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}: expected i/n with 0 <= i < n")
+    with open(path, 'r') as f:
+        filenames = [line.strip() for line in f if line.strip()]
+    return filenames[index::count]
+
+def run_item(task:str, filename:str, log_dir:str, in_memory:bool=False) -> float:
+    """Run one combination in this worker, with its output in its own log file. Returns the wall time."""
+    start = time.perf_counter()
+    log_path = os.path.join(log_dir, f"{task}_{filename}.out")
+    with open(log_path, 'a') as log, redirect_stdout(log), redirect_stderr(log):
+        logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler(log)], force=True)
+        try:
+            if task == 'mlhc':
+                import run_mlhc
+                # the grid's workers already use the cores; one process per combination
+                run_mlhc.main(filename, in_memory=in_memory, n_workers=1)
+            else:
+                import run_meta
+                run_meta.main(filename)
+        except BaseException:
+            traceback.print_exc()
+            raise
+        finally:
+            logging.basicConfig(handlers=[logging.NullHandler()], force=True)
+    return time.perf_counter() - start
+
+def run_grid(task:str, filenames:List[str], n_workers:int, retries:int, log_dir:str, in_memory:bool=False) -> List[str]:
+    """Run every combination not yet in <task>_done.txt. Returns the ones that failed."""
+    os.makedirs(log_dir, exist_ok=True)
+    done_path = os.path.join(log_dir, f"{task}_done.txt")
+    finished = set()
+    if os.path.isfile(done_path):
+        with open(done_path, 'r') as f:
+            finished = {line.strip() for line in f}
+    todo = [x for x in filenames if x not in finished]
+    print(f"{task}: {len(filenames)} combinations, {len(filenames) - len(todo)} already done, {len(todo)} to run on {n_workers} worker(s)")
+
+    failed = []
+    failures = {filename: 0 for filename in todo}
+    queue = deque(todo)
+    # combinations that were running when a worker died: rerun one at a time to find the one that killed it
+    suspects = deque()
+    pending = {}
+    n_done = 0
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+
+    def fail(filename, reason):
+        failures[filename] += 1
+        if failures[filename] <= retries:
+            print(f"{filename} failed ({reason}), retry {failures[filename]}/{retries}")
+            return True
+        print(f"{filename} failed ({reason}), giving up")
+        failed.append(filename)
+        return False
+
+    def collect(future):
+        """Record a finished combination; returns it if its worker died, to be rerun."""
+        nonlocal n_done
+        filename = pending.pop(future)
+        try:
+            elapsed = future.result()
+        except BrokenProcessPool:
+            return filename
+        except Exception as e:
+            if fail(filename, f"{type(e).__name__}: {e}"):
+                queue.append(filename)
+            return None
+        done_file.write(f"{filename}\n")
+        done_file.flush()
+        n_done += 1
+        rate = (time.perf_counter() - start) / n_done
+        eta = rate * (len(todo) - n_done - len(failed))
+        print(f"[{n_done}/{len(todo)}] {filename} in {elapsed:.1f}s, ETA {eta / 60:.1f} min")
+        return None
+
+    try:
+        with open(done_path, 'a') as done_file:
+            while queue or suspects or pending:
+                # at most one combination per worker in flight, so the ones lost with a worker were running
+                if suspects:
+                    if not pending:
+                        filename = suspects.popleft()
+                        pending[executor.submit(run_item, task, filename, log_dir, in_memory)] = filename
+                else:
+                    while queue and len(pending) < n_workers:
+                        filename = queue.popleft()
+                        pending[executor.submit(run_item, task, filename, log_dir, in_memory)] = filename
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                lost = [filename for filename in map(collect, completed) if filename is not None]
+                if not lost:
+                    continue
+                # the rest of the pool's futures are done too, most of them lost with it
+                completed, _ = wait(pending)
+                lost += [filename for filename in map(collect, completed) if filename is not None]
+                executor.shutdown(wait=True)
+                executor = ProcessPoolExecutor(max_workers=n_workers)
+                if len(lost) == 1:
+                    # it ran alone, so it killed its worker
+                    if fail(lost[0], "worker died"):
+                        suspects.appendleft(lost[0])
+                else:
+                    print(f"A worker died running one of {', '.join(lost)}; rerunning them one at a time")
+                    suspects.extend(lost)
+    except BaseException:
+        terminate_pool(executor)
+        raise
+    finally:
+        with open(os.path.join(log_dir, f"{task}_failed.txt"), 'w') as f:
+            f.writelines(f"{filename}\n" for filename in failed)
+    executor.shutdown()
+    print(f"{task}: {n_done} done, {len(failed)} failed, {time.perf_counter() - start:.0f}s")
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run run_mlhc.py or run_meta.py over a combination list on a local process pool.")
+    parser.add_argument('task', choices=['mlhc', 'meta'])
+    parser.add_argument('combinations', nargs='?', default='all_combinations.txt', help="one filename per line (gen_combo.py)")
+    parser.add_argument('--shard', default='0/1', help="i/n: run every n-th combination starting at i")
+    parser.add_argument('--workers', type=int, default=0, help="worker processes; 0 = the cores allocated to this job")
+    parser.add_argument('--retries', type=int, default=1, help="extra attempts for a failed combination")
+    parser.add_argument('--log-dir', default='logs_grid')
+    parser.add_argument('--in-memory', action='store_true', help="run_mlhc.py --in-memory")
+    args = parser.parse_args()
+
+    filenames = read_combinations(args.combinations, args.shard)
+    failed = run_grid(
+        args.task, filenames,
+        n_workers=get_n_workers(args.workers),
+        retries=args.retries,
+        log_dir=args.log_dir,
+        in_memory=args.in_memory,
+    )
+    sys.exit(1 if failed else 0)
@@ -5,9 +5,12 @@ import json
 import yaml
 import re 
 import pandas as pd
-from pyjpm.mp_utils import PlackettLuce,  MCMC, compute_conflict2, get_average_tau
+from utils_mp import SamplerCache, get_average_tau
 from scipy.stats import pearsonr, spearmanr
 import numpy as np 
+from utils_store import load_true_order_and_stages, load_ordering_arrays
+from utils_prefs import stack_ordering_arrays, corpus_conflict_overlap
+from utils_trace import Tracer, trace_path
 
 def extract_components(filename):
     pattern = r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$'
@@ -33,13 +36,38 @@ def get_overlap_rate(padded_partial_ranks:np.ndarray) -> float:
     total_unique_items = len(unique_items)
     return repeated_items_count / total_unique_items
 
-if __name__ == "__main__":
+TITLES = [
+    "Exp 1: S + Ordinal kj (DM) + X (Normal)",
+    "Exp 2: S + Ordinal kj (DM) + X (Non-Normal)",
+    "Exp 3: S + Ordinal kj (Uniform) + X (Normal)",
+    "Exp 4: S + Ordinal kj (Uniform) + X (Non-Normal)",
+    "Exp 8: S + Continuous kj (Uniform) + X (Sigmoid)",
+    "Exp 9: S + Continuous kj (Skewed) + X (Sigmoid)",
+    "Exp 5: S + Continuous kj (Uniform) + X (Normal)",
+    "Exp 6: S + Continuous kj (Uniform) + X (Non-Normal)",
+    "Exp 10: S + Continuous kj (Skewed) + X (Normal)",
+    "Exp 7: S + Continuous kj (Skewed) + X (Non-Normal)",
+    "Exp 11: xi (Normal) + Continuous kj (Skewed) + X (Sigmoid)",
+    "Exp 12: xi (Normal) + Continuous kj (Skewed) + X (Normal)"
+]
+
+EXP_NUMS = [1,2,3,4,8,9,5,6,10,7,11,12]
+
+def get_experiment_label(experiments, E):
+    """(pretty title, experiment number) of the experiment name E; (E, 0) if it is unknown."""
+    # Normalize mapping dictionaries
+    CONVERT_E_DICT = {k: v for k, v in zip(experiments, TITLES)}
+    GET_E_NUM = dict(zip(TITLES, EXP_NUMS))
+
+    E_pretty = CONVERT_E_DICT.get(E, E)
+    return E_pretty, GET_E_NUM.get(E_pretty, 0)
+
+def main(filename:str):
+    """Compute the metadata of one combination and save it to MP_METADATA_DIR/<filename>.csv."""
     # Get directories correct
     base_dir = os.path.dirname(os.path.abspath(__file__))
     print(f"Current working directory: {base_dir}")
 
-    # Read parameters from command line arguments
-    filename = sys.argv[1]
     J, R, E, M = extract_components(filename)
     print(f"Processing with {filename}")
 
@@ -49,83 +77,55 @@ if __name__ == "__main__":
     N_RANDOM_PERMS = config['N_RANDOM_PERMS']
     MP_MCMC = config['MP_MCMC']
     N_SHUFFLE = config['N_SHUFFLE']
+    # sample the MP_SAMPLE_COUNT orderings as parallel chains (utils_mp.sample_chains)
+    BATCHED = config.get('MP_BATCHED_SAMPLING', True)
+    CHECK_ENERGIES = config.get('MP_CHECK_ENERGIES', False)
     MP_METADATA_DIR = config['MP_METADATA_DIR']
     EXPERIMENTS = config['EXPERIMENT_NAMES']
     OUTPUT_DIR = os.path.join(base_dir, MP_METADATA_DIR)
     
-    titles = [
-        "Exp 1: S + Ordinal kj (DM) + X (Normal)",
-        "Exp 2: S + Ordinal kj (DM) + X (Non-Normal)",
-        "Exp 3: S + Ordinal kj (Uniform) + X (Normal)",
-        "Exp 4: S + Ordinal kj (Uniform) + X (Non-Normal)",
-        "Exp 8: S + Continuous kj (Uniform) + X (Sigmoid)",
-        "Exp 9: S + Continuous kj (Skewed) + X (Sigmoid)",
-        "Exp 5: S + Continuous kj (Uniform) + X (Normal)",
-        "Exp 6: S + Continuous kj (Uniform) + X (Non-Normal)",
-        "Exp 10: S + Continuous kj (Skewed) + X (Normal)",
-        "Exp 7: S + Continuous kj (Skewed) + X (Non-Normal)",
-        "Exp 11: xi (Normal) + Continuous kj (Skewed) + X (Sigmoid)",
-        "Exp 12: xi (Normal) + Continuous kj (Skewed) + X (Normal)"
-    ]
-
-    exp_nums = [1,2,3,4,8,9,5,6,10,7,11,12]
-
-    # Normalize mapping dictionaries
-    CONVERT_E_DICT = {k: v for k, v in zip(EXPERIMENTS, titles)}
-    GET_E_NUM = dict(zip(titles, exp_nums))
-
-    E_pretty = CONVERT_E_DICT.get(E, E)
-    E_Num = GET_E_NUM.get(E_pretty, 0)
+    E_pretty, E_Num = get_experiment_label(EXPERIMENTS, E)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    tracer = Tracer(trace_path(base_dir, config, 'run_meta', filename), script='run_meta', key=filename, J=int(J))
     rng = np.random.default_rng(config['GEN_SEED'])
     all_data_framework = config['MP_DATA_DIR']
     all_data_framework = [x for x in all_data_framework if x != 'Random']
+    # the generator sampler of a framework is also its inference sampler of the same method
+    samplers = SamplerCache()
+    sampling = dict(
+        mcmc_iterations=MP_MCMC, 
+        n_shuffle=N_SHUFFLE, 
+        sample_count=MP_SAMPLE_COUNT, 
+        n_random_perms=N_RANDOM_PERMS,
+    )
 
     ALL_DICTS = []
     for data_framework in all_data_framework:
         mp_method = data_framework if 'Mallows_Tau' not in data_framework else 'Mallows_Tau'
         mallows_temperature = 1 if data_framework == 'Mallows_Tau_T1' else 10
-        json_file = os.path.join(base_dir, f"true_order_and_stages_{data_framework}.json")
-        if not os.path.isfile(json_file):
-            print(f"Error: JSON file {json_file} does not exist.")
-            sys.exit(1)
-
-        with open(json_file, "r") as f:
-            true_order_and_stages = json.load(f)
-        padded_partial_ranks = np.array(true_order_and_stages[filename]['ordering_array'])
-        # n_partial_rankings = true_order_and_stages[filename]['n_partial_rankings']
+        with tracer.stage('json_load', data_framework=data_framework):
+            fname_data = load_true_order_and_stages(base_dir, data_framework, filename)
+        padded_partial_ranks = fname_data['ordering_array']
+        # i-before-j counts, coverage and positions, stored by run_gen.py (utils_prefs.py)
+        preference_index = fname_data['preference_index']
+        # n_partial_rankings = fname_data['n_partial_rankings']
         # unpadded_ordering_array = []
         # for order in padded_partial_ranks:
         #     unpadded_order = [x for x in order if x >= 0]
         #     unpadded_ordering_array.append(unpadded_order)
         # average_partial_ranking_length = sum(len(x) for x in unpadded_ordering_array)/len(padded_partial_ranks)
 
-        conflict = compute_conflict2(padded_partial_ranks)
-        overlap_rate = get_overlap_rate(padded_partial_ranks)
-
-        if data_framework == 'PL':
-            sampler = PlackettLuce(
-                ordering_array=padded_partial_ranks, 
-                rng=rng, 
-                sample_count=MP_SAMPLE_COUNT, 
-                pl_best=False,
-                mcmc_iterations=MP_MCMC, 
-                n_shuffle=N_SHUFFLE, 
-                n_random_perms=N_RANDOM_PERMS,
-            )
-        else:
-            sampler = MCMC(
-                ordering_array=padded_partial_ranks,
-                rng=rng, 
-                method=mp_method, 
-                mcmc_iterations=MP_MCMC, 
-                n_shuffle=N_SHUFFLE, 
-                n_random_perms=N_RANDOM_PERMS,
-                sample_count=MP_SAMPLE_COUNT, 
-                mallows_temperature=mallows_temperature
-            )
-        sampler.compute_alignment_and_determinism()
+        with tracer.stage('conflict_overlap', data_framework=data_framework):
+            # same values as compute_conflict2 and get_overlap_rate, without rescanning the array
+            conflict = preference_index.conflict()
+            overlap_rate = preference_index.overlap_rate()
+
+        with tracer.stage('sampler', data_framework=data_framework, algo=mp_method):
+            sampler = samplers.get(
+                padded_partial_ranks, rng, mp_method, mallows_temperature, batched=BATCHED,
+                check_energies=CHECK_ENERGIES, preference_index=preference_index, **sampling)
+            sampler.compute_alignment_and_determinism()
         # ground truth generated by the generator 
         sigma_gt = sampler.sampled_combined_orderings # ground truth orderings
         unique_elements = sampler.unique_elements
@@ -141,32 +141,15 @@ if __name__ == "__main__":
             'sharpness': sampler.aggrank_agreement
         }
         for inf_method in ['BT', 'PL', 'Pairwise', 'Mallows_Tau']:
-            random_perms = np.array([rng.permutation(unique_elements) for _ in range(N_RANDOM_PERMS)])
-            if inf_method == 'PL':
-                inf_sampler = PlackettLuce(
-                    ordering_array=padded_partial_ranks, 
-                    rng=rng, 
-                    sample_count=MP_SAMPLE_COUNT, 
-                    pl_best=False,
-                    mcmc_iterations=MP_MCMC, 
-                    n_shuffle=N_SHUFFLE, 
-                    n_random_perms=N_RANDOM_PERMS,
-                )
-            else:
-                inf_sampler = MCMC(
-                    ordering_array=padded_partial_ranks, 
-                    rng=rng, 
-                    method=inf_method, 
-                    mcmc_iterations=MP_MCMC, 
-                    sample_count=MP_SAMPLE_COUNT, 
-                    n_shuffle=N_SHUFFLE, 
-                    n_random_perms=N_RANDOM_PERMS,
-                    mallows_temperature=mallows_temperature
-                )
-            # rho (E_inf (Rand perms), d(rand perms, sigm_gt))
-            e_inf_randperms_arr = [inf_sampler.get_energy(x) for x in random_perms]
-            tau_dists, _ = get_average_tau(random_perms, sigma_gt)
-            spearman_rho, _ = spearmanr(e_inf_randperms_arr, tau_dists)
+            with tracer.stage('energy_scoring', data_framework=data_framework, algo=inf_method):
+                random_perms = np.array([rng.permutation(unique_elements) for _ in range(N_RANDOM_PERMS)])
+                inf_sampler = samplers.get(
+                    padded_partial_ranks, rng, inf_method, mallows_temperature, batched=BATCHED,
+                    check_energies=CHECK_ENERGIES, preference_index=preference_index, **sampling)
+                # rho (E_inf (Rand perms), d(rand perms, sigm_gt))
+                e_inf_randperms_arr = inf_sampler.get_energies(random_perms)
+                tau_dists, _ = get_average_tau(random_perms, sigma_gt)
+                spearman_rho, _ = spearmanr(e_inf_randperms_arr, tau_dists)
             # make a fresh copy per algo
             result_dic = curr_dic.copy()
             result_dic.update({
@@ -174,6 +157,7 @@ if __name__ == "__main__":
                 'spearman_rho': spearman_rho
             })
             ALL_DICTS.append(result_dic)
+    print(f"Samplers: {samplers.stats()}")
     df = pd.DataFrame(ALL_DICTS)
     params = {'J': int(J), 'R': float(R), 'E': E_pretty, 'M': int(M)}
     for name, value in params.items():
@@ -181,4 +165,57 @@ if __name__ == "__main__":
     df.to_csv(f"{OUTPUT_DIR}/{filename}.csv",index=False)
     # df.to_parquet(f"{OUTPUT_DIR}/{filename}.parquet", engine="pyarrow", index=False)
 
-    
\ No newline at end of file
+def main_corpus(output_path:str=None):
+    """Conflict and overlap of every combination of every framework, in one table.
+
+    The ordering arrays of all combinations are stacked into one tensor and the two metrics
+    computed on it at once (utils_prefs.corpus_conflict_overlap); they equal the `conflict` and
+    `overlap_rate` columns of the per-combination CSVs. Saved to corpus_metadata.csv by default,
+    outside MP_METADATA_DIR, so it is not mixed with the per-combination files.
+    """
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config()
+    EXPERIMENTS = config['EXPERIMENT_NAMES']
+    if output_path is None:
+        output_path = os.path.join(base_dir, 'corpus_metadata.csv')
+    tracer = Tracer(trace_path(base_dir, config, 'run_meta', 'corpus'), script='run_meta', key='corpus')
+    all_data_framework = [x for x in config['MP_DATA_DIR'] if x != 'Random']
+
+    rows, ordering_arrays = [], []
+    for data_framework in all_data_framework:
+        with tracer.stage('json_load', data_framework=data_framework):
+            arrays = load_ordering_arrays(base_dir, data_framework)
+        for filename, ordering_array in arrays.items():
+            components = extract_components(filename)
+            if components is None:
+                continue
+            J, R, E, M = components
+            E_pretty, E_Num = get_experiment_label(EXPERIMENTS, E)
+            rows.append({'filename': filename, 'data_framework': data_framework, 'E_Num': E_Num,
+                         'J': int(J), 'R': float(R), 'E': E_pretty, 'M': int(M)})
+            ordering_arrays.append(ordering_array)
+
+    with tracer.stage('conflict_overlap', n_combinations=len(rows)):
+        tensor, n_rankings = stack_ordering_arrays(ordering_arrays)
+        conflict, overlap_rate = corpus_conflict_overlap(tensor, n_rankings)
+    print(f"{len(rows)} combinations, tensor of shape {tensor.shape}")
+
+    df = pd.DataFrame(rows)
+    df.insert(3, 'conflict', conflict)
+    df.insert(4, 'overlap_rate', overlap_rate)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    print(f"Saved {output_path}")
+
+if __name__ == "__main__":
+    # Read parameters from command line arguments
+    try:
+        if sys.argv[1] == '--corpus':
+            main_corpus(sys.argv[2] if len(sys.argv) > 2 else None)
+        else:
+            main(sys.argv[1])
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
@@ -16,6 +16,7 @@ chmod 755 logs_meta
 echo "Created logs directory at $(pwd)/logs_meta"
 
 mkdir -p metadata
+mkdir -p traces
 
 
 # ==============================================================================
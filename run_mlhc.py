@@ -3,12 +3,24 @@ import os
 sys.path.append(os.getcwd())
 
 import json 
-from pyjpm import run_mpebm, get_params_path
+import shutil
+from pyjpm import get_params_path
 from pyjpm.mp_utils import get_unique_rows
 
 import yaml
 import re 
 import numpy as np 
+from typing import Optional
+from utils_store import load_true_order_and_stages
+from utils_pool import get_n_workers, map_kwargs, process_pool
+from utils_ebm import run_mpebm
+from utils_cache import run_mpebm_cached
+from utils_data import generate_combination
+from utils_checkpoint import JobProgress
+from utils_datafile import data_path
+from utils_archive import DataArchive, find_shard
+from utils_convergence import get_criteria
+from utils_trace import Tracer, trace_path, traced_call, traced_kwargs
 
 def extract_components(filename):
     pattern = r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$'
@@ -24,7 +36,13 @@ def load_config():
     with open(config_path, "r") as f:
         return yaml.safe_load(f)
 
-if __name__ == "__main__":
+def main(filename:str, in_memory:bool=False, n_workers:Optional[int]=None):
+    """Fit every method to one combination, for each framework in MP_DATA_DIR.
+
+    With in_memory the datasets are regenerated from run_gen.py's seeds in this process and
+    handed to run_mpebm as DataFrames: no data/ tree is needed, only the ground truth stores.
+    n_workers overrides MLHC_WORKERS.
+    """
     # Get directories correct
     base_dir = os.path.dirname(os.path.abspath(__file__))
     print(f"Current working directory: {base_dir}")
@@ -44,74 +62,160 @@ if __name__ == "__main__":
     print("Loaded config:")
     print(json.dumps(config, indent=4))
 
+    DATA_FORMAT = config.get('DATA_FORMAT', 'csv')
     N_MCMC=config['N_MCMC']
     N_SHUFFLE=config['N_SHUFFLE']
     BURN_IN=config['BURN_IN']
     THINNING=config['THINNING']
     MCMC_SEED = config['MCMC_SEED']
+    # ADAPTIVE_MCMC: chains stop once converged, N_MCMC (x2 for partial rankings) is the cap
+    CONVERGENCE = get_criteria(config)
 
     rng = np.random.default_rng(config['MCMC_SEED'])
 
-    for mp_data_dir in config['MP_DATA_DIR']:
-        data_dir = os.path.join(base_dir, "data", mp_data_dir)
-        OUTPUT_DIR=os.path.join(config['OUTPUT_DIR'], mp_data_dir)
-
-        # Read parameters from command line arguments
-        filename = sys.argv[1]
-        J, R, E, M = extract_components(filename)
-        print(f"Processing with {filename}")
-        data_file = os.path.join(data_dir, f"{filename}.csv")
-        if not os.path.isfile(data_file):
-            print(f"Error: Data file {data_file} does not exist.")
-            sys.exit(1)
-
-        # Obtain ordering_array
-        estimated_partial_rankings = []
-        # final_theta_phi_list = []
-
-        # Get true order and true stages dict
-        with open(os.path.join(base_dir, f"true_order_and_stages_{mp_data_dir}.json"), "r") as f:
-            true_order_and_stages = json.load(f)
-        true_order_dict = true_order_and_stages[filename]['true_order']
-        true_stages = true_order_and_stages[filename]['true_stages']
-        partial_rankings = true_order_and_stages[filename]['ordering_array']
-        n_partial_rankings = len(partial_rankings)
-
-        for idx in range(n_partial_rankings):
-            random_state = rng.integers(0, 2**32 - 1)
-            # partial ranking data file path
-            five_times_J = int(J)*config['TIMES_MORE']
-            pr_data_file = os.path.join(data_dir, f"PR{idx}_m{M}_j{five_times_J}_r{R}_E{E}.csv")
-
-            _, order_with_highest_ll = run_mpebm(
-                data_file=pr_data_file,
-                save_results=False,
-                n_iter=N_MCMC * 2,
-                n_shuffle=N_SHUFFLE,
-                burn_in=BURN_IN,
-                thinning=THINNING,
-                seed = random_state
-            )
-            partial_ordering_str = [k for k, v in sorted(order_with_highest_ll.items(), key=lambda item: item[1])]
-            partial_ordering = [str2int[bm] for bm in partial_ordering_str]
-            estimated_partial_rankings.append(partial_ordering)
-            
-        # theta_phi_use = merge_mean_dicts(final_theta_phi_list)
-        padded_partial_rankings = get_unique_rows(estimated_partial_rankings)
-
-        ###################################################################################
-        # Step1: MPEBM
-        ###################################################################################
-        for mp_method in config['TESTED_MP_METHODS']:
+    # Per-stage wall/CPU time and peak memory, one JSON line each (utils_trace.py)
+    J = extract_components(filename)[0]
+    tracer = Tracer(trace_path(base_dir, config, 'run_mlhc', filename), script='run_mlhc', key=filename, J=int(J))
+
+    # Partial-ranking fits are cached by data content and hyperparameters (utils_cache.py);
+    # the cache lives outside algo_results so run.sh does not wipe it.
+    FIT_CACHE_DIR = config.get('FIT_CACHE_DIR')
+    if FIT_CACHE_DIR:
+        FIT_CACHE_DIR = os.path.join(base_dir, FIT_CACHE_DIR)
+
+    # Chain checkpoints and finished stages (utils_checkpoint.py). They live in the output dir,
+    # which HTCondor spools on eviction, so a restarted job resumes instead of starting over.
+    CHECKPOINT_DIR = os.path.join(config['OUTPUT_DIR'], 'checkpoints', filename)
+    CHECKPOINT_SECONDS = config.get('CHECKPOINT_SECONDS', 300)
+    progress = JobProgress(os.path.join(CHECKPOINT_DIR, 'progress.json'))
+
+    # Datasets come from this job's shard of the data archive (utils_archive.py) if run_mlhc.sh
+    # fetched one, from data/ otherwise
+    archive = None
+    archive_dir = os.path.join(base_dir, config.get('DATA_ARCHIVE') or '')
+    if not in_memory and config.get('DATA_ARCHIVE') and os.path.isdir(archive_dir):
+        archive = DataArchive(find_shard(archive_dir, filename))
+        print(f"Reading datasets from {archive.path}")
+
+    # Every saved fit also appends its metrics to this Parquet dataset (utils_results.py)
+    RESULTS_STORE = config.get('RESULTS_STORE')
+    if RESULTS_STORE:
+        RESULTS_STORE = os.path.join(config['OUTPUT_DIR'], RESULTS_STORE)
+
+    # The fits below are independent given their seeds, which are drawn here in the original order,
+    # so running them on a pool does not change the results.
+    n_workers = get_n_workers(config.get('MLHC_WORKERS') if n_workers is None else n_workers)
+    print(f"Using {n_workers} worker process(es)")
+    # a failed fit stops the other fits of the job instead of waiting for them
+    with process_pool(n_workers) as executor:
+        for mp_data_dir in config['MP_DATA_DIR']:
+            data_dir = os.path.join(base_dir, "data", mp_data_dir)
+            OUTPUT_DIR=os.path.join(config['OUTPUT_DIR'], mp_data_dir)
+
+            J, R, E, M = extract_components(filename)
+            print(f"Processing with {filename}")
+            data_file = data_path(data_dir, filename, DATA_FORMAT)
+            if in_memory:
+                with tracer.stage('generate_in_memory', data_framework=mp_data_dir):
+                    data, partial_data = generate_combination(config, params, mp_data_dir, filename, base_dir)
+                data_source = dict(data=data, fname=filename)
+            elif archive is not None:
+                data_source = dict(data=archive.read(mp_data_dir, filename), fname=filename)
+            elif not os.path.isfile(data_file):
+                raise FileNotFoundError(f"Data file {data_file} does not exist.")
+            else:
+                data_source = dict(data_file=data_file)
+
+            # Get true order and true stages dict
+            with tracer.stage('json_load', data_framework=mp_data_dir):
+                fname_data = load_true_order_and_stages(base_dir, mp_data_dir, filename)
+            true_order_dict = fname_data['true_order']
+            true_stages = fname_data['true_stages']
+            partial_rankings = fname_data['ordering_array']
+            n_partial_rankings = len(partial_rankings)
+
+            partial_fits = []
+            for idx in range(n_partial_rankings):
+                random_state = rng.integers(0, 2**32 - 1)
+                # partial ranking data file path
+                five_times_J = int(J)*config['TIMES_MORE']
+                pr_fname = f"PR{idx}_m{M}_j{five_times_J}_r{R}_E{E}"
+                if in_memory:
+                    pr_source = dict(data=partial_data[idx], fname=pr_fname)
+                elif archive is not None:
+                    pr_source = dict(data=archive.read(mp_data_dir, pr_fname), fname=pr_fname)
+                else:
+                    pr_source = dict(data_file=data_path(data_dir, pr_fname, DATA_FORMAT))
+                partial_fits.append(dict(
+                    **pr_source,
+                    save_results=False,
+                    cache_dir=FIT_CACHE_DIR,
+                    cache_max_mb=config.get('FIT_CACHE_MAX_MB', 256),
+                    n_iter=N_MCMC * 2,
+                    n_shuffle=N_SHUFFLE,
+                    burn_in=BURN_IN,
+                    thinning=THINNING,
+                    seed = random_state,
+                    convergence=CONVERGENCE,
+                    checkpoint_file=os.path.join(CHECKPOINT_DIR, f"{mp_data_dir}_{pr_fname}.npz"),
+                    checkpoint_seconds=CHECKPOINT_SECONDS,
+                ))
+
+            # Obtain ordering_array
+            estimated_partial_rankings = progress.get(f"{mp_data_dir}/partial")
+            if estimated_partial_rankings is None:
+                estimated_partial_rankings = []
+                traced_fits = traced_kwargs(
+                    tracer, 'partial_fit', run_mpebm_cached, partial_fits,
+                    [dict(data_framework=mp_data_dir, algo='saebm', pr_idx=idx) for idx in range(n_partial_rankings)])
+                for _, order_with_highest_ll in map_kwargs(traced_call, traced_fits, executor):
+                    partial_ordering_str = [k for k, v in sorted(order_with_highest_ll.items(), key=lambda item: item[1])]
+                    partial_ordering = [int(str2int[bm]) for bm in partial_ordering_str]
+                    estimated_partial_rankings.append(partial_ordering)
+                progress.done(f"{mp_data_dir}/partial", estimated_partial_rankings)
+
+
+            # theta_phi_use = merge_mean_dicts(final_theta_phi_list)
+            padded_partial_rankings = get_unique_rows(estimated_partial_rankings)
+
+            mixed_fits = []
+            ###################################################################################
+            # Step1: MPEBM
+            ###################################################################################
+            for mp_method in config['TESTED_MP_METHODS']:
+                random_state = rng.integers(0, 2**32 - 1)
+                mixed_fits.append(dict(
+                    save_results=True,
+                    partial_rankings=padded_partial_rankings,
+                    bm2int=str2int,
+                    mp_method=mp_method,
+                    **data_source,
+                    output_dir=OUTPUT_DIR,
+                    output_folder=mp_method,
+                    n_iter=N_MCMC,
+                    n_shuffle=N_SHUFFLE,
+                    burn_in=BURN_IN,
+                    thinning=THINNING,
+                    true_order_dict=true_order_dict,
+                    true_stages = true_stages,
+                    seed = random_state,
+                    mallows_temperature = 1.0,
+                    convergence=CONVERGENCE,
+                    checkpoint_file=os.path.join(CHECKPOINT_DIR, f"{mp_data_dir}_{mp_method}.npz"),
+                    checkpoint_seconds=CHECKPOINT_SECONDS,
+                    results_store=RESULTS_STORE,
+                    data_framework=mp_data_dir,
+                ))
+        
+            ###################################################################################
+            # Step2: 
+            ###################################################################################
             random_state = rng.integers(0, 2**32 - 1)
-            run_mpebm(
+            mixed_fits.append(dict(
                 save_results=True,
-                partial_rankings=padded_partial_rankings,
-                bm2int=str2int,
-                mp_method=mp_method,
-                data_file= data_file,
+                **data_source,
                 output_dir=OUTPUT_DIR,
-                output_folder=mp_method,
+                output_folder='saebm',
                 n_iter=N_MCMC,
                 n_shuffle=N_SHUFFLE,
                 burn_in=BURN_IN,
@@ -119,29 +223,28 @@ if __name__ == "__main__":
                 true_order_dict=true_order_dict,
                 true_stages = true_stages,
                 seed = random_state,
-                mallows_temperature = 1.0,
-            )
-        
-        ###################################################################################
-        # Step2: 
-        ###################################################################################
-        random_state = rng.integers(0, 2**32 - 1)
-        run_mpebm(
-            save_results=True,
-            data_file= data_file,
-            output_dir=OUTPUT_DIR,
-            output_folder='saebm',
-            n_iter=N_MCMC,
-            n_shuffle=N_SHUFFLE,
-            burn_in=BURN_IN,
-            thinning=THINNING,
-            true_order_dict=true_order_dict,
-            true_stages = true_stages,
-            seed = random_state
-        )
-
-
-    
+                convergence=CONVERGENCE,
+                checkpoint_file=os.path.join(CHECKPOINT_DIR, f"{mp_data_dir}_saebm.npz"),
+                checkpoint_seconds=CHECKPOINT_SECONDS,
+                results_store=RESULTS_STORE,
+                data_framework=mp_data_dir,
+            ))
+            if progress.get(f"{mp_data_dir}/mixed") is None:
+                traced_fits = traced_kwargs(
+                    tracer, 'mixed_fit', run_mpebm, mixed_fits,
+                    [dict(data_framework=mp_data_dir, algo=x.get('mp_method', 'saebm')) for x in mixed_fits])
+                map_kwargs(traced_call, traced_fits, executor)
+                progress.done(f"{mp_data_dir}/mixed")
+
+    if archive is not None:
+        archive.close()
+    # the job is complete: nothing left to resume
+    shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
 
-    
-    
\ No newline at end of file
+if __name__ == "__main__":
+    # python3 run_mlhc.py <filename> [--in-memory]
+    try:
+        main(sys.argv[1], in_memory='--in-memory' in sys.argv[2:])
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
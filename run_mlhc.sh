@@ -21,6 +21,7 @@ for dir1 in BT PL PL Mallows_Tau_T1 Mallows_Tau_T10 Pairwise Random; do
         mkdir -p "algo_results/$dir1/$dir"
     done
 done
+mkdir -p traces
 
 # ==============================================================================
 # 🐍 Conda Env Extraction
@@ -56,9 +57,16 @@ fi
 # ==============================================================================
 # 📦 Extract data
 # ==============================================================================
+DATA_SHARDS="/staging/hhao9/mpebm_data_shards"
 DATA_TARBALL="/staging/hhao9/mpebm_data.tar.gz"
 
-if [[ -f "$DATA_TARBALL" ]]; then
+if [[ -d "$DATA_SHARDS" ]]; then
+    # only the shard with this combination's datasets; run_mlhc.py reads it without extracting
+    SHARD=$("$PYTHON_EXEC" ./utils_archive.py shard "$1")
+    echo "📦 Copying $DATA_SHARDS/$SHARD..."
+    mkdir -p data_shards
+    cp "$DATA_SHARDS/$SHARD" data_shards/
+elif [[ -f "$DATA_TARBALL" ]]; then
     echo "📦 Extracting $DATA_TARBALL..."
     tar -xzf "$DATA_TARBALL"
     # If extraction creates "mpebm_data", rename to "data"
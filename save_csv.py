@@ -6,8 +6,13 @@ import yaml
 import numpy as np 
 from tqdm import tqdm
 import shutil
+import hashlib
+import argparse
 from pyjpm import get_params_path
 import pyjpm.mp_utils as mp_utils
+from utils_store import open_true_order_and_stages
+from utils_pool import get_n_workers, process_pool
+from utils_results import read_results, compact
 
 EPSILON = 1e-12
 
@@ -33,7 +38,235 @@ def generate_expected_files(config, ALL_DATA_DIR, ALL_ALGOS):
                             expected.append((data_dir, algo, fname))
     return set(expected)
 
-def main():
+# Per-file results of earlier runs: path, mtime_ns, size, settings_hash, status, reason + RECORD_COLUMNS
+MANIFEST_FILE = 'all_results_manifest.csv'
+RECORD_COLUMNS = [
+    'data_framework', 'J', 'R', 'E', 'M', 'algo', 'E_Num', 'n_partial_rankings',
+    'kendalls_tau', 'average_partial_ranking_length', 'mae',
+]
+# Files per task sent to a worker
+CHUNK_SIZE = 500
+
+def summarize_true_order(fname_data) -> dict:
+    ordering_array = np.array(fname_data['ordering_array'])
+    unpadded_ordering_array = []
+    for order in ordering_array:
+        unpadded_order = [x for x in order if x >= 0]
+        unpadded_ordering_array.append(unpadded_order)
+    average_partial_ranking_length = sum(len(x) for x in unpadded_ordering_array)/len(ordering_array)
+    return {
+        'n_partial_rankings': fname_data["n_partial_rankings"],
+        'average_partial_ranking_length': average_partial_ranking_length,
+    }
+
+def parse_fname(fname:str, settings:dict):
+    """(J, R, E, M) of a result file name. Raises ValueError with the reason if it is not part of the grid."""
+    # Parse filename components
+    components = extract_components(fname)
+    if not components:
+        raise ValueError("Invalid filename format")
+
+    J, R, E, M = components
+    try:
+        J = int(J)
+        R = float(R)
+        M = int(M)
+    except ValueError:
+        raise ValueError("Invalid numeric format in filename")
+
+    # Validate against config
+    if J not in settings['JS']:
+        raise ValueError(f"Invalid J value {J}")
+    if R not in settings['RS']:
+        raise ValueError(f"Invalid R value {R}")
+    if E not in settings['EXPERIMENTS']:
+        raise ValueError(f"Invalid experiment {E}")
+    if not (0 <= M < settings['N_VARIANTS']):
+        raise ValueError(f"Invalid M value {M}")
+    return J, R, E, M
+
+def make_record(data_dir:str, algo:str, components:tuple, data:dict, summary:dict, settings:dict):
+    """Metrics of one fit -> ('ok', record) or ('skipped', None) for experiments outside the analysis."""
+    J, R, E, M = components
+    algo_pretty = settings['CONVERT_ALGO_DICT'].get(algo, algo)
+    E_pretty = settings['CONVERT_E_DICT'].get(E, E)
+    E_num = settings['GET_E_NUM'].get(E_pretty, 0)
+
+    if E_num == 0:
+        return 'skipped', None
+
+    return 'ok', {
+        'data_framework': data_dir,
+        'J': J,
+        'R': R,
+        'E': E_pretty,
+        'M': M,
+        'algo': algo_pretty,
+        'E_Num': int(E_num),
+        'n_partial_rankings': summary['n_partial_rankings'],
+        'kendalls_tau': data['kendalls_tau'],
+        'average_partial_ranking_length': summary['average_partial_ranking_length'],
+        'mae': data['mean_absolute_error'],
+    }
+
+def parse_result_file(full_path:str, data_dir:str, algo:str, fname:str, summary:dict, settings:dict):
+    """One result file -> ('ok', record), ('failed', reason) or ('skipped', None)."""
+    try:
+        components = parse_fname(fname, settings)
+    except ValueError as e:
+        return 'failed', str(e)
+
+    # Load and validate JSON content
+    try:
+        with open(full_path, 'r') as f:
+            data = json.load(f)
+
+        if 'kendalls_tau' not in data or 'mean_absolute_error' not in data:
+            return 'failed', "Missing metrics in JSON"
+
+        return make_record(data_dir, algo, components, data, summary, settings)
+    except json.JSONDecodeError:
+        return 'failed', "Invalid JSON format"
+    except Exception as e:
+        return 'failed', f"Unexpected error: {str(e)}"
+
+def get_summary(true_order_and_stages, summaries:dict, key:str):
+    """summarize_true_order of a combination, memoized in summaries; None if it is not in the ground truth."""
+    if key not in summaries:
+        try:
+            summaries[key] = summarize_true_order(true_order_and_stages[key])
+        except KeyError:
+            summaries[key] = None
+    return summaries[key]
+
+def make_row(path:str, status:str, result, **extra) -> dict:
+    row = {'path': path, **extra, 'status': status, 'reason': result if status == 'failed' else None}
+    row.update({col: (result or {}).get(col) if status == 'ok' else None for col in RECORD_COLUMNS})
+    return row
+
+def parse_chunk(data_dir:str, chunk:list, settings:dict) -> list:
+    """Manifest rows for result files of one data framework; the ground truth is read once per combination."""
+    true_order_and_stages = open_true_order_and_stages('.', data_dir)
+    summaries = {}
+    rows = []
+    for _, algo, fname, full_path, mtime_ns, size in chunk:
+        summary = get_summary(true_order_and_stages, summaries, fname.replace("_results.json", ''))
+        if summary is None:
+            status, result = 'failed', "Not in true_order_and_stages"
+        else:
+            status, result = parse_result_file(full_path, data_dir, algo, fname, summary, settings)
+        rows.append(make_row(full_path, status, result, mtime_ns=mtime_ns, size=size))
+    if hasattr(true_order_and_stages, 'close'):
+        true_order_and_stages.close()
+    return rows
+
+def parse_entries(entries:list, settings:dict, n_workers:int) -> dict:
+    """Parse result files on a process pool, in chunks grouped by data framework. Returns path -> row."""
+    by_data_dir = {}
+    for entry in entries:
+        by_data_dir.setdefault(entry[0], []).append(entry)
+    tasks = [
+        (data_dir, group[start:start + CHUNK_SIZE])
+        for data_dir, group in by_data_dir.items()
+        for start in range(0, len(group), CHUNK_SIZE)
+    ]
+    parsed = {}
+    with process_pool(n_workers if len(tasks) > 1 else 1) as executor:
+        futures = [
+            executor.submit(parse_chunk, data_dir, chunk, settings) if executor else None
+            for data_dir, chunk in tasks
+        ]
+        for (data_dir, chunk), future in tqdm(zip(tasks, futures), total=len(tasks), desc="Parsing"):
+            rows = future.result() if executor else parse_chunk(data_dir, chunk, settings)
+            parsed.update((row['path'], row) for row in rows)
+    return parsed
+
+def parse_store(store_dir:str, settings:dict, data_dirs:list, algos:list) -> list:
+    """Rows for the fits in the utils_results.py store instead of the result files, in config order."""
+    # one file per partition reads in a fraction of a second, one file per fit does not
+    compact(store_dir)
+    df = read_results(
+        store_dir,
+        filters=[('data_framework', 'in', data_dirs), ('algo', 'in', algos)],
+        columns=['kendalls_tau', 'mean_absolute_error'],
+    )
+    df = df.astype(object).where(df.notna(), None)
+    rows = []
+    for data_dir in data_dirs:
+        true_order_and_stages = open_true_order_and_stages('.', data_dir)
+        summaries = {}
+        for algo in algos:
+            for record in df[(df['data_framework'] == data_dir) & (df['algo'] == algo)].to_dict('records'):
+                fname = f"{record['filename']}_results.json"
+                path = os.path.join(store_dir, data_dir, algo, fname)
+                summary = get_summary(true_order_and_stages, summaries, record['filename'])
+                if summary is None:
+                    status, result = 'failed', "Not in true_order_and_stages"
+                else:
+                    try:
+                        status, result = make_record(data_dir, algo, parse_fname(fname, settings), record, summary, settings)
+                    except ValueError as e:
+                        status, result = 'failed', str(e)
+                rows.append(make_row(path, status, result, found=(data_dir, algo, fname)))
+        if hasattr(true_order_and_stages, 'close'):
+            true_order_and_stages.close()
+    return rows
+
+def load_manifest(path:str, settings_hash:str) -> dict:
+    """path -> row of the last run, if it used the same settings."""
+    if not os.path.isfile(path):
+        return {}
+    manifest = pd.read_csv(path, float_precision='round_trip', keep_default_na=False, na_values=[''])
+    manifest = manifest[manifest['settings_hash'] == settings_hash]
+    manifest = manifest.astype(object).where(manifest.notna(), None)
+    return {row['path']: row for row in manifest.to_dict('records')}
+
+def save_manifest(path:str, rows:list, settings_hash:str):
+    manifest = pd.DataFrame(rows, columns=['path', 'mtime_ns', 'size', 'status', 'reason'] + RECORD_COLUMNS)
+    manifest.insert(3, 'settings_hash', settings_hash)
+    tmp_path = f"{path}.tmp"
+    manifest.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def scan_results(output_dir:str, settings:dict, data_dirs:list, algos:list, full:bool, n_workers:int):
+    """Rows for every *_results.json under output_dir, in directory order, and the (data_dir, algo, fname) found."""
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+    manifest = {} if full else load_manifest(MANIFEST_FILE, settings_hash)
+
+    # Every result file, in directory order: (data_dir, algo, fname, full_path, mtime_ns, size)
+    entries = []
+    for data_dir in data_dirs:
+        for algo in algos:
+            algo_dir = os.path.join(output_dir, data_dir, algo, "results")
+
+            if not os.path.exists(algo_dir):
+                print(f"\nWarning: Missing directory for {data_dir}, {algo}")
+                continue
+
+            for entry in os.scandir(algo_dir):
+                if entry.name.endswith('_results.json'):
+                    stat = entry.stat()
+                    entries.append((data_dir, algo, entry.name, os.path.join(algo_dir, entry.name), stat.st_mtime_ns, stat.st_size))
+    found_files = set((data_dir, algo, fname) for data_dir, algo, fname, _, _, _ in entries)
+
+    # Only new or changed files are parsed
+    stale = [
+        entry for entry in entries
+        if entry[3] not in manifest or (manifest[entry[3]]['mtime_ns'], manifest[entry[3]]['size']) != (entry[4], entry[5])
+    ]
+    print(f"{len(entries)} result files, {len(entries) - len(stale)} unchanged, {len(stale)} to parse")
+    parsed = parse_entries(stale, settings, n_workers)
+
+    rows = [parsed.get(entry[3]) or manifest[entry[3]] for entry in entries]
+    save_manifest(MANIFEST_FILE, rows, settings_hash)
+    return rows, found_files
+
+def main(full:bool=False, n_workers:int=1, from_store:bool=False):
+    """Aggregate algo_results into all_results.csv, parsing only files that changed since the last run (unless full).
+
+    With from_store the fits are read from the RESULTS_STORE Parquet dataset (utils_results.py)
+    instead of the *_results.json files.
+    """
 
     # params_file = get_params_path()
     params_file = 'params.json'
@@ -106,138 +339,20 @@ def main():
     # Initialize tracking structures
     expected_files = generate_expected_files(
         config, ALL_DATA_DIR=ALL_DATA_DIR, ALL_ALGOS=ALL_ALGOS)
-    found_files = set()
-    missing_files = set()
-    failed_files = []
-    records = []
-
-    for data_dir in tqdm(ALL_DATA_DIR, desc=f"Processing data_dirs"):
-        print(f'Processing {data_dir}')
-        with open(f"true_order_and_stages_{data_dir}.json", "r") as f:
-            true_order_and_stages = json.load(f)
-        # Process all algorithms
-        for algo in ALL_ALGOS:
-            algo_dir = os.path.join(OUTPUT_DIR, data_dir, algo, "results")
-
-            if not os.path.exists(algo_dir):
-                print(f"\nWarning: Missing directory for {data_dir}, {algo}")
-                continue
-
-            # Process all result files
-            files = [f for f in os.listdir(algo_dir) if f.endswith('_results.json')]
-            for fname in tqdm(files, desc=f"{algo}", leave=False):
-                # obtain certainty and conflict 
-                fname_data = true_order_and_stages[fname.replace("_results.json", '')]
-                ordering_array = np.array(fname_data['ordering_array'])
-                unpadded_ordering_array = []
-                for order in ordering_array:
-                    unpadded_order = [x for x in order if x >= 0]
-                    unpadded_ordering_array.append(unpadded_order)
-                average_partial_ranking_length = sum(len(x) for x in unpadded_ordering_array)/len(ordering_array)
-                n_partial_rankings = fname_data["n_partial_rankings"]
-
-                full_path = os.path.join(algo_dir, fname)
-
-                # Track found files
-                found_files.add((data_dir, algo, fname))
-
-                # Parse filename components
-                components = extract_components(fname)
-                if not components:
-                    failed_files.append((full_path, "Invalid filename format"))
-                    continue
-
-                J, R, E, M = components
-                try:
-                    J = int(J)
-                    R = float(R)
-                    M = int(M)
-                except ValueError:
-                    failed_files.append((full_path, "Invalid numeric format in filename"))
-                    continue
-                    
-                # Validate against config
-                if J not in JS:
-                    failed_files.append((full_path, f"Invalid J value {J}"))
-                    continue
-                if R not in RS:
-                    failed_files.append((full_path, f"Invalid R value {R}"))
-                    continue
-                if E not in EXPERIMENTS:
-                    failed_files.append((full_path, f"Invalid experiment {E}"))
-                    continue
-                if not (0 <= M < N_VARIANTS):
-                    failed_files.append((full_path, f"Invalid M value {M}"))
-                    continue
-
-                # Load and validate JSON content
-                try:
-                    with open(full_path, 'r') as f:
-                        data = json.load(f)
-                    
-                    if 'kendalls_tau' not in data or 'mean_absolute_error' not in data:
-                        failed_files.append((full_path, "Missing metrics in JSON"))
-                        continue
-
-                    algo_pretty = CONVERT_ALGO_DICT.get(algo, algo)  
-                    E_pretty = CONVERT_E_DICT.get(E, E)
-                    E_num = GET_E_NUM.get(E_pretty, 0)
-
-                    if E_num == 0:
-                        continue 
-
-                    kendalls_tau = data['kendalls_tau']
-                    mae_result = data['mean_absolute_error']
-
-                    # # Calcuate energy
-                    # highest_ll_order  = [k for k, v in sorted(data["order_with_highest_ll"].items(), key=lambda item: item[1])]
-                    # highest_ll_order = np.array([str2int[bm] for bm in highest_ll_order])
-
-                    # mallows_temperature = np.nan 
-                    # mp_method = data_dir
-                    # if data_dir == 'Random':
-                    #     energy = np.nan
-                    # if data_dir == 'Mallows_Tau_T1.0':
-                    #     mallows_temperature = 1
-                    #     mp_method = 'Mallows_Tau'
-                    # if data_dir == 'Mallows_Tau_T10.0':
-                    #     mallows_temperature = 10 
-                    #     mp_method = 'Mallows_Tau'
-                    # try:
-                    #     if data_dir != 'Random':
-                    #         if data_dir == 'PL':
-                    #             sampler = mp_utils.PlackettLuce(ordering_array=ordering_array, rng=rng)
-                    #         else:
-                    #             sampler = mp_utils.MCMC(
-                    #                 ordering_array=ordering_array, 
-                    #                 method=mp_method, 
-                    #                 rng=rng, 
-                    #                 mallows_temperature=mallows_temperature
-                    #             )
-                    #         energy = sampler.get_energy(highest_ll_order)
-                        
-                    # except Exception as e:
-                    #     print(f"{data_dir}")
-                    #     print(f"An error occurred: {e}")
-                        
-                    records.append({
-                        'data_framework': data_dir,
-                        'J': J,
-                        'R': R,
-                        'E': E_pretty,
-                        'M': M,
-                        'algo': algo_pretty,
-                        'E_Num': int(E_num),
-                        'n_partial_rankings': n_partial_rankings,
-                        # 'energy': energy,
-                        'kendalls_tau': kendalls_tau,
-                        'average_partial_ranking_length': average_partial_ranking_length,
-                        'mae': mae_result,
-                    })
-                except json.JSONDecodeError:
-                    failed_files.append((full_path, "Invalid JSON format"))
-                except Exception as e:
-                    failed_files.append((full_path, f"Unexpected error: {str(e)}"))
+    settings = dict(
+        JS=JS, RS=RS, EXPERIMENTS=EXPERIMENTS, N_VARIANTS=N_VARIANTS,
+        CONVERT_ALGO_DICT=CONVERT_ALGO_DICT, CONVERT_E_DICT=CONVERT_E_DICT, GET_E_NUM=GET_E_NUM,
+    )
+    if from_store:
+        store_dir = os.path.join(OUTPUT_DIR, config['RESULTS_STORE'])
+        rows = parse_store(store_dir, settings, ALL_DATA_DIR, ALL_ALGOS)
+        found_files = set(row['found'] for row in rows)
+        print(f"{len(rows)} fits in {store_dir}")
+    else:
+        rows, found_files = scan_results(OUTPUT_DIR, settings, ALL_DATA_DIR, ALL_ALGOS, full, n_workers)
+
+    records = [{col: row[col] for col in RECORD_COLUMNS} for row in rows if row['status'] == 'ok']
+    failed_files = [(row['path'], row['reason']) for row in rows if row['status'] == 'failed']
     
     # Calculate missing files
     missing_files = expected_files - found_files
@@ -293,4 +408,9 @@ def main():
         print(f"Logged {len(failed_files)} failed files to failed_files.txt")
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Collect algo_results into all_results.csv.")
+    parser.add_argument('--full', action='store_true', help=f"ignore {MANIFEST_FILE} and parse every file")
+    parser.add_argument('--workers', type=int, default=0, help="processes for parsing; 0 = the cores allocated to this job")
+    parser.add_argument('--from-store', action='store_true', help="read the fits from the RESULTS_STORE Parquet dataset instead of the JSON files")
+    args = parser.parse_args()
+    main(full=args.full, n_workers=get_n_workers(args.workers), from_store=args.from_store)
@@ -1,7 +1,9 @@
+import os
+import json
+import hashlib
 import pandas as pd 
 import numpy as np 
 from typing import List, Dict, Tuple, Optional
-import copy 
 import altair as alt 
 from collections import defaultdict, namedtuple, Counter
 
@@ -23,8 +25,7 @@ def get_adni_filtered(raw:str, meta_data:List[str], select_biomarkers:List[str],
     df = df[df['DX_bl'].isin(diagnosis_list)]
 
     # 3. Convert biomarker columns to numeric (handles garbage strings like '--')
-    for col in select_biomarkers:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df[select_biomarkers] = df[select_biomarkers].apply(pd.to_numeric, errors='coerce')
 
     # 4. Drop rows with any NaN in biomarkers
     df = df.dropna(subset=select_biomarkers).reset_index(drop=True)
@@ -79,19 +80,23 @@ def process_data(df:pd.DataFrame, ventricles_log:bool, tau_log:bool) -> Tuple[pd
     if ventricles_log:
         df['VentricleNorm (log)'] = np.log10(df['VentricleNorm'])
         df.drop(['VentricleNorm', 'Ventricles'], axis=1, inplace=True)
-    participant_dx_dict = dict(zip(df.PTID, df.DX))
     df.drop([
         'VISCODE', 'COLPROT', 'DX', 'ICV', 'Ventricles', 
         'Hippocampus', 'WholeBrain', 'Entorhinal', 'Fusiform', 'MidTemp'
     ], axis=1, inplace=True)
     # for debm
     debm_output = df.copy()
-    df.drop(['Diagnosis', 'PTID'], axis=1, inplace=True)
+    return (debm_output, *to_model_inputs(debm_output))
+
+def to_model_inputs(debm_output:pd.DataFrame) -> Tuple[np.ndarray, pd.DataFrame, Dict[int, str], List[str]]:
+    """(data_matrix, df_long, participant_dx_dict, ordered_biomarkers) of process_data, from its debm_output."""
+    participant_dx_dict = dict(zip(debm_output.PTID, debm_output.Diagnosis))
+    df = debm_output.drop(['Diagnosis', 'PTID'], axis=1)
     # Ordered biomarkers, to match the ordering outputs later
     ordered_biomarkers = list(df.columns)
     df['diseased'] = [int(dx != 'CN') for dx in participant_dx_dict.values()]
     # for ucl
-    data_matrix = copy.deepcopy(df.to_numpy())
+    data_matrix = df.to_numpy(copy=True)
     df['participant'] = range(len(df))
     df['diseased'] = [bool(x) for x in df.diseased]
     df_long = pd.melt(
@@ -100,30 +105,129 @@ def process_data(df:pd.DataFrame, ventricles_log:bool, tau_log:bool) -> Tuple[pd
         var_name='biomarker',              # name for former column names
         value_name='measurement'                 # name for the measured values
     )
-    return debm_output, data_matrix, df_long, participant_dx_dict, ordered_biomarkers
+    return data_matrix, df_long, participant_dx_dict, ordered_biomarkers
+
+def hash_file(path:str, chunk_size:int=1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_adni(
+    raw:str, 
+    meta_data:List[str], 
+    select_biomarkers:List[str], 
+    diagnosis_list:List[str], 
+    ventricles_log:bool, 
+    tau_log:bool, 
+    cache_dir:Optional[str]=None,
+) -> Tuple[pd.DataFrame, np.ndarray, pd.DataFrame, Dict[int, str], List[str]]:
+    """process_data(get_adni_filtered(...)), with the filtered, normalized table cached.
+
+    The cache is one Parquet file per key in cache_dir, the SHA-256 of the raw file's content
+    and of the arguments. A rerun on the same ADNIMERGE.csv reads that file instead of parsing
+    the CSV; a new download or other biomarkers give a new key. cache_dir None disables it.
+    """
+    cache_path = None
+    if cache_dir:
+        options = dict(
+            meta_data=meta_data, select_biomarkers=select_biomarkers, diagnosis_list=diagnosis_list, 
+            ventricles_log=ventricles_log, tau_log=tau_log,
+        )
+        key = hashlib.sha256(f"{hash_file(raw)}{json.dumps(options, sort_keys=True)}".encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, f"adni_{key[:16]}.parquet")
+        if os.path.isfile(cache_path):
+            print(f"Reading the preprocessed ADNI data from {cache_path}")
+            debm_output = pd.read_parquet(cache_path)
+            return (debm_output, *to_model_inputs(debm_output))
+
+    adni_filtered = get_adni_filtered(raw, meta_data, select_biomarkers, diagnosis_list)
+    outputs = process_data(adni_filtered, ventricles_log=ventricles_log, tau_log=tau_log)
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        outputs[0].to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    return outputs
     
+DIAGNOSIS_ORDER = ['CN', 'EMCI', 'LMCI', 'AD']
+
+class StagingDistributions:
+    """Stage x diagnosis contingency tables of many staging runs at once.
+
+    ml_stages: (n_runs, n_participants) ML stages, e.g. one row per algorithm, seed or
+        bootstrap replicate.
+    diagnoses: (n_participants,) diagnoses shared by all runs, or (n_runs, n_participants)
+        when participants differ between runs (bootstrap resamples). Diagnoses not in
+        diagnosis_order are not counted.
+    labels: optional names of the runs, for table() and chart().
+
+    All tables come from a single np.bincount: counts[run, stage, diagnosis]. The per-run
+    DataFrames and Altair charts are only built when asked for.
+    """
+    def __init__(self, ml_stages, diagnoses, labels:Optional[List]=None, diagnosis_order:List[str]=DIAGNOSIS_ORDER):
+        ml_stages = np.atleast_2d(np.asarray(ml_stages, dtype=np.int64))
+        n_runs, n_participants = ml_stages.shape
+        self.diagnosis_order = list(diagnosis_order)
+        self.labels = list(labels) if labels is not None else list(range(n_runs))
+        if len(self.labels) != n_runs:
+            raise ValueError(f"{len(self.labels)} labels for {n_runs} runs.")
+
+        diagnoses = np.asarray(diagnoses)
+        # -1 for diagnoses not in diagnosis_order
+        dx_codes = pd.Categorical(diagnoses.ravel(), categories=self.diagnosis_order).codes.astype(np.int64)
+        dx_codes = np.broadcast_to(dx_codes.reshape(diagnoses.shape), ml_stages.shape)
+
+        # each run's own stage range, as plot_staging always had it
+        self.min_stages = ml_stages.min(axis=1)
+        self.max_stages = ml_stages.max(axis=1)
+        self.stage_offset = int(self.min_stages.min())
+        n_stages = int(self.max_stages.max()) - self.stage_offset + 1
+        n_dx = len(self.diagnosis_order)
+
+        counted = dx_codes >= 0
+        runs = np.broadcast_to(np.arange(n_runs)[:, None], ml_stages.shape)
+        flat = (runs[counted] * n_stages + ml_stages[counted] - self.stage_offset) * n_dx + dx_codes[counted]
+        self.counts = np.bincount(flat, minlength=n_runs * n_stages * n_dx).reshape(n_runs, n_stages, n_dx)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def run_index(self, run) -> int:
+        """Index of a run, given its label or its index."""
+        if run in self.labels:
+            return self.labels.index(run)
+        if isinstance(run, (int, np.integer)) and 0 <= run < len(self):
+            return int(run)
+        raise KeyError(f"No staging run {run!r}.")
+
+    def table(self, run) -> pd.DataFrame:
+        """Stage, Diagnosis, Count, Total and Percentage of one run, over its stage range."""
+        idx = self.run_index(run)
+        lo, hi = int(self.min_stages[idx]) - self.stage_offset, int(self.max_stages[idx]) - self.stage_offset
+        counts = self.counts[idx, lo:hi + 1]
+        totals = counts.sum(axis=1, keepdims=True)
+        n_stages, n_dx = counts.shape
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percentages = counts / totals
+        return pd.DataFrame({
+            'Stage': np.repeat(np.arange(lo, hi + 1) + self.stage_offset, n_dx),
+            'Diagnosis': self.diagnosis_order * n_stages,
+            'Count': counts.ravel(),
+            'Total': np.repeat(totals.ravel(), n_dx),
+            'Percentage': percentages.ravel(),
+        })
+
+    def chart(self, run, algorithm:str):
+        """The plot_staging chart of one run."""
+        return staging_chart(self.table(run), algorithm)
+
 def plot_staging(ml_stages:List[int], participant_dx_dict:Dict[int, str], algorithm:str):
+    return StagingDistributions([ml_stages], list(participant_dx_dict.values())).chart(0, algorithm)
 
-    # DataFrame preparation
-    df = pd.DataFrame({
-        'Stage': ml_stages,
-        'Diagnosis': list(participant_dx_dict.values())
-    })
-    diagnosis_order = ['CN', 'EMCI', 'LMCI', 'AD']
-    stage_range = list(range(df['Stage'].min(), df['Stage'].max() + 1))
-
-    # Count table with missing combinations filled
-    count_df = df.groupby(['Stage', 'Diagnosis']).size().reset_index(name='Count')
-    all_combinations = pd.MultiIndex.from_product([stage_range, diagnosis_order], names=['Stage', 'Diagnosis'])
-    count_df = count_df.set_index(['Stage', 'Diagnosis']).reindex(all_combinations, fill_value=0).reset_index()
-
-    # Calculate stage totals for reference
-    stage_totals = count_df.groupby('Stage')['Count'].sum().reset_index()
-    stage_totals = stage_totals.rename(columns={'Count': 'Total'})
-    count_df = pd.merge(count_df, stage_totals, on='Stage')
-
-    # Calculate percentage for tooltips while keeping absolute counts for display
-    count_df['Percentage'] = count_df['Count'] / count_df['Total']
+def staging_chart(count_df:pd.DataFrame, algorithm:str):
+    """Stacked bars of the participants per stage and diagnosis, from a StagingDistributions.table."""
 
     # Paul Tol's colorblind-friendly palette (scientific standard)
     color_scale = alt.Scale(
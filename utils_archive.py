@@ -0,0 +1,144 @@
+"""Sharded, indexed archive of the `data/` tree, read member by member.
+
+A run_mlhc.py job needs one `j{J}_r{R}_E{E}_m{M}` dataset and its `PR{idx}_...` siblings per
+framework, but `mpebm_data.tar.gz` makes it copy and extract all of `data/`. Here the
+datasets are spread over `n` zip files, `<archive_dir>/shard_{k:03d}_of_{n:03d}.zip`, and
+every dataset of a combination (all frameworks, mixed and partial) is in shard
+`crc32(combination) % n`. A job copies that one shard and reads its members in place: zip's
+central directory is the member index, so nothing is extracted to disk.
+
+Members are `<framework>/<name>.csv` (deflated) or `<framework>/<name>.parquet` (stored:
+Parquet is compressed already, see utils_datafile.py).
+
+    python3 utils_archive.py build data data_shards --shards 64   # gen.sh
+    python3 utils_archive.py shard j50_r0.1_E..._m0               # shard file of a combination
+    python3 utils_archive.py list data_shards/shard_000_of_064.zip
+"""
+import os
+import re
+import glob
+import zlib
+import yaml
+import zipfile
+import argparse
+import pandas as pd
+from typing import Dict, List, Optional
+from utils_datafile import DATA_FORMATS, read_dataset
+
+SHARD_PATTERN = re.compile(r'^shard_(\d+)_of_(\d+)\.zip$')
+
+def shard_name(shard:int, n_shards:int) -> str:
+    return f"shard_{shard:03d}_of_{n_shards:03d}.zip"
+
+def shard_of(combination:str, n_shards:int) -> int:
+    """Shard index of a j{J}_r{R}_E{E}_m{M} combination; crc32 is stable across processes and machines."""
+    return zlib.crc32(combination.encode()) % n_shards
+
+def combination_of(name:str, times_more:int) -> Optional[str]:
+    """The combination a dataset belongs to: itself, or for PR{idx}_m{M}_j{J * times_more}_r{R}_E{E}, j{J}_r{R}_E{E}_m{M}."""
+    if re.match(r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$', name):
+        return name
+    match = re.match(r'^PR\d+_m(\d+)_j(\d+)_r([\d.]+)_E(.*)$', name)
+    if match:
+        M, J, R, E = match.groups()
+        return f"j{int(J) // times_more}_r{R}_E{E}_m{M}"
+    return None
+
+def build_archive(data_dir:str, archive_dir:str, n_shards:int, times_more:int) -> Dict[int, int]:
+    """Pack every dataset under data_dir/<framework>/ into n_shards zip files. Returns shard -> member count."""
+    members = {shard: [] for shard in range(n_shards)}
+    extensions = tuple(DATA_FORMATS.values())
+    for path in sorted(glob.glob(os.path.join(data_dir, '*', '*'))):
+        name, ext = os.path.splitext(os.path.basename(path))
+        if ext not in extensions:
+            continue
+        combination = combination_of(name, times_more)
+        if combination is None:
+            raise ValueError(f"{path} is not a dataset of any combination")
+        data_framework = os.path.basename(os.path.dirname(path))
+        members[shard_of(combination, n_shards)].append((path, f"{data_framework}/{name}{ext}"))
+
+    os.makedirs(archive_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(archive_dir, 'shard_*_of_*.zip')):
+        os.remove(old)
+    for shard, shard_members in members.items():
+        shard_path = os.path.join(archive_dir, shard_name(shard, n_shards))
+        tmp_path = f"{shard_path}.tmp"
+        with zipfile.ZipFile(tmp_path, 'w') as zf:
+            for path, arcname in shard_members:
+                compression = zipfile.ZIP_STORED if arcname.endswith('.parquet') else zipfile.ZIP_DEFLATED
+                zf.write(path, arcname, compress_type=compression)
+        os.replace(tmp_path, shard_path)
+    return {shard: len(shard_members) for shard, shard_members in members.items()}
+
+def find_shard(archive_dir:str, combination:str) -> str:
+    """Path of the shard holding combination; only that shard needs to be in archive_dir."""
+    for path in glob.glob(os.path.join(archive_dir, 'shard_*_of_*.zip')):
+        n_shards = int(SHARD_PATTERN.match(os.path.basename(path)).group(2))
+        shard_path = os.path.join(archive_dir, shard_name(shard_of(combination, n_shards), n_shards))
+        if os.path.isfile(shard_path):
+            return shard_path
+        raise FileNotFoundError(f"{shard_path} (the shard of {combination}) does not exist.")
+    raise FileNotFoundError(f"No shard_*_of_*.zip in {archive_dir}.")
+
+class DataArchive:
+    """One shard, opened for random access to its datasets."""
+    def __init__(self, path:str):
+        self.path = path
+        self.zf = zipfile.ZipFile(path, 'r')
+        # <framework>/<name> -> member
+        self.index = {os.path.splitext(x)[0]: x for x in self.zf.namelist()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+
+    def __contains__(self, key:str) -> bool:
+        return key in self.index
+
+    def names(self, data_framework:str) -> List[str]:
+        prefix = f"{data_framework}/"
+        return sorted(x[len(prefix):] for x in self.index if x.startswith(prefix))
+
+    def read(self, data_framework:str, name:str) -> pd.DataFrame:
+        """Dataset `name` of data_framework, as `read_dataset` would load it from data/."""
+        key = f"{data_framework}/{name}"
+        if key not in self.index:
+            raise FileNotFoundError(f"Data file {key} is not in {self.path}.")
+        member = self.index[key]
+        return read_dataset(member, content=self.zf.read(member))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and inspect the sharded data archive.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help="pack data/ into shards")
+    build.add_argument('data_dir', nargs='?', default='data')
+    build.add_argument('archive_dir', nargs='?', default='data_shards')
+    build.add_argument('--shards', type=int, default=None, help="default: DATA_ARCHIVE_SHARDS in config.yaml")
+    shard = subparsers.add_parser('shard', help="print the shard file of a combination")
+    shard.add_argument('combination')
+    shard.add_argument('--shards', type=int, default=None, help="default: DATA_ARCHIVE_SHARDS in config.yaml")
+    listing = subparsers.add_parser('list', help="print the members of a shard")
+    listing.add_argument('shard_path')
+    args = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    n_shards = getattr(args, 'shards', None) or config.get('DATA_ARCHIVE_SHARDS', 64)
+
+    if args.command == 'build':
+        counts = build_archive(args.data_dir, args.archive_dir, n_shards, config['TIMES_MORE'])
+        size = sum(os.path.getsize(x) for x in glob.glob(os.path.join(args.archive_dir, 'shard_*_of_*.zip')))
+        print(f"{args.data_dir} -> {args.archive_dir}: {sum(counts.values())} datasets in {n_shards} shards "
+              f"({min(counts.values())}-{max(counts.values())} per shard, {size / 1e6:.1f} MB)")
+    elif args.command == 'shard':
+        print(shard_name(shard_of(args.combination, n_shards), n_shards))
+    else:
+        with zipfile.ZipFile(args.shard_path, 'r') as zf:
+            for info in zf.infolist():
+                print(f"{info.filename}\t{info.file_size}\t{info.compress_size}")
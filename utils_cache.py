@@ -0,0 +1,126 @@
+"""Content-addressed on-disk cache of partial-ranking fits.
+
+A partial-ranking fit in run_mlhc.py depends only on its dataset and on
+(n_iter, n_shuffle, burn_in, thinning, seed), plus the convergence criteria with
+ADAPTIVE_MCMC. The cache key is a SHA-256 of the
+dataset's content plus those values, so a rerun with the same data and
+hyperparameters reads `order_with_highest_ll` back instead of rerunning MCMC,
+no matter what changed downstream (e.g. TESTED_MP_METHODS).
+
+Each entry is one small JSON file `<cache_dir>/<key[:2]>/<key>.json`, written
+atomically, so concurrent workers can share a cache. When the cache grows past
+`max_bytes` (checked every EVICT_EVERY writes or so), the least recently used
+entries are removed.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from typing import Dict, Optional, Tuple
+from utils_ebm import run_mpebm
+
+# Bump when a change in the fit code makes old entries invalid
+CACHE_VERSION = 1
+HASHED_FIT_ARGS = ('n_iter', 'n_shuffle', 'burn_in', 'thinning', 'seed')
+# Scanning the cache costs a stat per entry, so only about one put in EVICT_EVERY checks the size
+EVICT_EVERY = 64
+
+def data_digest(data_file:Optional[str]=None, data:Optional[pd.DataFrame]=None) -> str:
+    """SHA-256 of a dataset: the bytes of data_file, or the content of an in-memory DataFrame."""
+    h = hashlib.sha256()
+    if data is not None:
+        h.update(b'df')
+        h.update(','.join(data.columns).encode())
+        h.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+    else:
+        h.update(b'csv')
+        with open(data_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+class FitCache:
+    def __init__(self, cache_dir:str, max_bytes:int=256 << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, digest:str, **fit_args) -> str:
+        hyper = {name: int(fit_args[name]) for name in HASHED_FIT_ARGS}
+        # an early-stopped chain gives another result; fixed-budget keys stay as they were
+        if fit_args.get('convergence'):
+            hyper['convergence'] = fit_args['convergence']
+        payload = json.dumps({'version': CACHE_VERSION, 'data': digest, **hyper}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key:str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # mark as recently used for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, key:str, entry:Dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        # keys are uniformly distributed, so this is a deterministic 1-in-EVICT_EVERY sample
+        if int(key[:8], 16) % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def run_mpebm_cached(cache_dir:Optional[str]=None, cache_max_mb:float=256, **fit_args) -> Tuple[np.ndarray, Dict[str, int]]:
+    """`run_mpebm(**fit_args)` of a partial-ranking fit (save_results=False), through the cache at cache_dir.
+
+    Without cache_dir this is plain run_mpebm.
+
+    Returns (best_order, order_with_highest_ll) like run_mpebm.
+    """
+    if not cache_dir:
+        return run_mpebm(**fit_args)
+    cache = FitCache(cache_dir, max_bytes=int(cache_max_mb * (1 << 20)))
+    key = cache.key(data_digest(fit_args.get('data_file'), fit_args.get('data')), **fit_args)
+    entry = cache.get(key)
+    if entry is None:
+        _, order_with_highest_ll = run_mpebm(**fit_args)
+        entry = {'order_with_highest_ll': order_with_highest_ll}
+        cache.put(key, entry)
+    order_with_highest_ll = entry['order_with_highest_ll']
+    # keys are the biomarkers sorted by name, the order of best_order
+    return np.array(list(order_with_highest_ll.values())), order_with_highest_ll
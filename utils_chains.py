@@ -0,0 +1,93 @@
+"""Independent MCMC chains of one model, run side by side and pooled.
+
+run_adni.py fits every algorithm with several seeds at once, each (seed, algorithm) an
+independent `utils_ebm.run_ebm` chain on a process pool. Per algorithm, `summarize_chains`
+then picks the chain with the highest max log likelihood, pools the post-burn-in orderings of
+all chains, and measures how much the chains agree:
+
+- kendall: normalized Kendall's tau distance, (1 - tau) / 2, between the best orderings of
+  every pair of chains (0: same ordering);
+- same_as_best: the share of chains whose best ordering is the overall best one;
+- split_rhat: split R-hat of the log-likelihood traces (utils_convergence.py), across chains.
+"""
+import os
+import shutil
+import itertools
+import numpy as np
+from typing import Dict, List, Optional
+from scipy.stats import kendalltau
+from utils_ebm import run_ebm
+from utils_convergence import split_rhat
+
+def chain_folder(algorithm:str, seed:int) -> str:
+    """Output folder of one chain, under run_ebm's output_dir."""
+    return os.path.join(algorithm, f"seed_{seed}")
+
+def run_chain(algorithm:str, seed:int, burn_in:int, thinning:int=1, **run_ebm_kwargs) -> Dict:
+    """One `run_ebm` chain, saved to chain_folder(algorithm, seed). Returns its results and its
+    post-burn-in traces (orders thinned); needs save_details for the biomarker names.
+    """
+    traces = {}
+    results = run_ebm(
+        algorithm=algorithm, seed=seed, burn_in=burn_in, thinning=thinning,
+        output_folder=chain_folder(algorithm, seed), traces=traces, **run_ebm_kwargs)
+    return dict(
+        algorithm=algorithm,
+        seed=seed,
+        results=results,
+        orders=traces['accepted_orders'][burn_in::thinning],
+        log_likelihoods=traces['log_likelihoods'][burn_in:],
+    )
+
+def kendall_distance(order1:np.ndarray, order2:np.ndarray) -> float:
+    tau, _ = kendalltau(order1, order2)
+    return float((1 - tau) / 2)
+
+def summarize_chains(chains:List[Dict]) -> Dict:
+    """Best chain, cross-chain agreement and pooled position probabilities of chains of one algorithm."""
+    biomarker_names = list(chains[0]['results']['order_with_highest_ll'])
+    best_orders = [np.array(list(x['results']['order_with_highest_ll'].values())) for x in chains]
+    max_lls = [x['results']['max_log_likelihood'] for x in chains]
+    best = int(np.argmax(max_lls))
+
+    distances = [kendall_distance(a, b) for a, b in itertools.combinations(best_orders, 2)]
+    # chains stopped early are shorter: compare the common length
+    n = min(len(x['log_likelihoods']) for x in chains)
+    log_likelihoods = np.stack([x['log_likelihoods'][:n] for x in chains])
+
+    pooled = pooled_orders(chains)
+    n_biomarkers = len(biomarker_names)
+    # counts[b, k]: how often biomarker b was at position k + 1
+    counts = np.stack([np.bincount(pooled[:, b] - 1, minlength=n_biomarkers) for b in range(n_biomarkers)])
+    probabilities = counts / len(pooled)
+
+    return {
+        'best_seed': chains[best]['seed'],
+        'max_log_likelihood': max_lls[best],
+        'order_with_highest_ll': chains[best]['results']['order_with_highest_ll'],
+        'chains': [
+            {'seed': x['seed'], 'max_log_likelihood': ll, 'runtime': x['results']['runtime'],
+             'stop_reason': x['results'].get('stop_reason'), 'n_iter_run': x['results'].get('n_iter_run'),
+             'kendall_to_best': kendall_distance(order, best_orders[best])}
+            for x, ll, order in zip(chains, max_lls, best_orders)
+        ],
+        'agreement': {
+            'kendall_mean': float(np.mean(distances)) if distances else 0.0,
+            'kendall_max': float(np.max(distances)) if distances else 0.0,
+            'same_as_best': float(np.mean([np.array_equal(x, best_orders[best]) for x in best_orders])),
+            'split_rhat': split_rhat(log_likelihoods) if len(chains) > 1 and n >= 4 else None,
+        },
+        'n_pooled_samples': int(len(pooled)),
+        'pooled_position_probabilities': {
+            bm: probabilities[b].tolist() for b, bm in enumerate(biomarker_names)},
+    }
+
+def pooled_orders(chains:List[Dict]) -> np.ndarray:
+    return np.concatenate([x['orders'] for x in chains])
+
+def publish_best(output_dir:str, algorithm:str, seed:int, subfolders:Optional[List[str]]=None):
+    """Copy the best chain's outputs up to output_dir/algorithm/, where a single-seed run puts them."""
+    source = os.path.join(output_dir, chain_folder(algorithm, seed))
+    for subfolder in subfolders or ['results', 'heatmaps', 'traceplots', 'records']:
+        if os.path.isdir(os.path.join(source, subfolder)):
+            shutil.copytree(os.path.join(source, subfolder), os.path.join(output_dir, algorithm, subfolder), dirs_exist_ok=True)
@@ -0,0 +1,61 @@
+"""Small checkpoint files for resuming preempted run_mlhc.py jobs.
+
+Two kinds of files live under `<OUTPUT_DIR>/checkpoints/<filename>/`:
+
+- one `.npz` per `run_mpebm` fit with the Metropolis-Hastings state (see utils_mh.py),
+  written every CHECKPOINT_SECONDS and once more when the chain finishes;
+- `progress.json`, the run_mlhc.py stages that have finished for each data framework.
+
+Every write goes to a temporary file first and is then renamed, so a job killed
+mid-write leaves the previous checkpoint intact.
+"""
+import os
+import json
+import numpy as np
+from typing import Dict, Optional
+
+def save_checkpoint(path:str, key:str, arrays:Dict[str, np.ndarray], scalars:Dict):
+    """Write arrays plus JSON-serializable scalars to path (.npz), tagged with key."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    meta = json.dumps({'key': key, **scalars})
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, _meta=np.array(meta), **arrays)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path:Optional[str], key:str) -> Optional[Dict]:
+    """The checkpoint at path as {scalars..., arrays...}, or None if missing, unreadable or for another key."""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as npz:
+            state = json.loads(str(npz['_meta']))
+            if state.pop('key') != key:
+                return None
+            for name in npz.files:
+                if name != '_meta':
+                    state[name] = npz[name]
+    except (OSError, ValueError, KeyError):
+        return None
+    return state
+
+class JobProgress:
+    """Finished stages of a run_mlhc.py job, with whatever they produced, persisted as JSON."""
+    def __init__(self, path:str):
+        self.path = path
+        self.state = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+
+    def get(self, name:str):
+        """Output of a finished stage, or None if it has not finished."""
+        return self.state.get(name)
+
+    def done(self, name:str, output=True):
+        self.state[name] = output
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,79 @@
+"""Online convergence checks for the Metropolis-Hastings chains (adaptive iteration budget).
+
+With `ADAPTIVE_MCMC: true`, a chain in utils_mh.py is checked every `check_every` iterations
+once it has run `min_iter`, and stops at the first check where all of these hold for the
+log-likelihood trace. As in BDA3, the first half of the chain so far (at least the burn-in) is
+treated as warm-up, so the initial climb does not count against convergence:
+
+- plateau: the best log likelihood has not improved for `plateau` iterations;
+- split R-hat (Gelman et al., BDA3 11.4, the two halves of the trace as two chains) is at
+  most `max_rhat`;
+- the effective sample size (Geyer's initial positive sequence) is at least `min_ess`.
+
+Otherwise the chain runs the configured number of iterations, which is the cap. A trace
+that did not move at all after burn-in has R-hat 1 and an ESS of its length: there is
+nothing left for these diagnostics to detect, and the plateau rule decides.
+"""
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+DEFAULT_CRITERIA = dict(min_iter=2000, check_every=500, plateau=2000, max_rhat=1.05, min_ess=100)
+
+def get_criteria(config:Dict) -> Optional[Dict]:
+    """Stopping criteria from config.yaml, or None (fixed budget) unless ADAPTIVE_MCMC is set."""
+    if not config.get('ADAPTIVE_MCMC'):
+        return None
+    return {**DEFAULT_CRITERIA, **(config.get('CONVERGENCE') or {})}
+
+def split_rhat(x:np.ndarray) -> float:
+    """Split-chain potential scale reduction factor of one trace, or of m traces of equal length (m, n)."""
+    x = np.atleast_2d(x)
+    half = x.shape[1] // 2
+    chains = np.concatenate([x[:, :half], x[:, x.shape[1] - half:]])
+    within = chains.var(axis=1, ddof=1).mean()
+    between = half * chains.mean(axis=1).var(ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+    var_hat = (half - 1) / half * within + between / half
+    return float(np.sqrt(var_hat / within))
+
+def effective_sample_size(x:np.ndarray) -> float:
+    """ESS of one trace, from its FFT autocorrelation truncated at Geyer's initial positive sequence."""
+    n = len(x)
+    centered = x - x.mean()
+    variance = centered @ centered / n
+    if variance == 0:
+        return float(n)
+    spectrum = np.fft.rfft(centered, n=2 * n)
+    acf = np.fft.irfft(spectrum * np.conjugate(spectrum))[:n] / (n * variance)
+    # sums of consecutive autocorrelation pairs, up to the first non-positive one
+    pairs = acf[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    negative = np.where(pairs <= 0)[0]
+    pairs = pairs[:negative[0]] if len(negative) else pairs
+    tau = -1.0 + 2.0 * pairs.sum()
+    return float(n / max(tau, 1.0 / n))
+
+def check_convergence(log_likelihoods:np.ndarray, best_iteration:int, burn_in:int, criteria:Dict) -> Tuple[bool, Dict]:
+    """(all criteria hold, diagnostics) for the trace log_likelihoods[:n] of a chain at iteration n."""
+    n = len(log_likelihoods)
+    trace = log_likelihoods[max(burn_in, n // 2):]
+    trace = trace[np.isfinite(trace)]
+    diagnostics = dict(ll_plateau=n - 1 - best_iteration, split_rhat=None, ess=None)
+    if len(trace) < 4:
+        return False, diagnostics
+    diagnostics['split_rhat'] = split_rhat(trace)
+    diagnostics['ess'] = effective_sample_size(trace)
+    converged = (
+        diagnostics['ll_plateau'] >= criteria['plateau']
+        and diagnostics['split_rhat'] <= criteria['max_rhat']
+        and diagnostics['ess'] >= criteria['min_ess']
+    )
+    return converged, diagnostics
+
+def should_check(iterations_done:int, criteria:Optional[Dict]) -> bool:
+    """Whether to check the chain after iterations_done iterations."""
+    return (
+        criteria is not None
+        and iterations_done >= criteria['min_iter']
+        and iterations_done % criteria['check_every'] == 0
+    )
@@ -0,0 +1,256 @@
+"""In-memory synthetic datasets: rebuild any combination's data without the CSVs.
+
+`run_gen.py` writes every dataset to `data/<framework>/` and `run_mlhc.py` parses them back.
+`generate_combination` returns the same datasets as DataFrames straight from the seeds
+`run_gen.py` used, so a single process can go from generation to `run_mpebm(data=...)`.
+"""
+import re
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+from collections import defaultdict
+from pyjpm import mp_utils
+from pyjpm.generate_data import generate_data, dirichlet_near_normal
+from utils_store import open_true_order_and_stages, TrueOrderStore
+
+# pyjpm.generate() defaults, copied so that the stage prior can be threaded explicitly (see below)
+DIRICHLET_MULTINOMIAL = [0.35, 0.85, 1.55, 2.45, 3.45, 4.25, 4.25, 3.45, 2.45, 1.55, 0.85, 0.35]
+BETA_PARAMS = {
+    'near_normal': {'alpha': 2.0, 'beta': 2.0},
+    'uniform': {'alpha': 1, 'beta': 1},
+    'regular': {'alpha': 5, 'beta': 2}
+}
+
+def get_dirichlet_alpha(pristine:bool) -> Dict[str, List[float]]:
+    """A fresh stage prior dict to pass to `generate()` / `generate_datasets()`.
+
+    `generate()` overwrites its mutable default `dirichlet_alpha['multinomial']` with
+    `dirichlet_near_normal(n)` whenever a dataset has n != 12 biomarkers, and the change sticks
+    for the rest of the process. So only the datasets before the first n != 12 one in a fresh
+    process (pristine=True) use the hand-written 12-stage prior; every later dataset uses
+    `dirichlet_near_normal(n)`, which is what an empty list (pristine=False) reproduces.
+    Passing the dict explicitly makes the data independent of what else ran in the process.
+    """
+    return {'uniform': [100], 'multinomial': list(DIRICHLET_MULTINOMIAL) if pristine else []}
+
+def draw_experiment_seeds(rng:np.random.Generator, experiment_names:List[str]) -> Dict[str, int]:
+    """One `generate()` seed per experiment, in the order run_gen.py draws them."""
+    return {exp_name: rng.integers(0, 2**32 - 1) for exp_name in experiment_names}
+
+def draw_partial_seeds(rng:np.random.Generator, n_partials:Iterable[Tuple[str, int]]) -> Dict[str, List[int]]:
+    """One seed per partial ordering of every (fname, n_partial_rankings), in store order."""
+    return {fname: [rng.integers(0, 2**32 - 1) for _ in range(n)] for fname, n in n_partials}
+
+def get_data_frameworks(mp_method:str) -> List[Tuple[str, float]]:
+    """(data_framework, mallows_temperature) pairs that `run_gen.py <mp_method>` produces, in order."""
+    if 'Mallows' not in mp_method:
+        return [(mp_method, 1.0)]
+    return [(f"{mp_method}_T{mallows_temperature}", mallows_temperature) for mallows_temperature in [1.0, 10.0]]
+
+def split_data_framework(data_framework:str) -> Tuple[str, float]:
+    """'Mallows_Tau_T10.0' -> ('Mallows_Tau', 10.0); 'BT' -> ('BT', 1.0)."""
+    if 'Mallows' in data_framework:
+        mp_method, temperature = data_framework.rsplit('_T', 1)
+        return mp_method, float(temperature)
+    return data_framework, 1.0
+
+def list_n_partials(base_dir:str, data_framework:str) -> List[Tuple[str, int]]:
+    records = open_true_order_and_stages(base_dir, data_framework)
+    if isinstance(records, TrueOrderStore):
+        with records:
+            return records.n_partial_rankings()
+    return [(fname, fname_data['n_partial_rankings']) for fname, fname_data in records.items()]
+
+def get_gen_seeds(config:Dict, data_framework:str, base_dir:str) -> Tuple[Dict[str, int], Dict[str, List[int]]]:
+    """Replay run_gen.py's seed draws up to `data_framework`.
+
+    Returns (experiment seeds, partial-ranking seeds) for that framework. Frameworks that
+    run_gen.py generates earlier in the same job (Mallows_Tau_T1.0 before _T10.0) are replayed
+    from their stores, since their draws depend on how many partial rankings each key has.
+    """
+    mp_method, _ = split_data_framework(data_framework)
+    rng = np.random.default_rng(config['GEN_SEED'])
+    for framework, _ in get_data_frameworks(mp_method):
+        experiment_seeds = draw_experiment_seeds(rng, config['EXPERIMENT_NAMES'])
+        partial_seeds = draw_partial_seeds(rng, list_n_partials(base_dir, framework))
+        if framework == data_framework:
+            return experiment_seeds, partial_seeds
+    raise ValueError(f"{data_framework} is not produced by run_gen.py {mp_method}")
+
+def generate_datasets(
+    mixed_pathology:bool,
+    experiment_name:str,
+    params:Dict,
+    js:List[int],
+    rs:List[float],
+    num_of_datasets_per_combination:int,
+    seed:int,
+    dirichlet_alpha:Dict[str, List[float]],
+    only:Optional[Set[str]]=None,
+    prefix:Optional[str]=None,
+    fixed_biomarker_order:bool=True,
+    mp_method:Optional[str]="BT",
+    mcmc_iterations:Optional[int]=100,
+    pl_best:bool=False,
+    mallows_temperature:float=1.0,
+    low_num:int=2,
+    high_num:int=4,
+    low_length:int=5,
+    high_length:int=10,
+    noise_std_parameter:float=0.05,
+) -> Tuple[Dict[str, Dict], Dict[str, pd.DataFrame]]:
+    """`pyjpm.generate()` without the CSV writes.
+
+    Follows generate() step for step, so the random streams and the ground truth are the
+    same. The datasets are returned as DataFrames instead of being written, and only for
+    filenames in `only` (all if None); the others are still stepped through because they
+    advance the shared random state.
+
+    Returns:
+        (true_order_and_stages dict as generate() returns it, {filename: long-format DataFrame})
+    """
+    biomarkers_str = np.array(sorted(params.keys()))
+    biomarkers_int = np.arange(0, len(params))
+    int2str = dict(zip(biomarkers_int, biomarkers_str))
+    rng = np.random.default_rng(seed)
+    true_order_and_stages_dict = defaultdict(dict)
+    datasets = {}
+
+    for participant_count in js:
+        for healthy_ratio in rs:
+            for variant in range(num_of_datasets_per_combination):
+                sub_seed = rng.integers(0, 1_000_000)
+                sub_rng = np.random.default_rng(sub_seed)
+                if num_of_datasets_per_combination >= 2:
+                    filename = f"j{participant_count}_r{healthy_ratio}_E{experiment_name}_m{variant}"
+                else:
+                    filename = f"j{participant_count}_r{healthy_ratio}_E{experiment_name}"
+                if prefix:
+                    filename = f"{prefix}_{filename}"
+
+                padded_ordering_array = None
+                params_to_use = params
+                if mixed_pathology:
+                    padded_ordering_array = mp_utils.get_padded_partial_orders(
+                        biomarkers_int=biomarkers_int, low_num=low_num,
+                        low_length=low_length, high_length=high_length,
+                        high_num=high_num, rng=sub_rng)
+                    true_order_and_stages_dict[filename]['mp_method'] = mp_method
+                    true_order_and_stages_dict[filename]['n_partial_rankings'] = len(padded_ordering_array)
+                    true_order_and_stages_dict[filename]['ordering_array'] = padded_ordering_array
+                    if fixed_biomarker_order:
+                        if mp_method == 'Random':
+                            combined_ordering = np.array(
+                                sorted(set(item for ordering in padded_ordering_array for item in ordering if item != -1)),
+                                dtype=np.int64
+                            )
+                            rng.shuffle(combined_ordering)
+                        else:
+                            combined_ordering = mp_utils.get_combined_order(
+                                padded_partial_orders=padded_ordering_array,
+                                rng=sub_rng,
+                                method=mp_method,
+                                mcmc_iterations=mcmc_iterations,
+                                pl_best=pl_best,
+                                mallows_temperature=mallows_temperature
+                            )
+                        params_to_use = mp_utils.get_final_params(params, combined_ordering, padded_ordering_array, int2str, rng)
+
+                if len(params_to_use) != len(dirichlet_alpha['multinomial']):
+                    dirichlet_alpha['multinomial'] = dirichlet_near_normal(n_biomarkers=len(params_to_use))
+                if only is not None and filename not in only:
+                    continue
+
+                datasets[filename] = generate_data(
+                    filename=filename,
+                    mixed_pathology=mixed_pathology,
+                    padded_ordering_array=padded_ordering_array,
+                    mp_method=mp_method,
+                    mcmc_iterations=mcmc_iterations,
+                    pl_best=pl_best,
+                    mallows_temperature=mallows_temperature,
+                    int2str=int2str,
+                    experiment_name=experiment_name,
+                    params=params_to_use,
+                    n_participants=participant_count,
+                    healthy_ratio=healthy_ratio,
+                    output_dir='',
+                    m=variant,
+                    dirichlet_alpha=dirichlet_alpha,
+                    beta_params=BETA_PARAMS,
+                    prefix=prefix,
+                    suffix=None,
+                    keep_all_cols=False,
+                    fixed_biomarker_order=fixed_biomarker_order,
+                    noise_std_parameter=noise_std_parameter,
+                    true_order_and_stages_dict=true_order_and_stages_dict,
+                    rng=sub_rng,
+                    save2file=False,
+                )
+    return true_order_and_stages_dict, datasets
+
+def generate_combination(
+        config:Dict,
+        params:Dict,
+        data_framework:str,
+        filename:str,
+        base_dir:str,
+    ) -> Tuple[pd.DataFrame, List[pd.DataFrame]]:
+    """Rebuild `data/<data_framework>/<filename>.csv` and its `PR{idx}_...` siblings in memory.
+
+    Returns (mixed-pathology DataFrame, [partial-ranking DataFrame for idx in 0..n-1]).
+    The ground truth store of `data_framework` must exist; it provides the seeds' order.
+    """
+    mp_method, mallows_temperature = split_data_framework(data_framework)
+    experiment_seeds, partial_seeds = get_gen_seeds(config, data_framework, base_dir)
+    J, R, E, M = _extract_components(filename)
+
+    # generate() settings of run_gen.py for this framework
+    if 'Mallows' in mp_method:
+        framework_kwargs = dict(fixed_biomarker_order=True, mallows_temperature=mallows_temperature)
+    else:
+        framework_kwargs = dict(fixed_biomarker_order=False, pl_best=False)
+    # run_gen.py runs the experiments in config order in one process; only the first one
+    # starts from generate()'s pristine stage prior
+    pristine = config['EXPERIMENT_NAMES'].index(E) == 0 and data_framework == get_data_frameworks(mp_method)[0][0]
+    records, datasets = generate_datasets(
+        mixed_pathology=True,
+        experiment_name=E,
+        params=params,
+        js=config['JS'],
+        rs=config['RS'],
+        num_of_datasets_per_combination=config['N_VARIANTS'],
+        seed=experiment_seeds[E],
+        dirichlet_alpha=get_dirichlet_alpha(pristine=pristine),
+        only={filename},
+        mp_method=mp_method,
+        mcmc_iterations=config['MP_MCMC'],
+        low_num=config['LOW_NUM'],
+        high_num=config['HIGH_NUM'],
+        low_length=config['LOW_LENGTH'],
+        high_length=config['HIGH_LENGTH'],
+        **framework_kwargs
+    )
+    int2str = dict(enumerate(sorted(params.keys())))
+    partial_datasets = []
+    for idx, partial_ordering in enumerate(records[filename]['ordering_array']):
+        partial_params = {int2str[bm]: params[int2str[bm]] for bm in partial_ordering if bm in int2str}
+        _, partial = generate_datasets(
+            mixed_pathology=False,
+            experiment_name=E,
+            params=partial_params,
+            js=[int(J) * config['TIMES_MORE']],
+            rs=[float(R)],
+            num_of_datasets_per_combination=1,
+            seed=partial_seeds[filename][idx],
+            dirichlet_alpha=get_dirichlet_alpha(pristine=False),
+            prefix=f"PR{idx}_m{M}",
+        )
+        partial_datasets.extend(partial.values())
+    return datasets[filename], partial_datasets
+
+def _extract_components(filename:str):
+    match = re.match(r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$', filename)
+    if match is None:
+        raise ValueError(f"Invalid combination name {filename}")
+    return match.groups()
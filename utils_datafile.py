@@ -0,0 +1,96 @@
+"""On-disk formats of the synthetic datasets in `data/<framework>/`.
+
+`generate()` writes long-format CSVs (participant, biomarker, measurement, diseased) and
+every `run_mpebm` call parses one back. With `DATA_FORMAT: 'parquet'` in config.yaml,
+run_gen.py converts them to zstd-compressed Parquet: biomarker is dictionary-encoded,
+measurement is float32 and participant int32. The files are several times smaller than
+the CSVs and `read_dataset` loads them memory-mapped, without any text parsing.
+
+float32 keeps about 7 significant digits of the measurements; fits on Parquet data agree
+with fits on the CSVs only to that precision.
+
+    python3 utils_datafile.py data/BT data/PL     # convert existing CSVs in place
+"""
+import sys
+import os
+import io
+import glob
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+
+DATA_FORMATS = {'csv': '.csv', 'parquet': '.parquet'}
+PARQUET_SCHEMA = pa.schema([
+    ('participant', pa.int32()),
+    ('biomarker', pa.dictionary(pa.int8(), pa.string())),
+    ('measurement', pa.float32()),
+    ('diseased', pa.bool_()),
+])
+# what pd.read_csv gives for the same file
+PANDAS_SCHEMA = pa.schema([
+    ('participant', pa.int64()),
+    ('biomarker', pa.string()),
+    ('measurement', pa.float64()),
+    ('diseased', pa.bool_()),
+])
+PARQUET_COMPRESSION = 'zstd'
+
+def data_path(data_dir:str, name:str, data_format:str='csv') -> str:
+    """Path of dataset `name` (e.g. j50_r0.1_E..._m0 or PR0_m0_j200_...) in data_dir."""
+    return os.path.join(data_dir, f"{name}{DATA_FORMATS[data_format]}")
+
+def write_dataset(data:pd.DataFrame, path:str):
+    """Write a long-format dataset; the format follows the extension of path."""
+    if path.endswith('.csv'):
+        data.to_csv(path, index=False)
+        return
+    table = pa.Table.from_pandas(
+        data[PARQUET_SCHEMA.names].astype({'biomarker': str}), schema=PARQUET_SCHEMA, preserve_index=False)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, compression=PARQUET_COMPRESSION)
+    os.replace(tmp_path, path)
+
+def read_dataset(path:str, content:Optional[bytes]=None) -> pd.DataFrame:
+    """A long-format dataset with the dtypes `pd.read_csv` gives, whatever its format.
+
+    content: the file's bytes, e.g. of an archive member (utils_archive.py); path then only
+        gives the format.
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path if content is None else io.BytesIO(content))
+    if content is None:
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+    else:
+        parquet_file = pq.ParquetFile(pa.BufferReader(content))
+    # cast in Arrow: decoding the dictionary there is much cheaper than from a pandas Categorical
+    return parquet_file.read().cast(PANDAS_SCHEMA).to_pandas()
+
+def convert_csv(csv_path:str, data_format:str) -> Optional[str]:
+    """Replace a CSV dataset by its data_format version. Returns the new path, None if nothing to do."""
+    path = csv_path[:-len('.csv')] + DATA_FORMATS[data_format]
+    if path == csv_path or not os.path.isfile(csv_path):
+        return None
+    write_dataset(pd.read_csv(csv_path), path)
+    os.remove(csv_path)
+    return path
+
+def convert_data_dir(data_dir:str, data_format:str, n_workers:int=1) -> int:
+    """Convert every CSV in data_dir to data_format. Returns the number of files converted."""
+    if data_format == 'csv':
+        return 0
+    csv_paths = sorted(glob.glob(os.path.join(data_dir, '*.csv')))
+    if n_workers > 1 and len(csv_paths) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            converted = list(executor.map(convert_csv, csv_paths, [data_format] * len(csv_paths), chunksize=64))
+    else:
+        converted = [convert_csv(x, data_format) for x in csv_paths]
+    return sum(x is not None for x in converted)
+
+if __name__ == "__main__":
+    for data_dir in sys.argv[1:]:
+        before = sum(os.path.getsize(x) for x in glob.glob(os.path.join(data_dir, '*.csv')))
+        n = convert_data_dir(data_dir, 'parquet', n_workers=os.cpu_count() or 1)
+        after = sum(os.path.getsize(x) for x in glob.glob(os.path.join(data_dir, '*.parquet')))
+        print(f"{data_dir}: {n} CSVs ({before / 1e6:.1f} MB) -> Parquet ({after / 1e6:.1f} MB)")
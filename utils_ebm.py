@@ -0,0 +1,272 @@
+"""Local drivers around `utils_mh`.
+
+`run_mpebm` follows `pyjpm.run_mpebm` step for step, but also takes the dataset as a
+DataFrame (`data=`), so callers that already hold the data in memory skip the CSV round trip,
+can checkpoint the chain (`checkpoint_file=`) to survive preemption, and can stop it early
+once it has converged (`convergence=`, see utils_convergence.py).
+
+`run_ebm` is `pysaebm.run_ebm` with the same early stopping.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Tuple
+from scipy.stats import kendalltau
+from sklearn.metrics import mean_absolute_error
+import pysaebm.utils as utils
+import pysaebm.run
+from pysaebm import run_ebm as pysaebm_run_ebm
+from utils_mh import metropolis_hastings, metropolis_hastings_ebm
+from utils_results import append_result
+from utils_datafile import read_dataset
+from pyjpm.utils import convert_np_types
+from pyjpm.viz import save_heatmap, save_traceplot
+
+def to_data_matrix(data:pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Long-format dataset -> (biomarker_names sorted, (n_participants, n_biomarkers) matrix, diseased_arr)."""
+    # sort biomarkers by name, ascending: this is the column order of data_matrix
+    biomarker_names = np.array(sorted(data.biomarker.unique()))
+    n_participants = len(data.participant.unique())
+    diseased_dict = dict(zip(data.participant, data.diseased))
+    dff = data.pivot(index='participant', columns='biomarker', values='measurement')
+    dff = dff.reindex(columns=biomarker_names, level=1)
+    dff.columns.name = None
+    dff.reset_index(inplace=True, drop=True)
+    data_matrix = dff.to_numpy()
+    diseased_arr = np.array([int(diseased_dict[x]) for x in range(n_participants)])
+    return biomarker_names, data_matrix, diseased_arr
+
+def get_checkpoint_key(data_matrix:np.ndarray, diseased_arr:np.ndarray, partial_rankings:np.ndarray, biomarkers_int:np.ndarray, **fit_args) -> str:
+    """SHA-256 of everything the chain depends on, so a checkpoint is only reused for the same fit."""
+    h = hashlib.sha256()
+    for arr in (data_matrix, diseased_arr, partial_rankings, biomarkers_int):
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype, arr.shape)).encode())
+        h.update(arr.tobytes())
+    h.update(json.dumps(fit_args, sort_keys=True).encode())
+    return h.hexdigest()
+
+def run_mpebm(
+    data_file:Optional[str]=None,
+    output_dir:Optional[str]=None,
+    partial_rankings:Optional[np.ndarray]=np.array([]),
+    bm2int:Optional[Dict[str, int]]=dict(),
+    mp_method:Optional[str]=None,
+    output_folder:Optional[str]=None,
+    n_iter:int=2000,
+    n_shuffle:int=2,
+    burn_in:int=500,
+    thinning:int=1,
+    true_order_dict:Optional[Dict[str, int]]=None,
+    true_stages:Optional[List[int]]=None,
+    fname_prefix:Optional[str]="",
+    prior_n:float=1.0,
+    prior_v:float=1.0,
+    seed:int=123,
+    save_results:bool=True,
+    save_plots:bool=False,
+    mallows_temperature:float=1.0,
+    data:Optional[pd.DataFrame]=None,
+    fname:Optional[str]=None,
+    checkpoint_file:Optional[str]=None,
+    checkpoint_seconds:float=300.0,
+    results_store:Optional[str]=None,
+    data_framework:Optional[str]=None,
+    convergence:Optional[Dict]=None,
+):
+    """
+    Same arguments and return values as `pyjpm.run_mpebm`, plus:
+
+    data_file (str): a .csv or .parquet dataset (utils_datafile.py).
+    data (pd.DataFrame): the dataset itself, in the long CSV layout (participant, biomarker,
+        measurement, diseased). Used instead of reading data_file.
+    fname (str): name of the results file when data is given; defaults to data_file's stem.
+    checkpoint_file (str): .npz file to checkpoint the chain to every checkpoint_seconds, and to
+        resume from if it holds a checkpoint of the same fit. The results do not depend on it.
+    results_store (str): also append the results to this Parquet store (utils_results.py),
+        in the data_framework/output_folder partition.
+    convergence (dict): stop the chain once these criteria hold (utils_convergence.get_criteria);
+        n_iter is then the cap. The results record stop_reason and n_iter_run either way.
+    """
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+
+    if data is None and data_file is None:
+        raise ValueError("Either data_file or data must be given.")
+    if fname is None:
+        if data_file is None:
+            raise ValueError("fname is required when only data is given.")
+        # drop the extension first: extract_fname only knows .csv
+        fname = utils.extract_fname(os.path.splitext(data_file)[0])
+
+    if save_results:
+        if output_folder:
+            output_dir = os.path.join(output_dir, output_folder)
+    utils.cleanup_old_files(output_dir, fname)
+
+    if save_results:
+        os.makedirs(output_dir, exist_ok=True)
+        results_folder = os.path.join(output_dir, "results")
+        os.makedirs(results_folder, exist_ok=True)
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s [%(levelname)s] %(message)s",
+            handlers=[logging.StreamHandler(sys.stdout)],
+            force=True
+        )
+    logging.info(f"Running {fname}")
+
+    if data is None:
+        data = read_dataset(data_file)
+    biomarker_names, data_matrix, diseased_arr = to_data_matrix(data)
+    # biomarkers_int are the IDs of the data_matrix columns; only needed with partial rankings
+    biomarkers_int = np.array([])
+    if len(partial_rankings) > 0:
+        biomarkers_int = np.array([bm2int[x] for x in biomarker_names])
+    logging.info(f"Number of biomarkers: {len(biomarker_names)}")
+
+    diagnostics = {}
+    all_orders, all_loglikes, best_order, best_log_likelihood, best_theta_phi = metropolis_hastings(
+        partial_rankings=partial_rankings, mp_method=mp_method,
+        data_matrix=data_matrix, diseased_arr=diseased_arr, biomarkers_int=biomarkers_int,
+        iterations=n_iter, n_shuffle=n_shuffle, prior_n=prior_n, prior_v=prior_v, rng=rng,
+        mallows_temperature=mallows_temperature, burn_in=burn_in,
+        checkpoint_file=checkpoint_file,
+        checkpoint_key=get_checkpoint_key(
+            data_matrix, diseased_arr, np.asarray(partial_rankings), biomarkers_int,
+            mp_method=mp_method, n_iter=n_iter, n_shuffle=n_shuffle, prior_n=prior_n, prior_v=prior_v,
+            seed=int(seed), mallows_temperature=mallows_temperature, burn_in=burn_in,
+            convergence=convergence,
+        ) if checkpoint_file else '',
+        checkpoint_seconds=checkpoint_seconds,
+        convergence=convergence,
+        diagnostics=diagnostics,
+    )
+
+    if save_plots:
+        heatmap_folder = os.path.join(output_dir, "heatmaps")
+        os.makedirs(heatmap_folder, exist_ok=True)
+        traceplot_folder = os.path.join(output_dir, "traceplots")
+        os.makedirs(traceplot_folder, exist_ok=True)
+        save_traceplot(
+            all_loglikes,
+            folder_name=traceplot_folder,
+            file_name=f"{fname_prefix}{fname}_traceplot",
+            title=f"Traceplot of Log Likelihoods"
+        )
+        save_heatmap(
+            all_orders,
+            burn_in,
+            thinning,
+            folder_name=heatmap_folder,
+            file_name=f"{fname_prefix}{fname}_heatmap",
+            title=f"Ordering Result",
+            biomarker_names=biomarker_names,
+            best_order=best_order
+        )
+
+    if not save_results:
+        return best_order, {k: int(v) for k, v in zip(biomarker_names, best_order)}
+
+    tau = None
+    mae = None
+    if true_order_dict:
+        # best_order follows the biomarkers sorted by name
+        true_order_dict = dict(sorted(true_order_dict.items()))
+        true_order_indices = np.array(list(true_order_dict.values()))
+        tau, _ = kendalltau(best_order, true_order_indices)
+        tau = (1 - tau) / 2
+
+    _, ml_stages, _ = utils.stage_with_plugin_pi_em(
+        data_matrix=data_matrix,
+        order_with_highest_ll=best_order,
+        final_theta_phi=best_theta_phi,
+        rng=rng,
+        max_iter=200,
+        tol=1e-6
+    )
+    if true_stages:
+        mae = mean_absolute_error(true_stages, ml_stages)
+
+    results = {
+        "runtime": time.time() - start_time,
+        "max_log_likelihood": best_log_likelihood,
+        "kendalls_tau": tau,
+        "mean_absolute_error": mae,
+        "order_with_highest_ll": {k: int(v) for k, v in zip(biomarker_names, best_order)},
+        "stop_reason": diagnostics['stop_reason'],
+        "n_iter_run": diagnostics['n_iter_run'],
+    }
+    results_file = os.path.join(results_folder, f"{fname_prefix}{fname}_results.json")
+    with open(results_file, "w") as f:
+        json.dump(convert_np_types(results), f, indent=4)
+    logging.info(f"Results saved to {results_file}")
+    if results_store:
+        append_result(results_store, data_framework, output_folder, f"{fname_prefix}{fname}", convert_np_types(results))
+    return best_order, results
+
+class PandasWithData:
+    """The pandas module, except that read_csv returns `data`."""
+    def __init__(self, data:pd.DataFrame):
+        self.data = data
+
+    def read_csv(self, *args, **kwargs) -> pd.DataFrame:
+        return self.data
+
+    def __getattr__(self, name:str):
+        return getattr(pd, name)
+
+def run_ebm(
+    convergence:Optional[Dict]=None,
+    traces:Optional[Dict]=None,
+    data:Optional[pd.DataFrame]=None,
+    fname:Optional[str]=None,
+    **kwargs,
+) -> Dict:
+    """`pysaebm.run_ebm(**kwargs)`, with its chain stopped early once the convergence criteria hold.
+
+    pysaebm.run_ebm runs whatever `metropolis_hastings` its module holds, so for the duration of
+    the call that is `utils_mh.metropolis_hastings_ebm`, which also reports why it stopped.
+    stop_reason and n_iter_run are added to the returned results and to the saved JSON.
+
+    traces (dict): filled in with the chain's accepted_orders and log_likelihoods, which
+        pysaebm.run_ebm does not return.
+    data (pd.DataFrame): the dataset in the long CSV layout, used instead of reading data_file;
+        pysaebm.run_ebm's `pd.read_csv` returns it for the duration of the call.
+    fname (str): names the outputs when data is given, as data_file's stem would.
+    """
+    if data is not None:
+        if fname is None:
+            raise ValueError("fname is required when data is given.")
+        kwargs['data_file'] = f"{fname}.csv"
+
+    diagnostics = {}
+    def sampler(**mh_kwargs):
+        out = metropolis_hastings_ebm(**mh_kwargs, convergence=convergence, diagnostics=diagnostics)
+        if traces is not None:
+            traces.update(accepted_orders=np.array(out[0]), log_likelihoods=np.array(out[1]))
+        return out
+
+    original, original_pd = pysaebm.run.metropolis_hastings, pysaebm.run.pd
+    pysaebm.run.metropolis_hastings = sampler
+    if data is not None:
+        pysaebm.run.pd = PandasWithData(data)
+    try:
+        results = pysaebm_run_ebm(**kwargs)
+    finally:
+        pysaebm.run.metropolis_hastings, pysaebm.run.pd = original, original_pd
+
+    results.update(stop_reason=diagnostics.get('stop_reason'), n_iter_run=diagnostics.get('n_iter_run'))
+    if kwargs.get('save_results', True):
+        # the same path pysaebm.run_ebm wrote to
+        output_dir = os.path.join(kwargs['output_dir'], kwargs.get('output_folder') or kwargs['algorithm'])
+        fname = utils.extract_fname(kwargs['data_file'])
+        results_file = os.path.join(output_dir, "results", f"{kwargs.get('fname_prefix') or ''}{fname}_results.json")
+        with open(results_file, "w") as f:
+            json.dump(convert_np_types(results), f, indent=4)
+    return results
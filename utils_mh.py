@@ -0,0 +1,352 @@
+"""Metropolis-Hastings for the MP-EBM, with checkpoint/restart.
+
+`metropolis_hastings` follows `pyjpm.mh.metropolis_hastings` draw for draw. With
+`checkpoint_file` set, it saves its full state (current and best ordering and theta/phi,
+stage prior, trace so far, sampler central ranking and the RNG state) every
+`checkpoint_seconds` and when the chain ends. A call with the same inputs and key picks up
+from that file, and the results are the same as those of an uninterrupted run.
+
+With `convergence` criteria (utils_convergence.py), the chain stops as soon as they hold, and
+`iterations` is only the cap. The returned traces then cover the iterations actually run.
+
+`metropolis_hastings_ebm` does the same for `pysaebm.run_ebm`'s sampler (run_adni.py), without
+checkpoints.
+"""
+import time
+import logging
+import numpy as np
+from typing import Dict, Tuple, Optional
+import pyjpm.utils as utils
+import pysaebm.utils as ebm_utils
+from utils_mp import PlackettLuce, MCMC
+from utils_checkpoint import save_checkpoint, load_checkpoint
+from utils_convergence import check_convergence, should_check
+
+def metropolis_hastings(
+        partial_rankings:np.ndarray,
+        mp_method:str,
+        data_matrix:np.ndarray,
+        diseased_arr:np.ndarray,
+        biomarkers_int:np.ndarray,
+        iterations:int,
+        n_shuffle:int,
+        prior_n:float,
+        prior_v:float,
+        mallows_temperature:float,
+        burn_in:int,
+        rng:np.random.Generator,
+        checkpoint_file:Optional[str]=None,
+        checkpoint_key:str='',
+        checkpoint_seconds:float=300.0,
+        convergence:Optional[Dict]=None,
+        diagnostics:Optional[Dict]=None,
+) -> Tuple:
+    """Same arguments and return values as `pyjpm.mh.metropolis_hastings`, plus:
+
+    checkpoint_file (str): where to save and look for the chain state (.npz); None disables checkpoints.
+    checkpoint_key (str): identifies the inputs; a checkpoint with another key is ignored.
+    checkpoint_seconds (float): wall time between two checkpoints.
+    convergence (dict): stopping criteria (utils_convergence.get_criteria); None runs all iterations.
+    diagnostics (dict): filled in with stop_reason ('converged' or 'max_iter'), n_iter_run and
+        the last convergence diagnostics.
+    """
+    sampler = None
+    if len(partial_rankings) > 0:
+        logging.info(f"Now using {mp_method}")
+        allowed_mp_method = {'PL', 'Mallows_Tau', 'Mallows_RMJ', 'Pairwise', 'BT'}
+        assert mp_method in allowed_mp_method, f'mp_method must be chosen from {allowed_mp_method}!'
+        if mp_method == 'PL':
+            sampler = PlackettLuce(ordering_array=partial_rankings, rng=rng)
+        else:
+            sampler = MCMC(
+                ordering_array=partial_rankings,
+                rng=rng, method=mp_method,
+                n_shuffle=n_shuffle,
+                mallows_temperature=mallows_temperature)
+
+    n_participants, n_biomarkers = data_matrix.shape
+    if n_shuffle <= 1:
+        raise ValueError("n_shuffle must be >= 2 or =0")
+    if n_shuffle > n_biomarkers:
+        raise ValueError("n_shuffle cannot exceed n_biomarkers")
+
+    n_stages = n_biomarkers + 1
+    disease_stages = np.arange(start=1, stop=n_stages, step=1)
+    n_disease_stages = n_stages - 1
+    non_diseased_ids = np.where(diseased_arr == 0)[0]
+    diseased_ids = np.where(diseased_arr == 1)[0]
+
+    # N * 4 matrix, cols: theta_mean, theta_std, phi_mean, phi_std
+    theta_phi_default = utils.get_initial_theta_phi_estimates(
+        data_matrix, non_diseased_ids, diseased_ids, prior_n, prior_v, rng=rng)
+    current_theta_phi = theta_phi_default.copy()
+    # current_order[i] is the stage position of biomarker i
+    current_order = rng.permutation(np.arange(1, n_stages))
+    current_ln_likelihood = -np.inf
+    alpha_prior = [1.0] * (n_disease_stages)
+    current_pi = rng.dirichlet(alpha_prior)
+    acceptance_count = 0
+
+    best_order = current_order.copy()
+    best_theta_phi = current_theta_phi.copy()
+    best_log_likelihood = current_ln_likelihood
+    best_iteration = 0
+    stop_reason = None
+    last_diagnostics = {}
+
+    all_accepted_orders = np.zeros((iterations, n_biomarkers), dtype=np.int64)
+    log_likelihoods = np.zeros(iterations, dtype=np.float64)
+
+    start_iteration = 0
+    state = load_checkpoint(checkpoint_file, checkpoint_key)
+    if state is not None:
+        start_iteration = state['iteration']
+        current_order = state['current_order'].astype(np.int64)
+        current_theta_phi = state['current_theta_phi']
+        current_ln_likelihood = state['current_ln_likelihood']
+        current_pi = state['current_pi']
+        acceptance_count = state['acceptance_count']
+        best_order = state['best_order'].astype(np.int64)
+        best_theta_phi = state['best_theta_phi']
+        best_log_likelihood = state['best_log_likelihood']
+        best_iteration = state.get('best_iteration', 0)
+        stop_reason = state.get('stop_reason')
+        last_diagnostics = state.get('diagnostics', {})
+        all_accepted_orders[:start_iteration] = state['all_accepted_orders']
+        log_likelihoods[:start_iteration] = state['log_likelihoods']
+        if 'central_ranking' in state:
+            sampler.central_ranking = state['central_ranking'].astype(np.int64)
+        rng.bit_generator.state = state['rng_state']
+        logging.info(f"Resuming from {checkpoint_file} at iteration {start_iteration}/{iterations}")
+
+    def checkpoint(next_iteration:int):
+        arrays = dict(
+            current_order=current_order,
+            current_theta_phi=current_theta_phi,
+            current_pi=current_pi,
+            best_order=best_order,
+            best_theta_phi=best_theta_phi,
+            # positions are at most n_biomarkers, int16 keeps the trace small
+            all_accepted_orders=all_accepted_orders[:next_iteration].astype(np.int16),
+            log_likelihoods=log_likelihoods[:next_iteration],
+        )
+        if sampler is not None and getattr(sampler, 'central_ranking', None) is not None:
+            arrays['central_ranking'] = sampler.central_ranking
+        save_checkpoint(checkpoint_file, checkpoint_key, arrays, dict(
+            iteration=next_iteration,
+            current_ln_likelihood=float(current_ln_likelihood),
+            acceptance_count=acceptance_count,
+            best_log_likelihood=float(best_log_likelihood),
+            best_iteration=best_iteration,
+            stop_reason=stop_reason,
+            diagnostics=last_diagnostics,
+            rng_state=rng.bit_generator.state,
+        ))
+
+    last_checkpoint = time.monotonic()
+    new_energy = 0.0
+    n_iter_run = start_iteration
+    # a chain that had already stopped when it was checkpointed does not continue
+    for iteration in range(start_iteration, iterations if stop_reason is None else start_iteration):
+        # unused, but drawn as in pyjpm so that the random stream stays the same
+        random_state = rng.integers(0, 2**32 - 1)
+
+        new_order = current_order.copy()
+        utils.shuffle_order(new_order, n_shuffle, rng)
+
+        # stage posteriors with the old theta/phi, then theta/phi for new_order
+        _, stage_post_old = utils.compute_total_ln_likelihood_and_stage_likelihoods(
+            n_participants, data_matrix, new_order, non_diseased_ids,
+            current_theta_phi, current_pi, disease_stages
+        )
+        new_theta_phi = utils.update_theta_phi_estimates(
+            n_biomarkers,
+            data_matrix,
+            new_order,
+            current_theta_phi,
+            stage_post_old,
+            disease_stages,
+            prior_n,
+            prior_v,
+        )
+        new_ln_likelihood, stage_post_new = utils.compute_total_ln_likelihood_and_stage_likelihoods(
+            n_participants, data_matrix, new_order, non_diseased_ids, new_theta_phi, current_pi, disease_stages
+        )
+        new_energy = 0.0
+        if sampler is not None:
+            new_energy = sampler.get_energy(biomarkers_int[np.argsort(new_order)])
+            new_ln_likelihood -= new_energy
+
+        delta = new_ln_likelihood - current_ln_likelihood
+        prob_accept = 1.0 if delta > 0 else np.exp(delta)
+
+        if rng.random() < prob_accept:
+            current_order = new_order
+            current_ln_likelihood = new_ln_likelihood
+            current_theta_phi = new_theta_phi
+            acceptance_count += 1
+
+            # soft stage counts of the diseased participants update the stage prior
+            stage_counts = stage_post_new[diseased_ids].sum(axis=0)
+            current_pi = rng.dirichlet(alpha_prior + stage_counts)
+
+            if current_ln_likelihood > best_log_likelihood:
+                best_log_likelihood = current_ln_likelihood
+                best_order = current_order.copy()
+                best_theta_phi = current_theta_phi.copy()
+                best_iteration = iteration
+
+        all_accepted_orders[iteration] = current_order.copy()
+        log_likelihoods[iteration] = current_ln_likelihood
+        n_iter_run = iteration + 1
+
+        if (iteration + 1) % max(10, iterations // 10) == 0:
+            acceptance_ratio = 100 * acceptance_count / (iteration + 1)
+            msg = (
+                f"Iteration {iteration + 1}/{iterations}, "
+                f"Acceptance Ratio: {acceptance_ratio:.2f}%, "
+                f"Log Likelihood: {current_ln_likelihood:.4f}"
+            )
+            if mp_method:
+                msg += f", New Energy: {new_energy:.4f}"
+            logging.info(msg)
+
+        if should_check(n_iter_run, convergence):
+            converged, last_diagnostics = check_convergence(
+                log_likelihoods[:n_iter_run], best_iteration, burn_in, convergence)
+            if converged:
+                stop_reason = 'converged'
+                logging.info(f"Converged at iteration {n_iter_run}/{iterations}: {last_diagnostics}")
+
+        if checkpoint_file and time.monotonic() - last_checkpoint >= checkpoint_seconds:
+            checkpoint(n_iter_run)
+            last_checkpoint = time.monotonic()
+
+        if stop_reason is not None:
+            break
+
+    if stop_reason is None:
+        stop_reason = 'max_iter'
+    if checkpoint_file and (state is None or state.get('stop_reason') is None):
+        # the finished chain, so that a restart after this point skips it entirely
+        checkpoint(n_iter_run)
+
+    if diagnostics is not None:
+        diagnostics.update(stop_reason=stop_reason, n_iter_run=n_iter_run, **last_diagnostics)
+    return (all_accepted_orders[:n_iter_run], log_likelihoods[:n_iter_run],
+            best_order, best_log_likelihood, best_theta_phi)
+
+def metropolis_hastings_ebm(
+        algorithm:str,
+        data_matrix:np.ndarray,
+        diseased_arr:np.ndarray,
+        iterations:int,
+        n_shuffle:int,
+        prior_n:float,
+        prior_v:float,
+        burn_in:int,
+        rng:np.random.Generator,
+        convergence:Optional[Dict]=None,
+        diagnostics:Optional[Dict]=None,
+) -> Tuple:
+    """`pysaebm.mh.metropolis_hastings` (the sampler of `pysaebm.run_ebm`), draw for draw, plus
+    the convergence and diagnostics arguments of `metropolis_hastings` above.
+    """
+    best_ll = -np.inf
+    best_order = None
+    best_theta_phi = None
+    best_stage_prior = None
+    best_iteration = 0
+    n_participants, n_biomarkers = data_matrix.shape
+
+    if n_shuffle <= 1:
+        raise ValueError("n_shuffle must be >= 2 or =0")
+    if n_shuffle > n_biomarkers:
+        raise ValueError("n_shuffle cannot exceed n_biomarkers")
+
+    n_stages = n_biomarkers + 1
+    disease_stages = np.arange(start=1, stop=n_stages, step=1)
+    n_disease_stages = n_stages - 1
+    non_diseased_ids = np.where(diseased_arr == 0)[0]
+    diseased_ids = np.where(diseased_arr == 1)[0]
+
+    theta_phi_default = ebm_utils.get_initial_theta_phi_estimates(
+        data_matrix, non_diseased_ids, diseased_ids, prior_n, prior_v, rng=rng)
+    current_theta_phi = theta_phi_default.copy()
+    current_order = rng.permutation(np.arange(1, n_stages))
+    current_ln_likelihood = -np.inf
+    alpha_prior = np.array([1.0] * (n_disease_stages))
+    current_pi = rng.dirichlet(alpha_prior)
+    acceptance_count = 0
+
+    all_accepted_orders = []
+    # pysaebm records the log likelihood before each iteration's update
+    log_likelihoods = []
+    stop_reason = None
+    last_diagnostics = {}
+
+    for iteration in range(iterations):
+        random_state = rng.integers(0, 2**32 - 1)
+        log_likelihoods.append(current_ln_likelihood)
+
+        new_order = current_order.copy()
+        ebm_utils.shuffle_order(new_order, n_shuffle, rng)
+
+        if algorithm == 'hard_kmeans':
+            new_ln_likelihood, stage_post_new = ebm_utils.compute_total_ln_likelihood_and_stage_likelihoods(
+                n_participants, data_matrix, new_order, non_diseased_ids, current_theta_phi, current_pi, disease_stages
+            )
+        else:
+            _, stage_post_old = ebm_utils.compute_total_ln_likelihood_and_stage_likelihoods(
+                n_participants, data_matrix, new_order, non_diseased_ids,
+                current_theta_phi, current_pi, disease_stages
+            )
+            new_theta_phi = ebm_utils.update_theta_phi_estimates(
+                algorithm, n_biomarkers, n_participants, non_diseased_ids, data_matrix, new_order,
+                current_theta_phi, stage_post_old, disease_stages, prior_n, prior_v, random_state,
+            )
+            new_ln_likelihood, stage_post_new = ebm_utils.compute_total_ln_likelihood_and_stage_likelihoods(
+                n_participants, data_matrix, new_order, non_diseased_ids, new_theta_phi, current_pi, disease_stages
+            )
+
+        delta = new_ln_likelihood - current_ln_likelihood
+        prob_accept = 1.0 if delta > 0 else np.exp(delta)
+
+        if rng.random() < prob_accept:
+            current_order = new_order
+            current_ln_likelihood = new_ln_likelihood
+            if algorithm != 'hard_kmeans':
+                current_theta_phi = new_theta_phi
+            acceptance_count += 1
+
+            stage_counts = stage_post_new[diseased_ids].sum(axis=0)
+            current_pi = rng.dirichlet(alpha_prior + stage_counts)
+
+            if current_ln_likelihood > best_ll:
+                best_ll = current_ln_likelihood
+                best_order = current_order.copy()
+                best_stage_prior = current_pi
+                best_theta_phi = current_theta_phi
+                best_iteration = iteration
+
+        all_accepted_orders.append(current_order.copy())
+
+        if (iteration + 1) % max(10, iterations // 10) == 0:
+            acceptance_ratio = 100 * acceptance_count / (iteration + 1)
+            logging.info(
+                f"Iteration {iteration + 1}/{iterations}, "
+                f"Acceptance Ratio: {acceptance_ratio:.2f}%, "
+                f"Log Likelihood: {current_ln_likelihood:.4f}, "
+            )
+
+        if should_check(iteration + 1, convergence):
+            converged, last_diagnostics = check_convergence(
+                np.array(log_likelihoods), best_iteration, burn_in, convergence)
+            if converged:
+                stop_reason = 'converged'
+                logging.info(f"Converged at iteration {iteration + 1}/{iterations}: {last_diagnostics}")
+                break
+
+    if diagnostics is not None:
+        diagnostics.update(stop_reason=stop_reason or 'max_iter', n_iter_run=len(log_likelihoods), **last_diagnostics)
+    return all_accepted_orders, log_likelihoods, best_order, best_theta_phi, best_stage_prior
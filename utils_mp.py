@@ -0,0 +1,476 @@
+"""Vectorized helpers on top of `pyjpm.mp_utils`.
+
+`PlackettLuce` and `MCMC` here are drop-in subclasses of the pyjpm samplers that add
+`get_energies(perms)`: the energies of a whole (N, n) matrix of permutations in a few
+array operations instead of N `get_energy` calls. The values agree with `get_energy`
+up to floating point summation order.
+
+`get_average_tau` is a batched replacement for the pyjpm function of the same name.
+
+`MCMC.get_sampled_combined_orderings` runs its `sample_count` chains side by side for the
+BT, Pairwise and Mallows_Tau methods (`sample_chains`): one array step moves every chain,
+with the proposal and acceptance rule of `pyjpm.mp_utils.mcmc_sample`. Each chain follows
+the same Markov chain as one `sample_one` call, so the samples have the same distribution;
+they are not the same draws. `MCMC(..., batched=False)` keeps the sequential walk.
+
+`SamplerCache` builds each sampler once per ordering array and configuration.
+"""
+import copy
+import hashlib
+import numpy as np
+from typing import Dict, Optional, Tuple, Union
+from scipy.optimize import minimize
+import pyjpm.mp_utils as mp_utils
+from utils_prefs import PreferenceIndex
+
+# Cap on the (chunk, n, n) temporaries built by the pairwise energies
+MAX_CHUNK_ELEMENTS = 1 << 22
+# Below this many items, scoring whole rows beats pair_terms_at for shuffles of 3+ positions
+INCREMENTAL_MIN_ITEMS = 24
+
+def _chunks(n_rows:int, n_items:int):
+    chunk = max(1, MAX_CHUNK_ELEMENTS // max(1, n_items * n_items))
+    for start in range(0, n_rows, chunk):
+        yield slice(start, min(start + chunk, n_rows))
+
+def _to_index(perms:np.ndarray, unique_elements:np.ndarray) -> np.ndarray:
+    """Map item IDs to their index in (sorted) unique_elements."""
+    return np.searchsorted(unique_elements, perms)
+
+def pair_energies(perm_idx:np.ndarray, pair_cost:np.ndarray) -> np.ndarray:
+    """sum_{p<q} pair_cost[perm[p], perm[q]] for every row of perm_idx.
+
+    perm_idx: (N, n) item indices; pair_cost: (n_items, n_items), cost of row item preceding column item.
+    """
+    N, n = perm_idx.shape
+    upper = np.triu(np.ones((n, n), dtype=bool), k=1)
+    energies = np.empty(N, dtype=np.float64)
+    for rows in _chunks(N, n):
+        idx = perm_idx[rows]
+        costs = pair_cost[idx[:, :, None], idx[:, None, :]]
+        energies[rows] = costs[:, upper].sum(axis=1)
+    return energies
+
+def pl_energies(perms:np.ndarray, unique_elements:np.ndarray, theta:np.ndarray) -> np.ndarray:
+    """Batched `pl_energy_numba`: -sum_i (theta_i - logsumexp(theta_i..theta_n))."""
+    alphas = theta[_to_index(perms, unique_elements)]
+    # suffix log-sum-exp, i.e. the log denominator at every position
+    log_denoms = np.logaddexp.accumulate(alphas[:, ::-1], axis=1)[:, ::-1]
+    return -(alphas - log_denoms).sum(axis=1)
+
+def bt_pair_cost(unique_elements:np.ndarray, theta_keys:np.ndarray, theta_values:np.ndarray) -> np.ndarray:
+    """cost[a, b] = -log P(a before b) under Bradley-Terry, clipped as in `bt_energy_numba`."""
+    theta = np.zeros(len(unique_elements), dtype=np.float64)
+    theta[_to_index(theta_keys, unique_elements)] = theta_values
+    prob = 1.0 / (1.0 + np.exp(theta[None, :] - theta[:, None]))
+    return -np.log(np.maximum(prob, 1e-16))
+
+def pairwise_pair_cost(unique_elements:np.ndarray, weights_keys:np.ndarray, weights_values:np.ndarray) -> np.ndarray:
+    """cost[a, b] = -w_ab, the dense form of the Pairwise weights."""
+    cost = np.zeros((len(unique_elements), len(unique_elements)), dtype=np.float64)
+    if len(weights_keys):
+        idx = _to_index(weights_keys, unique_elements)
+        cost[idx[:, 0], idx[:, 1]] = -weights_values
+    return cost
+
+def mallows_tau_pair_cost(unique_elements:np.ndarray, central_ordering:np.ndarray, mallows_temperature:float) -> np.ndarray:
+    """cost[a, b] = mallows_temperature / n_pairs if b precedes a in central_ordering, so that
+    pair_energies gives `mallows_tau_energies`: each discordant pair adds its share of the distance.
+    """
+    n = len(unique_elements)
+    n_pairs = n * (n - 1) // 2
+    central_pos = np.empty(n, dtype=np.int64)
+    central_pos[_to_index(central_ordering, unique_elements)] = np.arange(n)
+    discordant = central_pos[:, None] > central_pos[None, :]
+    return discordant * (mallows_temperature / n_pairs) if n_pairs else np.zeros((n, n))
+
+def pair_terms_at(perm_idx:np.ndarray, positions:np.ndarray, pair_costs:np.ndarray) -> np.ndarray:
+    """The part of pair_energies(perm_idx) from pairs with at least one position in `positions`.
+
+    positions: (N, s) distinct positions per row; pair_costs: np.stack([pair_cost.T, pair_cost]).
+    O(s n) per row instead of O(n^2).
+    """
+    n_rows, n = perm_idx.shape
+    rows = np.arange(n_rows)[:, None, None]
+    items = np.take_along_axis(perm_idx, positions, axis=1)[:, :, None]
+    q = np.arange(n)
+    # (N, s, n): the term of the pair (positions[r, k], q), in sequence order
+    terms = pair_costs[(positions[:, :, None] < q).view(np.int8), items, perm_idx[:, None, :]]
+    terms[positions[:, :, None] == q] = 0.0
+    # a pair of two listed positions is in both of their rows: count it once
+    within = terms[rows, np.arange(positions.shape[1])[None, :, None], positions[:, None, :]]
+    return terms.sum(axis=(1, 2)) - within.sum(axis=(1, 2)) / 2
+
+def swap_deltas(perm_idx:np.ndarray, positions:np.ndarray, pair_cost_diff:np.ndarray) -> np.ndarray:
+    """Energy change of swapping the items at the two positions of every row, in O(j - i).
+
+    pair_cost_diff: pair_cost - pair_cost.T. Swapping a (at i) and b (at j) flips the pair
+    (a, b) and, for every item x between them, trades (a, x), (x, b) for (b, x), (x, a); the
+    pairs with items outside [i, j] keep their order.
+    """
+    n_rows, n = perm_idx.shape
+    rows = np.arange(n_rows)
+    i, j = positions.min(axis=1), positions.max(axis=1)
+    a, b = perm_idx[rows, i], perm_idx[rows, j]
+    q = np.arange(n)
+    between = (q > i[:, None]) & (q < j[:, None])
+    changes = pair_cost_diff[b[:, None], perm_idx] - pair_cost_diff[a[:, None], perm_idx]
+    return pair_cost_diff[b, a] + (changes * between).sum(axis=1)
+
+def propose_shuffles(perm_idx:np.ndarray, n_shuffle:int, rng:np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """`shuffle_order` on a copy of every row: n_shuffle distinct positions, rearranged so that
+    none of them keeps its item. Returns the proposals and the (N, n_shuffle) positions moved.
+    """
+    n_chains, n = perm_idx.shape
+    if n_shuffle <= 1:
+        raise ValueError("n_shuffle must be >= 2 or =0")
+    if n_shuffle > n:
+        raise ValueError("n_shuffle cannot exceed array length")
+    rows = np.arange(n_chains)[:, None]
+    proposals = perm_idx.copy()
+    if n_shuffle == 2:
+        # the only derangement of two positions is the swap
+        i = rng.integers(0, n, n_chains)
+        j = rng.integers(0, n - 1, n_chains)
+        positions = np.stack([i, j + (j >= i)], axis=1)
+        proposals[rows, positions] = perm_idx[rows, positions[:, ::-1]]
+        return proposals, positions
+    positions = np.argsort(rng.random((n_chains, n)), axis=1)[:, :n_shuffle]
+    # a random derangement of the chosen positions, by rejection as in shuffle_order
+    order = np.argsort(rng.random((n_chains, n_shuffle)), axis=1)
+    fixed = (order == np.arange(n_shuffle)).any(axis=1)
+    while fixed.any():
+        order[fixed] = np.argsort(rng.random((fixed.sum(), n_shuffle)), axis=1)
+        fixed = (order == np.arange(n_shuffle)).any(axis=1)
+    proposals[rows, positions] = perm_idx[rows, np.take_along_axis(positions, order, axis=1)]
+    return proposals, positions
+
+def sample_chains(
+        pair_cost:np.ndarray, 
+        n_chains:int, 
+        iterations:int, 
+        n_shuffle:int, 
+        rng:np.random.Generator,
+        check_energies:bool=False,
+    ) -> np.ndarray:
+    """n_chains independent runs of `mcmc_sample` under the energy sum_{p<q} pair_cost[perm[p], perm[q]].
+
+    Every chain starts from a random permutation and returns the lowest-energy ordering it
+    visited. Returns (n_chains, n) item indices.
+
+    A proposal only changes the terms of pairs involving the n_shuffle positions it moved, so
+    its energy is the current one plus the change of those terms: O(j - i) per chain for a swap
+    (swap_deltas), O(n_shuffle n) otherwise (pair_terms_at, from INCREMENTAL_MIN_ITEMS items on).
+    With check_energies every proposal is also scored in full, and a mismatch raises.
+    """
+    n = len(pair_cost)
+    pair_cost_diff = pair_cost - pair_cost.T
+    pair_costs = np.stack([pair_cost.T, pair_cost])
+    current = np.argsort(rng.random((n_chains, n)), axis=1)
+    energies = pair_energies(current, pair_cost)
+    best, best_energies = current.copy(), energies.copy()
+    for _ in range(iterations):
+        proposals, positions = propose_shuffles(current, n_shuffle, rng)
+        if n_shuffle == 2:
+            proposal_energies = energies + swap_deltas(current, positions, pair_cost_diff)
+        elif n >= INCREMENTAL_MIN_ITEMS:
+            proposal_energies = energies + (
+                pair_terms_at(proposals, positions, pair_costs) - pair_terms_at(current, positions, pair_costs))
+        else:
+            proposal_energies = pair_energies(proposals, pair_cost)
+        if check_energies:
+            full = pair_energies(proposals, pair_cost)
+            if not np.allclose(proposal_energies, full, rtol=1e-9, atol=1e-9):
+                raise RuntimeError(
+                    f"Incremental energies are off by up to {np.abs(proposal_energies - full).max():.3g}")
+        # min(1, exp(E(current) - E(proposal)))
+        accept = rng.random(n_chains) < np.exp(np.minimum(energies - proposal_energies, 0.0))
+        current[accept] = proposals[accept]
+        energies[accept] = proposal_energies[accept]
+        improved = energies < best_energies
+        best[improved] = current[improved]
+        best_energies[improved] = energies[improved]
+    return best
+
+def pair_precedence(perms:np.ndarray) -> np.ndarray:
+    """(N, n(n-1)/2) indicators, one per item pair (a, b) with a < b in ID order: 1 if a precedes b.
+
+    The normalized Kendall's tau distance between two permutations of the same items is the
+    Hamming distance between their rows divided by n(n-1)/2.
+    """
+    # argsort of an ID array gives each item's position, items taken in ID order
+    pos = np.argsort(perms, axis=1)
+    first, second = np.triu_indices(perms.shape[1], k=1)
+    return (pos[:, first] < pos[:, second]).astype(np.float64)
+
+def kendall_tau_distances(perms_a:np.ndarray, perms_b:np.ndarray) -> np.ndarray:
+    """(nA, nB) matrix of `normalized_kendalls_tau_distance` between every pair of permutations."""
+    perms_a = np.atleast_2d(perms_a)
+    perms_b = np.atleast_2d(perms_b)
+    n = perms_a.shape[1]
+    n_pairs = n * (n - 1) // 2
+    if n_pairs == 0:
+        return np.zeros((len(perms_a), len(perms_b)))
+    xb = pair_precedence(perms_b)
+    sb = xb.sum(axis=1)
+    out = np.empty((len(perms_a), len(perms_b)), dtype=np.float64)
+    # |xa - xb| = |xa| + |xb| - 2 xa.xb for 0/1 vectors
+    chunk = max(1, MAX_CHUNK_ELEMENTS // max(1, n_pairs + len(perms_b)))
+    for start in range(0, len(perms_a), chunk):
+        xa = pair_precedence(perms_a[start:start + chunk])
+        out[start:start + chunk] = (xa.sum(axis=1)[:, None] + sb[None, :] - 2 * xa @ xb.T) / n_pairs
+    return out
+
+def get_average_tau(perms_a:np.ndarray, perms_b:np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Same as `pyjpm.mp_utils.get_average_tau`, in O((nA + nB) n^2) instead of O(nA nB n^2).
+
+    Averaging over perms_b commutes with the Hamming identity above, so only the column sums
+    of perms_b's precedence matrix are needed, never the (nA, nB) distance matrix.
+
+    Returns:
+        inner_taus: inner_taus[i] = average distance between perms_a[i] and all perms_b
+        avg_tau: mean(inner_taus)
+    """
+    perms_a = np.atleast_2d(perms_a)
+    perms_b = np.atleast_2d(perms_b)
+    n = perms_a.shape[1]
+    n_pairs = n * (n - 1) // 2
+    if n_pairs == 0:
+        inner_taus = np.zeros(len(perms_a))
+        return inner_taus, float(np.mean(inner_taus))
+    nB = len(perms_b)
+    col_sum_b = np.zeros(n_pairs, dtype=np.float64)
+    for rows in _chunks(nB, n):
+        col_sum_b += pair_precedence(perms_b[rows]).sum(axis=0)
+    total_b = col_sum_b.sum()
+    inner_taus = np.empty(len(perms_a), dtype=np.float64)
+    for rows in _chunks(len(perms_a), n):
+        xa = pair_precedence(perms_a[rows])
+        discordant = nB * xa.sum(axis=1) + total_b - 2 * xa @ col_sum_b
+        inner_taus[rows] = discordant / (nB * n_pairs)
+    return inner_taus, float(np.mean(inner_taus))
+
+def mallows_tau_energies(perms:np.ndarray, central_ordering:np.ndarray, mallows_temperature:float) -> np.ndarray:
+    """Batched `mallows_energy_numba(..., dist_metric='tau')`."""
+    return mallows_temperature * kendall_tau_distances(perms, central_ordering[None, :])[:, 0]
+
+class PlackettLuce(mp_utils.PlackettLuce):
+    def get_energies(self, perms:np.ndarray) -> np.ndarray:
+        """
+        perms: (N, n) array of real biomarker IDs, each row a permutation of unique_elements
+        Returns: (N,) energies, same as [self.get_energy(x) for x in perms]
+        """
+        perms = np.atleast_2d(np.asarray(perms, dtype=np.int64))
+        return pl_energies(perms, self.unique_elements, self.theta)
+
+    def get_sampled_combined_orderings(self):
+        for idx in range(self.sample_count):
+            order = self.sample_one().astype(np.int64)
+            if order.shape != (self.n_unique_elements,):
+                raise ValueError(f"Unexpected sample shape {order.shape}")
+            self.sampled_combined_orderings[idx, :] = order
+        self.sampled_energies[:] = self.get_energies(self.sampled_combined_orderings)
+
+    def compute_alignment_and_determinism(self):
+        # those sampled are using the original random IDs, not indices
+        if np.sum(self.sampled_combined_orderings[0]) == 0:
+            self.get_sampled_combined_orderings()
+
+        # Calculate aggrank_agreement: how stable is the full ranking generation
+        rank_matrix = mp_utils.rankings_to_matrix(self.sampled_combined_orderings)
+        self.aggrank_agreement = mp_utils.kendalls_w(rank_matrix)
+
+        random_perms = np.array([self.rng.permutation(self.unique_elements) for _ in range(self.n_random_perms)])
+        self.random_perms = random_perms
+        self.random_perm_energies = self.get_energies(random_perms)
+
+        self.aggrank_dependence = mp_utils.auroc_from_energies(y=self.sampled_energies, x=self.random_perm_energies)
+
+class MCMC(mp_utils.MCMC):
+    # methods whose energy is a sum over item pairs, which sample_chains can run
+    BATCHED_METHODS = ('BT', 'Pairwise', 'Mallows_Tau')
+
+    def __init__(
+            self, 
+            ordering_array:np.ndarray, 
+            *args, 
+            batched:bool=True, 
+            check_energies:bool=False, 
+            preference_index:Optional[PreferenceIndex]=None, 
+            **kwargs
+        ):
+        """pyjpm's MCMC; batched: draw sampled_combined_orderings with `sample_chains`, which checks
+        its incremental energies against full ones with check_energies (slow, for debugging).
+
+        preference_index: the `utils_prefs.PreferenceIndex` of ordering_array, e.g. from the
+        store; built here if not given. The BT and Pairwise parameters come from its counts.
+        """
+        self.batched = batched
+        self.check_energies = check_energies
+        if preference_index is None:
+            preference_index = PreferenceIndex.from_ordering_array(ordering_array)
+        self.preference_index = preference_index
+        super().__init__(ordering_array, *args, **kwargs)
+
+    def _prepare_pairwise_data(self):
+        """`weights_keys`/`weights_values` from the preference index instead of a scan of the rankings."""
+        self.weights_keys, self.weights_values = self.preference_index.pairwise_weights()
+
+    def _prepare_bt_data(self):
+        """`theta_keys`/`theta_values`: the BT maximum likelihood fit of pyjpm, on the index's counts."""
+        pairs, counts = self.preference_index.bt_counts()
+        first, second = pairs[:, 0], pairs[:, 1]
+
+        def bt_neg_log_likelihood(theta:np.ndarray) -> float:
+            # summed one term at a time in pyjpm's order, so L-BFGS-B takes the same steps
+            terms = counts * (theta[first] - np.logaddexp(theta[first], theta[second]))
+            return -np.cumsum(terms)[-1] if len(terms) else 0.0
+
+        result = minimize(fun=bt_neg_log_likelihood, x0=np.zeros(self.n_items), method='L-BFGS-B')
+        self.theta_keys = self.preference_index.items.astype(np.int64)
+        self.theta_values = result.x.astype(np.float64)
+
+    def pair_cost(self) -> np.ndarray:
+        """The (n_items, n_items) pair costs whose pair_energies are this sampler's energies."""
+        if self.method == 'BT':
+            return bt_pair_cost(self.unique_elements, self.theta_keys, self.theta_values)
+        elif self.method == 'Pairwise':
+            return pairwise_pair_cost(self.unique_elements, self.weights_keys, self.weights_values)
+        elif self.method == 'Mallows_Tau':
+            return mallows_tau_pair_cost(self.unique_elements, self.central_ranking, self.mallows_temperature)
+        raise ValueError(f"{self.method} energies are not pairwise")
+
+    def get_energies(self, perms:np.ndarray) -> np.ndarray:
+        """
+        perms: (N, n) array of real biomarker IDs, each row a permutation of unique_elements
+        Returns: (N,) energies, same as [self.get_energy(x) for x in perms]
+        """
+        perms = np.atleast_2d(np.asarray(perms, dtype=np.int64))
+        if 'Mallows' in self.method and self.central_ranking is None:
+            # let pyjpm draw the central ranking exactly as get_energy would
+            self.get_energy(perms[0])
+        if self.method == 'BT':
+            cost = bt_pair_cost(self.unique_elements, self.theta_keys, self.theta_values)
+            return pair_energies(_to_index(perms, self.unique_elements), cost)
+        elif self.method == 'Pairwise':
+            cost = pairwise_pair_cost(self.unique_elements, self.weights_keys, self.weights_values)
+            return pair_energies(_to_index(perms, self.unique_elements), cost)
+        elif self.method == 'Mallows_Tau':
+            return mallows_tau_energies(perms, self.central_ranking, self.mallows_temperature)
+        elif self.method == 'Mallows_RMJ':
+            return np.array([self.get_energy(x) for x in perms], dtype=np.float64)
+        else:
+            raise ValueError(f"Unknown method {self.method}")
+
+    def get_sampled_combined_orderings(self):
+        """Generate multiple samples"""
+        if self.batched and self.method in self.BATCHED_METHODS:
+            idx = sample_chains(
+                self.pair_cost(), self.sample_count, self.iterations, self.n_shuffle, self.rng,
+                check_energies=self.check_energies)
+            self.sampled_combined_orderings[:] = self.unique_elements[idx]
+            self.sampled_energies[:] = self.get_energies(self.sampled_combined_orderings)
+            return
+        for idx in range(self.sample_count):
+            self.sampled_combined_orderings[idx, :] = self.sample_one()
+        self.sampled_energies[:] = self.get_energies(self.sampled_combined_orderings)
+
+    def compute_alignment_and_determinism(self):
+        # those sampled are using the original random IDs, not indices
+        if np.sum(self.sampled_combined_orderings[0]) == 0:
+            self.get_sampled_combined_orderings()
+
+        # Calculate aggrank_agreement: how stable is the full ranking generation
+        rank_matrix = mp_utils.rankings_to_matrix(self.sampled_combined_orderings)
+        self.aggrank_agreement = mp_utils.kendalls_w(rank_matrix)
+
+        random_perms = np.array([self.rng.permutation(self.unique_elements) for _ in range(self.n_random_perms)])
+        self.random_perms = random_perms
+
+        # we need to redo central ranking sampling, as in pyjpm. In real mh, you won't know the
+        # central ranking we used to get sampled combined orderings
+        ori_method = self.method
+        self.method = 'BT'
+        self._prepare_method_data()
+        self.central_ranking = self.sample_one()
+        self.method = ori_method # change back to Mallows method
+
+        self.random_perm_energies = self.get_energies(random_perms)
+        self.aggrank_dependence = mp_utils.auroc_from_energies(y=self.sampled_energies, x=self.random_perm_energies)
+
+def ordering_digest(ordering_array:np.ndarray) -> str:
+    """SHA-256 of a padded ordering array: its shape and values."""
+    ordering_array = np.ascontiguousarray(ordering_array, dtype=np.int64)
+    h = hashlib.sha256()
+    h.update(str(ordering_array.shape).encode())
+    h.update(ordering_array.tobytes())
+    return h.hexdigest()
+
+class SamplerCache:
+    """Samplers keyed by the ordering array, the method, the Mallows temperature and the sampling
+    parameters, so that e.g. run_meta.py's generator sampler also serves as the inference sampler
+    of the same method.
+
+    Cached samplers are shared: callers must not change them. Building a BT, Pairwise or PL
+    sampler does not touch rng, so a cache hit gives the same energies and rng stream as a new
+    one. A Mallows sampler draws its central ranking from rng when built; on a hit the cache
+    returns a shallow copy with a central ranking drawn the same way, which keeps results
+    identical to building it anew while skipping the BT preparation.
+    """
+    def __init__(self):
+        self.samplers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, ordering_array:np.ndarray, method:str, mallows_temperature:float, **sampling) -> Tuple:
+        if 'Mallows' not in method:
+            # only the Mallows energies depend on it
+            mallows_temperature = None
+        return (ordering_digest(ordering_array), method, mallows_temperature, tuple(sorted(sampling.items())))
+
+    def get(
+            self,
+            ordering_array:np.ndarray,
+            rng:np.random.Generator,
+            method:str,
+            mallows_temperature:float=1,
+            batched:bool=True,
+            check_energies:bool=False,
+            preference_index:Optional[PreferenceIndex]=None,
+            **sampling
+        ) -> Union[PlackettLuce, MCMC]:
+        """PlackettLuce(ordering_array, rng, pl_best=False, **sampling) if method is 'PL',
+        MCMC(ordering_array, rng=rng, method=method, mallows_temperature=..., batched=...,
+        check_energies=..., **sampling) otherwise.
+
+        sampling: mcmc_iterations, n_shuffle, sample_count, n_random_perms. preference_index goes to
+        MCMC; as it derives from ordering_array, it is not part of the key.
+        """
+        if method != 'PL':
+            sampling = dict(sampling, batched=batched, check_energies=check_energies)
+        key = self.key(ordering_array, method, mallows_temperature, **sampling)
+        sampler = self.samplers.get(key)
+        if sampler is None:
+            self.misses += 1
+            if method == 'PL':
+                sampler = PlackettLuce(ordering_array=ordering_array, rng=rng, pl_best=False, **sampling)
+            else:
+                sampler = MCMC(
+                    ordering_array=ordering_array, rng=rng, method=method,
+                    mallows_temperature=mallows_temperature, preference_index=preference_index, **sampling)
+            self.samplers[key] = sampler
+            return sampler
+        self.hits += 1
+        if 'Mallows' not in method:
+            return sampler
+        sampler = copy.copy(sampler)
+        sampler.rng = rng
+        # as in MCMC.__init__: the central ranking is a BT sample
+        sampler.method = 'BT'
+        sampler.central_ranking = sampler.sample_one()
+        sampler.method = method
+        return sampler
+
+    def stats(self) -> Dict[str, int]:
+        return {'built': self.misses, 'reused': self.hits}
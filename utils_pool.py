@@ -0,0 +1,58 @@
+"""Process-pool helpers shared by the run_*.py scripts."""
+import os
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional
+
+def get_n_workers(requested:Optional[int]=None) -> int:
+    """Number of worker processes to use.
+
+    `requested` wins if it is positive. Otherwise use the cores allocated to this job:
+    HTCondor exports OMP_NUM_THREADS = request_cpus, and outside a job we fall back
+    to the CPUs this process may run on.
+    """
+    if requested:
+        return max(1, int(requested))
+    if os.environ.get('OMP_NUM_THREADS', '').isdigit():
+        return max(1, int(os.environ['OMP_NUM_THREADS']))
+    return max(1, len(os.sched_getaffinity(0)))
+
+def map_kwargs(fn:Callable, kwargs_list:List[Dict], executor:Optional[Executor]=None) -> List:
+    """[fn(**kwargs) for kwargs in kwargs_list], run on `executor` if given. Results keep the input order."""
+    if executor is None:
+        return [fn(**kwargs) for kwargs in kwargs_list]
+    futures = [executor.submit(fn, **kwargs) for kwargs in kwargs_list]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        # the calls that have not started yet are not needed any more
+        for future in futures:
+            future.cancel()
+        raise
+
+@contextmanager
+def process_pool(n_workers:int) -> Iterator[Optional[Executor]]:
+    """A ProcessPoolExecutor of n_workers, or None (run in this process) for a single worker.
+
+    If the body raises, the queued calls are cancelled and the running ones terminated instead
+    of waited for, so a failed job ends at once; the fits checkpoint, and a rerun resumes them.
+    """
+    if n_workers <= 1:
+        yield None
+        return
+    executor = ProcessPoolExecutor(max_workers=n_workers)
+    try:
+        yield executor
+    except BaseException:
+        terminate_pool(executor)
+        raise
+    executor.shutdown()
+
+def terminate_pool(executor:ProcessPoolExecutor):
+    """Shut executor down without waiting for the calls it is running."""
+    # shutdown() drops the process table
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
@@ -0,0 +1,166 @@
+"""Pairwise-preference index of one combination's partial rankings.
+
+`compute_conflict2`, `get_overlap_rate` and the BT/Pairwise sampler set-up each rescan the
+padded `ordering_array` (item IDs, padded with -1). `PreferenceIndex` derives once:
+
+- items: the sorted item IDs;
+- before[a, b]: how many rankings put items[a] before items[b];
+- coverage[a]: how many rankings contain items[a];
+- positions[k, a]: the position of items[a] in ranking k, -1 if it is not there.
+
+`TrueOrderStore` (utils_store.py) stores it next to `ordering_array` when run_gen.py writes
+a combination, and the metrics here and `utils_mp.MCMC` take it in place of the raw array.
+Sums run in the order of the pyjpm loops they replace, so the metrics and the BT fit are
+the same to the last bit.
+
+`corpus_conflict_overlap` computes the two metrics of many combinations at once, from their
+ordering arrays stacked into one (combinations, rankings, length) tensor.
+"""
+import numpy as np
+from typing import List, Tuple
+
+# Item IDs, positions and counts are small integers, as in utils_store
+_BLOB_DTYPE = np.int16
+
+class PreferenceIndex:
+    def __init__(self, items:np.ndarray, before:np.ndarray, coverage:np.ndarray, positions:np.ndarray):
+        self.items = items
+        self.before = before
+        self.coverage = coverage
+        self.positions = positions
+
+    @classmethod
+    def from_ordering_array(cls, ordering_array:np.ndarray) -> 'PreferenceIndex':
+        ordering_array = np.atleast_2d(np.asarray(ordering_array, dtype=np.int64))
+        valid = ordering_array != -1
+        items = np.unique(ordering_array[valid])
+        n_rankings, n = len(ordering_array), len(items)
+        positions = np.full((n_rankings, n), -1, dtype=np.int64)
+        rows, cols = np.nonzero(valid)
+        # position among the ranking's items, wherever the padding is
+        positions[rows, np.searchsorted(items, ordering_array[rows, cols])] = (np.cumsum(valid, axis=1) - 1)[rows, cols]
+        return cls(items, _precedence(positions).sum(axis=0), (positions >= 0).sum(axis=0), positions)
+
+    @property
+    def n_items(self) -> int:
+        return len(self.items)
+
+    @property
+    def n_rankings(self) -> int:
+        return len(self.positions)
+
+    def to_blob(self) -> bytes:
+        parts = [np.array([self.n_items]), self.items, self.coverage, self.before.ravel(), self.positions.ravel()]
+        return np.concatenate(parts).astype(_BLOB_DTYPE).tobytes()
+
+    @classmethod
+    def from_blob(cls, blob:bytes, n_rankings:int) -> 'PreferenceIndex':
+        values = np.frombuffer(blob, dtype=_BLOB_DTYPE).astype(np.int64)
+        n = int(values[0])
+        items, coverage, before, positions = np.split(values[1:], np.cumsum([n, n, n * n]))
+        return cls(items, before.reshape(n, n), coverage, positions.reshape(n_rankings, n))
+
+    def overlap_rate(self) -> float:
+        """`run_meta.get_overlap_rate`: the share of items that are in more than one ranking."""
+        if self.n_items == 0:
+            return 0.0
+        return float(np.sum(self.coverage > 1) / self.n_items)
+
+    def conflict(self) -> float:
+        """`pyjpm.mp_utils.compute_conflict2`: the mean normalized Kendall's tau distance between
+        every two rankings, on the items they share (0 if they share fewer than two).
+        """
+        K = self.n_rankings
+        if K < 2:
+            return 0.0
+        precedence = _precedence(self.positions).astype(np.float64)
+        # discordant[k, l]: pairs ranking k orders one way and ranking l the other
+        discordant = precedence.reshape(K, -1) @ precedence.transpose(0, 2, 1).reshape(K, -1).T
+        present = (self.positions >= 0).astype(np.float64)
+        common = present @ present.T
+        n_pairs = common * (common - 1) / 2
+        distances = np.divide(discordant, n_pairs, out=np.zeros_like(discordant), where=n_pairs > 0)
+        upper = np.triu_indices(K, k=1)
+        # cumsum adds one at a time, like the loop over (i, j)
+        return float(2 / (K * (K - 1)) * np.cumsum(distances[upper])[-1])
+
+    def bt_counts(self):
+        """(index pairs (m, 2), counts (m,)) of the item pairs ranked a before b at least once, in
+        the order `_prepare_bt_data` first meets them: ranking by ranking, (i, j) by position.
+        """
+        rankings = []
+        for positions in self.positions:
+            present = np.flatnonzero(positions >= 0)
+            rankings.append(present[np.argsort(positions[present])])
+        first, second = [], []
+        for ranking in rankings:
+            i, j = np.triu_indices(len(ranking), k=1)
+            first.append(ranking[i])
+            second.append(ranking[j])
+        first = np.concatenate(first) if first else np.zeros(0, dtype=np.int64)
+        second = np.concatenate(second) if second else np.zeros(0, dtype=np.int64)
+        _, seen = np.unique(first * self.n_items + second, return_index=True)
+        seen = np.sort(seen)
+        a, b = first[seen], second[seen]
+        return np.stack([a, b], axis=1), self.before[a, b]
+
+    def pairwise_weights(self):
+        """(ID pairs (m, 2), weights (m,)) as in `_prepare_pairwise_data`: for every ordered pair of
+        items ranked together at least once, #(a before b) - #(b before a).
+        """
+        a, b = np.nonzero(self.before + self.before.T)
+        keys = np.stack([self.items[a], self.items[b]], axis=1)
+        return keys, (self.before[a, b] - self.before[b, a]).astype(np.float64)
+
+def stack_ordering_arrays(ordering_arrays:List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """(tensor (C, K, L), n_rankings (C,)): the arrays padded with -1 to the most rankings and the
+    longest ranking among them.
+    """
+    ordering_arrays = [np.atleast_2d(np.asarray(x, dtype=np.int64)) for x in ordering_arrays]
+    n_rankings = np.array([len(x) for x in ordering_arrays], dtype=np.int64)
+    K = int(n_rankings.max(initial=0))
+    L = max((x.shape[1] for x in ordering_arrays), default=0)
+    tensor = np.full((len(ordering_arrays), K, L), -1, dtype=np.int64)
+    for c, x in enumerate(ordering_arrays):
+        tensor[c, :x.shape[0], :x.shape[1]] = x
+    return tensor, n_rankings
+
+def corpus_conflict_overlap(tensor:np.ndarray, n_rankings:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(conflict (C,), overlap_rate (C,)) of every combination of a `stack_ordering_arrays` tensor,
+    the same to the last bit as `PreferenceIndex.conflict` and `overlap_rate` of each one.
+
+    Items are indexed by ID, so the padding rankings contain no items: they add nothing to the
+    coverage, and their distances to the other rankings are 0.
+    """
+    C, K, L = tensor.shape
+    valid = tensor != -1
+    n = int(tensor.max(initial=-1)) + 1
+    positions = np.full((C, K, n), -1, dtype=np.int64)
+    c, k, col = np.nonzero(valid)
+    positions[c, k, tensor[c, k, col]] = (np.cumsum(valid, axis=2) - 1)[c, k, col]
+    present = positions >= 0
+
+    coverage = present.sum(axis=1)
+    n_items = (coverage > 0).sum(axis=1)
+    overlap_rate = np.divide(np.sum(coverage > 1, axis=1), n_items, out=np.zeros(C), where=n_items > 0)
+
+    precedence = _precedence(positions.reshape(C * K, n)).reshape(C, K, n * n).astype(np.float64)
+    transposed = precedence.reshape(C, K, n, n).transpose(0, 1, 3, 2).reshape(C, K, n * n)
+    discordant = precedence @ transposed.transpose(0, 2, 1)
+    present = present.astype(np.float64)
+    common = present @ present.transpose(0, 2, 1)
+    n_pairs = common * (common - 1) / 2
+    distances = np.divide(discordant, n_pairs, out=np.zeros_like(discordant), where=n_pairs > 0)
+    upper = np.triu_indices(K, k=1)
+    # pairs with a padding ranking add 0.0, which leaves each running sum as it was
+    sums = np.cumsum(distances[:, upper[0], upper[1]], axis=1)[:, -1] if K > 1 else np.zeros(C)
+    n_ranking_pairs = n_rankings * (n_rankings - 1)
+    scale = np.divide(2, n_ranking_pairs, out=np.zeros(C), where=n_ranking_pairs > 0)
+    conflict = scale * sums
+    return conflict, overlap_rate
+
+def _precedence(positions:np.ndarray) -> np.ndarray:
+    """(K, n, n) booleans: ranking k has both items and puts a before b."""
+    present = positions >= 0
+    both = present[:, :, None] & present[:, None, :]
+    return both & (positions[:, :, None] < positions[:, None, :])
@@ -0,0 +1,150 @@
+"""Parquet table of fit metrics, appended to by the run_mpebm jobs themselves.
+
+Next to its `*_results.json`, every `run_mpebm(save_results=True, results_store=...)` fit
+writes one row (filename, J, R, E, M, runtime, max_log_likelihood, kendalls_tau,
+mean_absolute_error) to a dataset partitioned like the results folders:
+
+    <store_dir>/data_framework=<framework>/algo=<algo>/<filename>-<written_at>-<uuid>.parquet
+
+A writer never touches an existing file: it writes a hidden temporary file in the partition
+and renames it, so any number of jobs can append at once without locks, and HTCondor can
+merge the stores of separate jobs by copying them into one directory. A rerun of a fit adds
+a newer row; `read_results` keeps the latest row per (data_framework, algo, filename).
+
+Readers get the partition columns for free and filter before reading any data:
+
+    read_results('algo_results/results_store', filters=[('algo', '=', 'BT'), ('J', '=', 50)])
+
+One file per fit adds up, so `python3 utils_results.py [store_dir]` compacts each partition
+into a single file. It is safe to run while jobs are still writing.
+"""
+import sys
+import os
+import re
+import glob
+import time
+import uuid
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pandas as pd
+from typing import Dict, List, Optional
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('data_framework', pa.string()), ('algo', pa.string())]), flavor='hive')
+SCHEMA = pa.schema([
+    ('filename', pa.string()),
+    ('J', pa.int64()),
+    ('R', pa.float64()),
+    ('E', pa.string()),
+    ('M', pa.int64()),
+    ('runtime', pa.float64()),
+    ('max_log_likelihood', pa.float64()),
+    ('kendalls_tau', pa.float64()),
+    ('mean_absolute_error', pa.float64()),
+    # time.time_ns() of the append; the latest row of a fit wins
+    ('written_at', pa.int64()),
+])
+KEY_COLUMNS = ['data_framework', 'algo', 'filename']
+
+def _extract_components(filename:str):
+    match = re.match(r'^j(\d+)_r([\d.]+)_E(.*?)_m(\d+)$', filename)
+    if match:
+        J, R, E, M = match.groups()
+        return int(J), float(R), E, int(M)
+    # e.g. the ADNI fits: no J/R/E/M
+    return None, None, None, None
+
+def _partition_dir(store_dir:str, data_framework:str, algo:str) -> str:
+    return os.path.join(store_dir, f"data_framework={data_framework}", f"algo={algo}")
+
+def _write_atomic(table:pa.Table, directory:str, name:str):
+    os.makedirs(directory, exist_ok=True)
+    # the leading dot hides the partial file from readers (pyarrow skips '.' and '_' files)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+def append_result(store_dir:str, data_framework:str, algo:str, filename:str, results:Dict) -> str:
+    """Add the metrics of one fit (the dict saved as *_results.json) to the store. Returns the new file."""
+    J, R, E, M = _extract_components(filename)
+    written_at = time.time_ns()
+    row = dict(
+        filename=filename, J=J, R=R, E=E, M=M,
+        runtime=results.get('runtime'),
+        max_log_likelihood=results.get('max_log_likelihood'),
+        kendalls_tau=results.get('kendalls_tau'),
+        mean_absolute_error=results.get('mean_absolute_error'),
+        written_at=written_at,
+    )
+    table = pa.Table.from_pylist([row], schema=SCHEMA)
+    name = f"{filename}-{written_at}-{uuid.uuid4().hex[:8]}.parquet"
+    directory = _partition_dir(store_dir, data_framework, algo)
+    _write_atomic(table, directory, name)
+    return os.path.join(directory, name)
+
+def open_dataset(store_dir:str) -> ds.Dataset:
+    """The store as a `pyarrow.dataset.Dataset`, with data_framework and algo as columns."""
+    schema = pa.unify_schemas([SCHEMA, PARTITIONING.schema])
+    return ds.dataset(store_dir, format='parquet', schema=schema, partitioning=PARTITIONING)
+
+def read_results(store_dir:str, filters:Optional[List]=None, columns:Optional[List[str]]=None, latest:bool=True) -> pd.DataFrame:
+    """Rows of the store as a DataFrame.
+
+    filters: conditions in the `pyarrow.parquet` list-of-tuples form, e.g.
+        [('data_framework', 'in', ['BT', 'PL']), ('J', '>=', 100)]. Partition columns prune
+        directories and the other columns are checked against row-group statistics.
+    columns: columns to read; the key columns are always included.
+    latest: keep only the latest row of each fit.
+    """
+    all_columns = KEY_COLUMNS + [x for x in SCHEMA.names if x not in KEY_COLUMNS]
+    if columns is not None:
+        columns = KEY_COLUMNS + [x for x in columns if x not in KEY_COLUMNS]
+        if latest and 'written_at' not in columns:
+            columns.append('written_at')
+    if not os.path.isdir(store_dir):
+        return pd.DataFrame(columns=columns or all_columns)
+    table = open_dataset(store_dir).to_table(
+        columns=columns or all_columns,
+        filter=pq.filters_to_expression(filters) if filters else None,
+    )
+    df = table.to_pandas()
+    if latest:
+        df = df.sort_values('written_at', kind='stable').drop_duplicates(KEY_COLUMNS, keep='last')
+        df = df.sort_values(KEY_COLUMNS, kind='stable').reset_index(drop=True)
+    return df
+
+def compact(store_dir:str) -> int:
+    """Merge the files of every partition into one, keeping the latest row per fit. Returns the files removed."""
+    removed = 0
+    for partition in sorted(glob.glob(os.path.join(store_dir, 'data_framework=*', 'algo=*'))):
+        files = sorted(
+            os.path.join(partition, x) for x in os.listdir(partition)
+            if x.endswith('.parquet') and not x.startswith(('.', '_'))
+        )
+        if len(files) < 2:
+            continue
+        table = pa.concat_tables(pq.read_table(x, schema=SCHEMA) for x in files)
+        df = table.to_pandas()
+        df = df.sort_values('written_at', kind='stable').drop_duplicates('filename', keep='last')
+        df = df.sort_values('filename', kind='stable')
+        written_at = time.time_ns()
+        # written before the inputs are removed: a reader in between sees duplicates, never gaps
+        _write_atomic(pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False), partition,
+                      f"part-{written_at}-{uuid.uuid4().hex[:8]}.parquet")
+        for x in files:
+            try:
+                os.remove(x)
+                removed += 1
+            except FileNotFoundError:
+                # another compaction got there first
+                pass
+    return removed
+
+if __name__ == "__main__":
+    store_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join('algo_results', 'results_store')
+    removed = compact(store_dir)
+    df = read_results(store_dir)
+    print(f"{store_dir}: compacted {removed} files, {len(df)} fits")
+    if len(df):
+        print(df.groupby(['data_framework', 'algo']).size().to_string())
@@ -0,0 +1,248 @@
+"""Indexed, single-file store for the `true_order_and_stages_<framework>` ground truth.
+
+The JSON files hold ~1800 combinations each, but every job only needs one of them.
+The store is a SQLite database with one row per `j{J}_r{R}_E{E}_m{M}` key, so a
+lookup is a primary-key read instead of a full `json.load`. Each row also keeps the
+`utils_prefs.PreferenceIndex` of its `ordering_array`, computed when the row is written.
+
+    python3 utils_store.py                 # convert every true_order_and_stages_*.json here
+    python3 utils_store.py BT PL           # only these frameworks
+"""
+import sys
+import os
+import json
+import glob
+import sqlite3
+import numpy as np
+from typing import Dict, List, Optional, Iterator, Tuple
+from utils_prefs import PreferenceIndex
+
+STORE_PREFIX = 'true_order_and_stages_'
+STORE_EXT = '.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    mp_method TEXT,
+    n_partial_rankings INTEGER,
+    ordering_array BLOB,
+    true_order TEXT,
+    true_stages BLOB,
+    preference_index BLOB
+);
+CREATE TABLE IF NOT EXISTS progress (
+    stage TEXT,
+    name TEXT,
+    PRIMARY KEY (stage, name)
+);
+"""
+
+def get_store_path(base_dir:str, data_framework:str) -> str:
+    return os.path.join(base_dir, f"{STORE_PREFIX}{data_framework}{STORE_EXT}")
+
+def get_json_path(base_dir:str, data_framework:str) -> str:
+    return os.path.join(base_dir, f"{STORE_PREFIX}{data_framework}.json")
+
+# Biomarker IDs (padded with -1) and stages are small integers; int16 keeps rows to a few hundred bytes.
+_BLOB_DTYPE = np.int16
+
+def _array_to_blob(arr) -> bytes:
+    return np.ascontiguousarray(arr, dtype=_BLOB_DTYPE).tobytes()
+
+def _blob_to_array(blob:bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=_BLOB_DTYPE).astype(np.int64)
+
+class TrueOrderStore:
+    """Key -> {mp_method, n_partial_rankings, ordering_array, true_order, true_stages, preference_index}.
+
+    `ordering_array` comes back as the padded int64 array; `true_stages` as a list of
+    ints, because `run_mpebm` tests it with `if true_stages:`. Stores written before the
+    preference index existed get the column on their next write, and the index is derived on
+    read until then.
+    """
+    def __init__(self, path:str, mode:str='r'):
+        self.path = path
+        self.mode = mode
+        if mode == 'r':
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Store {path} does not exist.")
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        elif mode == 'w':
+            self.conn = sqlite3.connect(path)
+            self.conn.executescript(_SCHEMA)
+            if 'preference_index' not in self._columns():
+                self.conn.execute("ALTER TABLE records ADD COLUMN preference_index BLOB")
+            self.conn.commit()
+        else:
+            raise ValueError(f"mode must be 'r' or 'w', got {mode}")
+        self.has_index = 'preference_index' in self._columns()
+
+    def _columns(self) -> List[str]:
+        return [row[1] for row in self.conn.execute("PRAGMA table_info(records)")]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            if self.mode == 'w':
+                self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def __contains__(self, key:str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM records WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def keys(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT key FROM records ORDER BY rowid")]
+
+    def n_partial_rankings(self) -> List[Tuple[str, int]]:
+        """(key, n_partial_rankings) for every record, in insertion order, without decoding the arrays."""
+        return list(self.conn.execute("SELECT key, n_partial_rankings FROM records ORDER BY rowid"))
+
+    def ordering_arrays(self) -> Iterator[Tuple[str, np.ndarray]]:
+        """(key, ordering_array) for every record, in insertion order, without decoding the rest."""
+        rows = self.conn.execute("SELECT key, n_partial_rankings, ordering_array FROM records ORDER BY rowid")
+        for key, n_partial_rankings, ordering_array in rows:
+            yield key, _blob_to_array(ordering_array).reshape(n_partial_rankings, -1)
+
+    def __getitem__(self, key:str) -> Dict:
+        row = self.conn.execute(
+            "SELECT mp_method, n_partial_rankings, ordering_array, true_order, true_stages, "
+            f"{'preference_index' if self.has_index else 'NULL'} FROM records WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        mp_method, n_partial_rankings, ordering_array, true_order, true_stages, preference_index = row
+        ordering_array = _blob_to_array(ordering_array).reshape(n_partial_rankings, -1)
+        if preference_index is None:
+            preference_index = PreferenceIndex.from_ordering_array(ordering_array)
+        else:
+            preference_index = PreferenceIndex.from_blob(preference_index, n_partial_rankings)
+        return {
+            'mp_method': mp_method,
+            'n_partial_rankings': n_partial_rankings,
+            'ordering_array': ordering_array,
+            'true_order': json.loads(true_order),
+            'true_stages': _blob_to_array(true_stages).tolist(),
+            'preference_index': preference_index,
+        }
+
+    def items(self) -> Iterator:
+        for key in self.keys():
+            yield key, self[key]
+
+    def put(self, key:str, record:Dict):
+        """Insert or replace one record. Accepts numpy or plain Python values."""
+        true_order = {str(k): int(v) for k, v in record['true_order'].items()}
+        ordering_array = np.asarray(record['ordering_array'], dtype=np.int64).reshape(int(record['n_partial_rankings']), -1)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO records "
+            "(key, mp_method, n_partial_rankings, ordering_array, true_order, true_stages, preference_index) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                record.get('mp_method'),
+                int(record['n_partial_rankings']),
+                _array_to_blob(ordering_array),
+                json.dumps(true_order),
+                _array_to_blob(record['true_stages']),
+                PreferenceIndex.from_ordering_array(ordering_array).to_blob(),
+            )
+        )
+
+    def update(self, records:Dict[str, Dict]):
+        for key, record in records.items():
+            self.put(key, record)
+        self.conn.commit()
+
+    def is_done(self, stage:str, name:str) -> bool:
+        """Whether `mark_done(stage, name)` was committed by this or an earlier run."""
+        row = self.conn.execute(
+            "SELECT 1 FROM progress WHERE stage = ? AND name = ?", (stage, name)).fetchone()
+        return row is not None
+
+    def mark_done(self, stage:str, name:str, records:Optional[Dict[str, Dict]]=None):
+        """Write `records` (if any) and mark (stage, name) as finished in one transaction.
+
+        A run killed before the commit leaves neither behind, so a restart redoes that unit only.
+        """
+        with self.conn:
+            for key, record in (records or {}).items():
+                self.put(key, record)
+            self.conn.execute("INSERT OR IGNORE INTO progress VALUES (?, ?)", (stage, name))
+
+    def export_json(self, json_path:str):
+        """Write the records as the `true_order_and_stages_<framework>.json` layout, one key at a time."""
+        tmp_path = f"{json_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("{")
+            for idx, (key, record) in enumerate(self.items()):
+                # derived, and not part of the JSON layout
+                del record['preference_index']
+                record['ordering_array'] = record['ordering_array'].tolist()
+                f.write("," if idx else "")
+                f.write(f"\n  {json.dumps(key)}: {json.dumps(record)}")
+            f.write("\n}\n")
+        os.replace(tmp_path, json_path)
+
+def open_true_order_and_stages(base_dir:str, data_framework:str):
+    """Mapping of key -> record for one framework.
+
+    Returns the indexed store if it exists, otherwise the parsed JSON dict (old layout).
+    """
+    store_path = get_store_path(base_dir, data_framework)
+    if os.path.isfile(store_path):
+        return TrueOrderStore(store_path)
+    json_path = get_json_path(base_dir, data_framework)
+    if not os.path.isfile(json_path):
+        raise FileNotFoundError(f"Neither {store_path} nor {json_path} exists.")
+    with open(json_path, "r") as f:
+        return json.load(f)
+
+def load_true_order_and_stages(base_dir:str, data_framework:str, filename:str) -> Dict:
+    """Read one combination, preferring the indexed store over the JSON file."""
+    records = open_true_order_and_stages(base_dir, data_framework)
+    if isinstance(records, TrueOrderStore):
+        with records:
+            return records[filename]
+    record = records[filename]
+    record['ordering_array'] = np.array(record['ordering_array'])
+    record['preference_index'] = PreferenceIndex.from_ordering_array(record['ordering_array'])
+    return record
+
+def load_ordering_arrays(base_dir:str, data_framework:str) -> Dict[str, np.ndarray]:
+    """key -> ordering_array of every combination of one framework, preferring the indexed store."""
+    records = open_true_order_and_stages(base_dir, data_framework)
+    if isinstance(records, TrueOrderStore):
+        with records:
+            return dict(records.ordering_arrays())
+    return {key: np.array(record['ordering_array']) for key, record in records.items()}
+
+def build_store_from_json(json_path:str, store_path:Optional[str]=None) -> str:
+    if store_path is None:
+        store_path = json_path[:-len('.json')] + STORE_EXT
+    with open(json_path, "r") as f:
+        records = json.load(f)
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    with TrueOrderStore(store_path, mode='w') as store:
+        store.update(records)
+    return store_path
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if len(sys.argv) > 1:
+        json_files = [get_json_path(base_dir, x) for x in sys.argv[1:]]
+    else:
+        json_files = sorted(glob.glob(os.path.join(base_dir, f"{STORE_PREFIX}*.json")))
+    for json_file in json_files:
+        store_path = build_store_from_json(json_file)
+        print(f"{json_file} -> {store_path} ({os.path.getsize(store_path) / 1e6:.2f} MB)")
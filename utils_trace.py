@@ -0,0 +1,194 @@
+"""Per-stage timing records of run_gen.py, run_meta.py and run_mlhc.py.
+
+Each job appends one JSON line per stage to `<TRACE_DIR>/<script>_<key>.jsonl` (TRACE_DIR in
+config.yaml; empty disables tracing):
+
+    {"script": "run_mlhc", "key": "j50_r0.1_E..._m0", "J": 50, "stage": "mixed_fit",
+     "data_framework": "BT", "algo": "PL", "wall_s": 812.4, "cpu_s": 809.9,
+     "rss_start_mb": 180.2, "peak_rss_mb": 412.0, "rss_scope": "stage",
+     "host": "...", "pid": 1234, "time": "2025-..."}
+
+cpu_s is the CPU time of the process that ran the stage (a pool worker for the fits).
+peak_rss_mb is that process's peak resident memory during the stage, and rss_start_mb its
+resident memory when the stage began: on Linux the peak is reset at the start of every stage
+through /proc/self/clear_refs and read from VmHWM, as run_bench.py does. Elsewhere only the
+process's lifetime peak is known (getrusage, rss_scope "process"): a stage's peak_rss_mb is
+then that of the process so far, and rss_start_mb the lifetime peak when the stage began.
+Lines are written with a single O_APPEND write, so pool workers can share a file.
+
+    python3 utils_trace.py traces                         # roll up by stage, J and framework
+    python3 utils_trace.py traces --by script stage algo
+"""
+import os
+import glob
+import json
+import time
+import socket
+import argparse
+import resource
+import pandas as pd
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# running peaks (KB) of the stages open in this process, outermost first: resetting the
+# high-water mark for an inner stage must not lose what an outer one has seen so far
+_open_peaks = []
+
+def _read_status_kb(*fields:str) -> Tuple[int, ...]:
+    values = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in fields:
+                values[name] = int(value.split()[0])
+    return tuple(values[field] for field in fields)
+
+def _reset_peak() -> Optional[int]:
+    """Reset this process's peak RSS to its current RSS; returns it in KB, or None if unsupported."""
+    try:
+        hwm, rss = _read_status_kb('VmHWM', 'VmRSS')
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (OSError, KeyError, ValueError):
+        return None
+    for i in range(len(_open_peaks)):
+        _open_peaks[i] = max(_open_peaks[i], hwm)
+    return rss
+
+def trace_path(base_dir:str, config:Dict, script:str, key:str) -> Optional[str]:
+    """Trace file of one job, or None if TRACE_DIR is not set."""
+    if not config.get('TRACE_DIR'):
+        return None
+    return os.path.join(base_dir, config['TRACE_DIR'], f"{script}_{key}.jsonl")
+
+class Tracer:
+    """Appends a record per stage to `path`; with path None, stages run untraced.
+
+    context: fields of every record, e.g. script, key and J. Picklable, so a tracer can go
+    to pool workers along with the stage it times (see traced_call).
+    """
+    def __init__(self, path:Optional[str], **context):
+        self.path = path
+        self.context = context
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @contextmanager
+    def stage(self, stage:str, **fields) -> Iterator[Dict]:
+        """Time the body; fields, and whatever the body adds to the yielded dict, go into the record.
+
+        A stage that raises is recorded too, with the exception's type as `error`.
+        """
+        record = dict(self.context, stage=stage, **fields)
+        start_kb = _reset_peak() if self.path is not None else None
+        if start_kb is not None:
+            _open_peaks.append(start_kb)
+        else:
+            # KB on Linux
+            start_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            if self.path is not None:
+                peak_kb, scope = self._stage_peak_kb()
+                record.update(
+                    wall_s=time.perf_counter() - wall,
+                    cpu_s=time.process_time() - cpu,
+                    rss_start_mb=start_kb / 1024,
+                    peak_rss_mb=peak_kb / 1024,
+                    rss_scope=scope,
+                    host=socket.gethostname(),
+                    pid=os.getpid(),
+                    time=datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                )
+                self.emit(record)
+
+    @staticmethod
+    def _stage_peak_kb() -> Tuple[int, str]:
+        """(peak RSS in KB, 'stage' or 'process') at the end of the innermost open stage."""
+        if _open_peaks:
+            peak = _open_peaks.pop()
+            try:
+                peak = max(peak, _read_status_kb('VmHWM')[0])
+            except (OSError, KeyError, ValueError):
+                pass
+            # what an enclosing stage would have seen had the mark not been reset
+            if _open_peaks:
+                _open_peaks[-1] = max(_open_peaks[-1], peak)
+            return peak, 'stage'
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'process'
+
+    def emit(self, record:Dict):
+        line = (json.dumps(record, default=str) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+def traced_call(tracer:Tracer, stage:str, fields:Dict, fn:Callable, kwargs:Dict):
+    """fn(**kwargs) as one traced stage; for `utils_pool.map_kwargs`, which runs it where the work is done."""
+    with tracer.stage(stage, **fields):
+        return fn(**kwargs)
+
+def traced_kwargs(tracer:Tracer, stage:str, fn:Callable, kwargs_list:List[Dict], fields_list:List[Dict]) -> List[Dict]:
+    """map_kwargs arguments running traced_call(fn) on each of kwargs_list."""
+    return [dict(tracer=tracer, stage=stage, fields=fields, fn=fn, kwargs=kwargs) for kwargs, fields in zip(kwargs_list, fields_list)]
+
+def read_traces(trace_dir:str) -> pd.DataFrame:
+    """All records of all jobs in trace_dir."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, '*.jsonl'))):
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of a job killed mid-write
+                    continue
+    return pd.DataFrame(records)
+
+def rollup(traces:pd.DataFrame, by:List[str]) -> pd.DataFrame:
+    """Per group: stage count, wall and CPU hours, their share of the total CPU hours, mean wall,
+    max peak RSS and the max rise of the RSS during a stage above its start.
+    """
+    traces = traces.copy()
+    traces['rss_rise_mb'] = (traces['peak_rss_mb'] - traces['rss_start_mb']).clip(lower=0) if 'rss_start_mb' in traces else float('nan')
+    for column in by:
+        traces[column] = traces[column].fillna('-') if column in traces else '-'
+    table = traces.groupby(by, dropna=False).agg(
+        n=('wall_s', 'size'),
+        wall_h=('wall_s', lambda x: x.sum() / 3600),
+        cpu_h=('cpu_s', lambda x: x.sum() / 3600),
+        mean_wall_s=('wall_s', 'mean'),
+        max_rss_mb=('peak_rss_mb', 'max'),
+        max_rise_mb=('rss_rise_mb', 'max'),
+    )
+    table['cpu_share'] = table['cpu_h'] / table['cpu_h'].sum()
+    return table.sort_values('cpu_h', ascending=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll up the per-stage trace records of the grid.")
+    parser.add_argument('trace_dir', nargs='?', default='traces')
+    parser.add_argument('--by', nargs='+', default=['stage', 'J', 'data_framework'], help="grouping fields")
+    parser.add_argument('--csv', default=None, help="also write the table to this CSV")
+    args = parser.parse_args()
+
+    traces = read_traces(args.trace_dir)
+    if traces.empty:
+        raise SystemExit(f"No trace records in {args.trace_dir}")
+    table = rollup(traces, args.by)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3f}'.format):
+        print(table)
+    print(f"{len(traces)} stages of {traces['key'].nunique()} jobs: "
+          f"{traces['wall_s'].sum() / 3600:.2f} wall hours, {traces['cpu_s'].sum() / 3600:.2f} CPU hours")
+    if args.csv:
+        table.to_csv(args.csv)